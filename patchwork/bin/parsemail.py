@@ -23,15 +23,13 @@ from __future__ import absolute_import
 
 import argparse
 import codecs
+import copy
+from collections import OrderedDict
 import datetime
-from email import message_from_file
+from email.feedparser import BytesFeedParser, FeedParser
 from email.header import Header, decode_header
-from email.parser import HeaderParser
 from email.utils import parsedate_tz, mktime_tz
-from fnmatch import fnmatch
-from functools import reduce
 import logging
-import operator
 import re
 import sys
 import weakref
@@ -43,19 +41,21 @@ if __name__ == '__main__':
 
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.core.exceptions import MultipleObjectsReturned
+from django.db import IntegrityError, models, transaction
 from django.db.models import Q
 from django.utils.log import AdminEmailHandler
 from django.utils import six
 from django.utils.six.moves import map
 
+from patchwork import deferred, ingeststats
 from patchwork import lock as lockmod
 from patchwork.lock import release
 from patchwork.models import (Patch, Project, Person, Comment, State, Series,
                               SeriesRevision, SeriesRevisionPatch,
-                              DelegationRule, get_default_initial_patch_state,
+                              ThreadIndex, expire_caches, register_cache,
+                              get_default_initial_patch_state,
                               series_revision_complete, SERIES_DEFAULT_NAME)
-from patchwork.parser import parse_patch, patch_get_filenames
+from patchwork.parser import analyse_patch, patch_get_filenames
 
 LOGGER = logging.getLogger(__name__)
 
@@ -67,6 +67,9 @@ VERBOSITY_LEVELS = {
     'critical': logging.CRITICAL
 }
 
+# parse_mail() return value for mails that have already been parsed
+DUPLICATE_MAIL = 2
+
 list_id_headers = ['List-ID', 'X-Mailing-List', 'X-list']
 whitespace_re = re.compile(r'\s+')
 
@@ -80,10 +83,15 @@ def clean_header(header):
 
     def decode(fragment):
         (frag_str, frag_encoding) = fragment
-        if frag_encoding:
+        if frag_encoding and frag_encoding != 'unknown-8bit':
             return frag_str.decode(frag_encoding)
-        elif isinstance(frag_str, six.binary_type):  # python 2
-            return frag_str.decode()
+        elif isinstance(frag_str, six.binary_type):
+            # unencoded 8-bit headers, which the bytes parser of python 3
+            # tags as unknown-8bit, are most likely UTF-8
+            try:
+                return frag_str.decode('utf-8')
+            except UnicodeDecodeError:
+                return frag_str.decode('latin-1')
         return frag_str
 
     fragments = list(map(decode, decode_header(header)))
@@ -91,16 +99,65 @@ def clean_header(header):
     return normalise_space(u' '.join(fragments))
 
 
-def find_project(mail):
+listid_res = [re.compile(r'.*<([^>]+)>.*', re.S),
+              re.compile(r'^([\S]+)$', re.S)]
+
+
+class ProjectRoutes(object):
+    """The projects receiving the mails of each list, with their subject
+       prefix tags already split"""
+
+    def __init__(self):
+        # listid -> [(project, subject prefix tags)], ordered so projects
+        # with a blank subject_prefix_tags come first
+        self.routes = {}
+        for project in Project.objects.order_by('subject_prefix_tags', 'pk'):
+            self.routes.setdefault(project.listid, []).append(
+                (project, project.get_subject_prefix_tags()))
+
+    def get(self, listid):
+        return self.routes.get(listid, [])
+
+
+_project_routes = None
+
+
+def get_project_routes():
+    """The ProjectRoutes, built once and kept until a project changes"""
+    global _project_routes
+
+    if _project_routes is None:
+        _project_routes = ProjectRoutes()
+    return _project_routes
+
+
+def _clear_project_routes():
+    global _project_routes
+    _project_routes = None
+
+
+def _project_routes_invalidate_callback(sender, **kwargs):
+    _clear_project_routes()
+
+
+models.signals.post_save.connect(_project_routes_invalidate_callback,
+                                 sender=Project)
+models.signals.post_delete.connect(_project_routes_invalidate_callback,
+                                   sender=Project)
+register_cache(_clear_project_routes)
+
+
+@ingeststats.timed('find_project')
+def find_project(mail, routes=None):
     project = None
-    listid_res = [re.compile(r'.*<([^>]+)>.*', re.S),
-                  re.compile(r'^([\S]+)$', re.S)]
+    if routes is None:
+        routes = get_project_routes()
 
     for header in list_id_headers:
         if header in mail:
 
             for listid_re in listid_res:
-                match = listid_re.match(mail.get(header))
+                match = listid_re.match(clean_header(mail.get(header)))
                 if match:
                     break
 
@@ -109,29 +166,26 @@ def find_project(mail):
 
             listid = match.group(1)
 
-            # order_by will put projects with a blank subject_prefix_tags
-            # first
-            projects = Project.objects.filter(listid=listid).\
-                order_by('subject_prefix_tags')
+            projects = routes.get(listid)
             if not projects:
                 break
 
             # fast path for the common case
             if len(projects) == 1:
-                project = projects[0]
+                project = projects[0][0]
                 break
 
             (_, prefixes) = clean_subject(mail.get('Subject'))
             catchall_project = None
-            if not projects[0].get_subject_prefix_tags():
-                catchall_project = projects[0]
+            if not projects[0][1]:
+                catchall_project = projects[0][0]
 
-            for p in projects:
-                if not p.get_subject_prefix_tags():
+            for (p, tags) in projects:
+                if not tags:
                     continue
 
                 for prefix in prefixes:
-                    if prefix in p.get_subject_prefix_tags():
+                    if prefix in tags:
                         project = p
 
             if not project:
@@ -140,6 +194,56 @@ def find_project(mail):
     return project
 
 
+class PersonCache(object):
+    """The most recently seen people, by lowercase email"""
+
+    def __init__(self, size):
+        self.size = size
+        self.people = OrderedDict()
+
+    def get(self, email):
+        person = self.people.pop(email, None)
+        if person is not None:
+            self.people[email] = person
+        return person
+
+    def add(self, person):
+        if self.size <= 0 or person.email_lower is None:
+            return
+        self.people.pop(person.email_lower, None)
+        self.people[person.email_lower] = person
+        while len(self.people) > self.size:
+            self.people.popitem(last=False)
+
+    def remove(self, email):
+        self.people.pop(email, None)
+
+    def clear(self):
+        self.people.clear()
+
+
+person_cache = PersonCache(settings.PARSEMAIL_PERSON_CACHE_SIZE)
+# people merged or deleted by another process are dropped with the caches
+register_cache(person_cache.clear)
+
+
+def cache_person(person):
+    # only remember people once they are committed, a rolled back person
+    # must not be found again
+    transaction.on_commit(lambda: person_cache.add(person))
+
+
+def _person_cache_invalidate_callback(sender, instance, **kwargs):
+    person_cache.remove(instance.email_lower)
+
+
+models.signals.post_save.connect(_person_cache_invalidate_callback,
+                                 sender=Person)
+models.signals.post_delete.connect(_person_cache_invalidate_callback,
+                                   sender=Person)
+
+
+@ingeststats.timed('find_author')
 def find_author(mail):
 
     from_header = clean_header(mail.get('From'))
@@ -174,18 +278,52 @@ def find_author(mail):
 
     save_required = False
 
-    try:
-        person = Person.objects.get(email__iexact=email)
-        if person.name != name:
-            person.name = name
+    person = person_cache.get(email.lower())
+    if person is None:
+        try:
+            person = Person.objects.get(email_lower=email.lower())
+            cache_person(person)
+        except Person.DoesNotExist:
+            person = Person(name=name, email=email)
             save_required = True
-    except Person.DoesNotExist:
-        person = Person(name=name, email=email)
+
+    if person.pk is not None and person.name != name:
+        # don't touch the cached person until the new name is saved
+        person = copy.copy(person)
+        person.name = name
         save_required = True
 
     return (person, save_required)
 
 
+def save_author(author):
+    """Save author, coping with the same new person being created by
+       a concurrent parsemail, eg. for another project"""
+    if author.pk is not None:
+        # author may come from person_cache, only write what we changed
+        author.save(update_fields=['name'])
+        cache_person(author)
+        return author
+
+    try:
+        with transaction.atomic():
+            author.save()
+        cache_person(author)
+        return author
+    except IntegrityError:
+        # the mail is parsed in a single transaction, whose snapshot may not
+        # show the person committed meanwhile: with REPEATABLE READ (the
+        # default of MySQL), a plain read keeps seeing the snapshot taken
+        # by the first query. A locking read sees the latest committed row.
+        person = Person.objects.select_for_update().get(
+            email_lower=author.email.lower())
+        if person.name != author.name:
+            person.name = author.name
+            person.save(update_fields=['name'])
+        cache_person(person)
+        return person
+
+
 def mail_date(mail):
     t = parsedate_tz(mail.get('Date', ''))
     if not t:
@@ -194,10 +332,58 @@ def mail_date(mail):
 
 
 def mail_headers(mail):
-    return reduce(operator.__concat__,
-                  ['%s: %s\n' % (k, Header(v, header_name=k,
-                                           continuation_ws='\t').encode())
-                   for (k, v) in list(mail.items())])
+    def header(name, value):
+        # unencoded 8-bit headers are parsed into Header objects
+        if isinstance(value, Header):
+            value = clean_header(value)
+        return Header(value, header_name=name, continuation_ws='\t').encode()
+
+    return ''.join(['%s: %s\n' % (k, header(k, v))
+                    for (k, v) in mail.items()])
+
+
+class MailTooLarge(Exception):
+    pass
+
+
+# size of the chunks read_mail() feeds the parser with
+READ_CHUNK_SIZE = 64 * 1024
+
+
+def read_chunks(f, max_size=None):
+    """Iterate over the chunks of the binary file f. Raises MailTooLarge,
+       once the rest of f has been read, if it's larger than max_size
+       bytes."""
+    size = 0
+
+    while True:
+        chunk = f.read(READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        size += len(chunk)
+        if max_size and size > max_size:
+            # read the rest so the sender doesn't see a broken pipe
+            while chunk:
+                chunk = f.read(READ_CHUNK_SIZE)
+                size += len(chunk)
+            raise MailTooLarge('mail of %d bytes, the limit is %d bytes' %
+                               (size, max_size))
+        yield chunk
+
+
+def read_mail(f, max_size=None):
+    """Parse the mail read from the binary file f, by chunks. The payload of
+       the non-text parts, which are never looked at, is dropped right away.
+       Raises MailTooLarge if the mail is larger than max_size bytes."""
+    parser = BytesFeedParser() if six.PY3 else FeedParser()
+    for chunk in read_chunks(f, max_size):
+        parser.feed(chunk)
+
+    mail = parser.close()
+    for part in mail.walk():
+        if not part.is_multipart() and part.get_content_maintype() != 'text':
+            part.set_payload('')
+    return mail
 
 
 def find_pull_request(content):
@@ -228,6 +414,7 @@ class MailContent:
         self.revision = None
         self.patch_order = 1    # place of the patch in the series
         self.filenames = []     # files touched by a diff
+        self.refs = []          # ancestors of the mail in its thread
 
 
 def build_references_from_headers(in_reply_to, references):
@@ -246,48 +433,41 @@ def build_references_from_headers(in_reply_to, references):
     return refs
 
 
-def get_object_by_msgid(cls, msgid):
-    try:
-        return cls.objects.get(msgid=msgid)
-    except cls.DoesNotExist:
-        return None
-    except MultipleObjectsReturned:
-        # it's theoritically possible to have the same message id for 2
-        # patches or comments, take the more recent object then, why
-        # not.
-        return cls.objects.filter(msgid=msgid).order_by('-date')[0]
-
-
-def find_header_in_text(headers, name):
-    parser = HeaderParser()
-    headers = parser.parsestr(headers)
-    return headers[name]
-
-
 def build_references_from_db(msgid):
-    # msgid belongs to either a patch or a comment
-    object = get_object_by_msgid(Patch, msgid)
-    if not object:
-        object = get_object_by_msgid(Comment, msgid)
-
-    if not object:
-        # cover letters are thread roots, but don't have a corresponding
-        # Comment object as the cover letter is stored in Series.
+    """The list of ancestors of msgid, from its parent up to the root of the
+       thread, as recorded by index_message()"""
+    try:
+        return ThreadIndex.objects.get(msgid=msgid).references
+    except ThreadIndex.DoesNotExist:
+        # cover letters are thread roots, but aren't indexed as they don't
+        # have a corresponding Patch or Comment object.
         return []
 
-    in_reply_to = find_header_in_text(object.headers, 'In-Reply-To')
-    references = find_header_in_text(object.headers, 'References')
-    refs = build_references_from_headers(in_reply_to, references)
+
+@ingeststats.timed('index_message')
+def index_message(msgid, refs):
+    """Record the ancestors of msgid, as given by build_references_list()"""
+    root_msgid = refs[-1] if refs else msgid
+    try:
+        with transaction.atomic():
+            ThreadIndex.objects.create(msgid=msgid,
+                                       parent_msgid=refs[0] if refs else None,
+                                       root_msgid=root_msgid,
+                                       references=refs)
+    except IntegrityError:
+        # we've already seen that mail, eg. the same patch sent to two lists
+        return
 
     if not refs:
-        return []
+        return
 
-    # note that we recurse on the highest ancestor found, not necessarily the
-    # immediate parent (depends: if the mail found in the DB is from a
-    # actually MUA which filled in the 'References:' header or if it is a
-    # git send-email mail, with only 'In-References-To: defined
-    ancestor_msgid = refs[-1]
-    return refs + build_references_from_db(ancestor_msgid)
+    # mails received before this one only knew the thread up to msgid, they
+    # can now know the rest
+    for entry in ThreadIndex.objects.filter(root_msgid=msgid) \
+                                    .exclude(msgid=msgid):
+        entry.references = entry.references + refs
+        entry.root_msgid = root_msgid
+        entry.save()
 
 
 def build_references_from_mail(mail):
@@ -295,6 +475,7 @@ def build_references_from_mail(mail):
                                          mail.get('References', None))
 
 
+@ingeststats.timed('build_references_list')
 def build_references_list(mail):
     """Construct the list of msgids from 'mail' to the root of the thread"""
 
@@ -332,16 +513,29 @@ def is_git_send_email(mail):
         'git-send-email' in mail.get('Message-ID', '')
 
 
+@ingeststats.timed('find_content')
 def find_content(project, mail, force_comment=False):
     patchbuf = None
+    # analysis of the inline patch, if patchbuf comes from one
+    analysis = None
     commentbuf = ''
     pullurl = None
     is_attachment = False
 
+    max_part_size = settings.PARSEMAIL_MAX_PART_SIZE
+
     for part in mail.walk():
         if part.get_content_maintype() != 'text':
             continue
 
+        # don't bother decoding huge parts, the size of the encoded payload
+        # is close enough
+        if max_part_size and len(part.get_payload()) > max_part_size:
+            LOGGER.warning("Ignoring the %s part of mail '%s': larger than "
+                           "%d bytes", part.get_content_type(),
+                           mail.get('Message-Id'), max_part_size)
+            continue
+
         payload = part.get_payload(decode=True)
         subtype = part.get_content_subtype()
 
@@ -376,12 +570,15 @@ def find_content(project, mail, force_comment=False):
         if subtype in ['x-patch', 'x-diff']:
             is_attachment = True
             patchbuf = payload
+            analysis = None
 
         elif subtype == 'plain':
             c = payload
 
             if not patchbuf:
-                (patchbuf, c) = parse_patch(payload)
+                with ingeststats.stage('analyse_patch'):
+                    analysis = analyse_patch(payload)
+                (patchbuf, c) = (analysis.patch, analysis.comment)
 
             if not pullurl:
                 pullurl = find_pull_request(payload)
@@ -398,7 +595,7 @@ def find_content(project, mail, force_comment=False):
     drop_prefixes += project.get_subject_prefix_tags()
     (name, prefixes) = clean_subject(mail.get('Subject'), drop_prefixes)
     (x, n) = parse_series_marker(prefixes)
-    refs = build_references_list(mail)
+    refs = ret.refs = build_references_list(mail)
     is_root = refs == []
     is_cover_letter = is_root and x == 0
     is_patch = patchbuf is not None
@@ -410,9 +607,15 @@ def find_content(project, mail, force_comment=False):
         ret.patch_order = x or 1
         ret.patch = Patch(name=name, pull_url=pullurl, content=patchbuf,
                           date=mail_date(mail), headers=mail_headers(mail))
+        if analysis and is_patch:
+            # saves Patch.save() from hashing the patch again
+            ret.patch.hash = analysis.hash.hexdigest()
 
     if patchbuf:
-        ret.filenames = patch_get_filenames(patchbuf)
+        if analysis:
+            ret.filenames = analysis.filenames
+        else:
+            ret.filenames = patch_get_filenames(patchbuf)
 
     # Create/update the Series and SeriesRevision objects
     if is_cover_letter or is_patch:
@@ -469,15 +672,7 @@ def find_previous_patch(project, revision, order, refs):
     # if one of the parents was a patch, this is an update. Well, almost. We
     # also need to make sure we don't match a patch from a series without a
     # cover letter (see comment below).
-    parent_patch = None
-    for ref in refs:
-        try:
-            patch = Patch.objects.get(project=project, msgid=ref)
-            parent_patch = patch
-            break
-        except Patch.DoesNotExist:
-            continue
-
+    parent_patch = find_patch_by_refs(project, refs)
     if not parent_patch:
         return None
 
@@ -520,6 +715,7 @@ def find_patch_order(revisions, previous_patch, order, n_patches):
 #     be updated once we receive the root message.
 #   - we need to create new revisions when the mail is actually a new version
 #     of a previous patch
+@ingeststats.timed('find_series_for_mail')
 def find_series_for_mail(project, name, msgid, is_patch, order, n_patches,
                          refs):
     if refs == []:
@@ -555,25 +751,36 @@ def find_series_for_mail(project, name, msgid, is_patch, order, n_patches,
     return (series, revision, order, n_patches)
 
 
-def find_patch_for_comment(project, refs):
-    for ref in refs:
-        patch = None
+def find_patch_by_refs(project, refs, comments=False):
+    """Find the patch of project that is the closest ancestor in refs or,
+       with comments, the patch of the closest ancestor being a comment.
+       For a given ref, a patch wins over a comment."""
+    if not refs:
+        return None
 
-        # first, check for a direct reply
-        try:
-            patch = Patch.objects.get(project=project, msgid=ref)
-            return patch
-        except Patch.DoesNotExist:
-            pass
+    patches = Patch.objects.filter(project=project, msgid__in=refs)
+    patches = dict((patch.msgid, patch) for patch in patches)
+    first = next((i for (i, ref) in enumerate(refs) if ref in patches), None)
+
+    # a comment only wins if it's closer in the thread than that patch
+    candidates = refs if first is None else refs[:first]
+    if comments and candidates:
+        query = Comment.objects.filter(patch__project=project,
+                                       msgid__in=candidates)
+        comment_patches = dict(query.values_list('msgid', 'patch_id'))
+        for ref in candidates:
+            if ref in comment_patches:
+                return Patch.objects.get(pk=comment_patches[ref])
+
+    if first is None:
+        return None
+    return patches[refs[first]]
 
-        # see if we have comments that refer to a patch
-        try:
-            comment = Comment.objects.get(patch__project=project, msgid=ref)
-            return comment.patch
-        except Comment.DoesNotExist:
-            pass
 
-    return None
+@ingeststats.timed('find_patch_for_comment')
+def find_patch_for_comment(project, refs):
+    # either a direct reply or a reply to a comment of a patch
+    return find_patch_by_refs(project, refs, comments=True)
 
 
 split_re = re.compile(r'[,\s]+')
@@ -653,27 +860,25 @@ def get_state(state_name):
     """ Return the state with the given name or the default State """
     if state_name:
         try:
-            return State.objects.get(name__iexact=state_name)
+            return State.from_string(state_name)
         except State.DoesNotExist:
             pass
     return get_default_initial_patch_state()
 
 
+@ingeststats.timed('auto_delegate')
 def auto_delegate(project, filenames):
     if not filenames:
         return None
 
-    rules = list(DelegationRule.objects.filter(project=project))
+    matcher = project.delegation_matcher
+    if not matcher.rules:
+        return None
 
     patch_delegate = None
 
     for filename in filenames:
-        file_delegate = None
-        for rule in rules:
-            if fnmatch(filename, rule.path):
-                file_delegate = rule.user
-                break
-
+        file_delegate = matcher.delegate(filename)
         if file_delegate is None:
             return None
 
@@ -704,6 +909,7 @@ def clean_series_name(str):
     return str.strip()
 
 
+@ingeststats.timed('on_revision_complete')
 def on_revision_complete(sender, revision, **kwargs):
     # Brand new series (revision.version == 1) may be updates to a Series
     # previously posted. Hook the SeriesRevision to the previous series then.
@@ -714,10 +920,10 @@ def on_revision_complete(sender, revision, **kwargs):
     if new_series.name == SERIES_DEFAULT_NAME:
         return
 
-    name = clean_series_name(new_series.name)
+    name = clean_series_name(new_series.name).lower()
     previous_series = Series.objects.filter(
             Q(project=new_series.project),
-            Q(name__iexact=name) & ~Q(pk=new_series.pk))
+            Q(name_lower=name) & ~Q(pk=new_series.pk))[:2]
     if len(previous_series) != 1:
         return
 
@@ -727,15 +933,26 @@ def on_revision_complete(sender, revision, **kwargs):
     new_revision.cover_letter = revision.cover_letter
     new_revision.n_patches = revision.n_patches
     new_revision.save()
-    i = 1
-    for patch in revision.ordered_patches():
-        new_revision.add_patch(patch, i)
-        i += 1
+    new_revision.add_patches((patch, order) for (order, patch)
+                             in enumerate(revision.ordered_patches(), 1))
 
     revision.delete()
     new_series.delete()
 
 
+@ingeststats.timed('is_duplicate')
+def is_duplicate(project, msgid):
+    """Has the mail msgid already been parsed for project? Mails seen for
+       the first time only cost a lookup in the thread index."""
+    if not ThreadIndex.objects.filter(msgid=msgid).exists():
+        return False
+
+    # the same mail can be sent to several projects
+    return (Patch.objects.filter(project=project, msgid=msgid).exists() or
+            Comment.objects.filter(patch__project=project,
+                                   msgid=msgid).exists())
+
+
 def parse_mail(mail):
 
     # some basic sanity checks
@@ -756,16 +973,46 @@ def parse_mail(mail):
         LOGGER.debug("Ignoring mail due to 'ignore' hint")
         return 0
 
-    project = find_project(mail)
-    if project is None:
-        LOGGER.error('Failed to find a project for mail')
-        return 1
-
+    msgid = mail.get('Message-Id').strip()
+    with ingeststats.record_mail(msgid):
+        # see the changes of the configuration made by other processes
+        expire_caches()
+        project = find_project(mail)
+        if project is None:
+            LOGGER.error('Failed to find a project for mail')
+            return 1
+
+        parse_lock = None
+        try:
+            with ingeststats.stage('lock'):
+                parse_lock = lock(project)
+            # a mail is parsed in a single transaction, committed with the
+            # project lock held. The work derived from the changes (revision
+            # states, events, tag counts) is done once, before committing.
+            with transaction.atomic(), deferred.collect():
+                # re-delivered mail, eg. MTA retries or list resends. Checked
+                # with the lock held, so that concurrent deliveries of the
+                # same mail see each other.
+                if is_duplicate(project, msgid):
+                    LOGGER.info("Ignoring mail '%s' already parsed for "
+                                "project '%s'", msgid, project.linkname)
+                    ingeststats.count('duplicate')
+                    return DUPLICATE_MAIL
+
+                ret = parse_project_mail(project, mail,
+                                         force_comment=(hint == 'comment'))
+                with ingeststats.stage('deferred'):
+                    deferred.run()
+            return ret
+        finally:
+            release(parse_lock)
+
+
+def parse_project_mail(project, mail, force_comment=False):
     msgid = mail.get('Message-Id').strip()
 
     (author, save_required) = find_author(mail)
 
-    force_comment = (hint == "comment")
     content = find_content(project, mail, force_comment)
     if not content:
         return 0
@@ -778,16 +1025,18 @@ def parse_mail(mail):
 
     if series:
         if save_required:
-            author.save()
+            author = save_author(author)
             save_required = False
         series.project = project
         series.submitter = author
-        series.save()
+        with ingeststats.stage('save_series'):
+            series.save()
         LOGGER.debug('Series saved')
 
     if revision:
         revision.series = series
-        revision.save()
+        with ingeststats.stage('save_revision'):
+            revision.save()
         LOGGER.debug('Revision saved')
 
     if patch:
@@ -797,29 +1046,35 @@ def parse_mail(mail):
 
         # we delay the saving until we know we have a patch.
         if save_required:
-            author.save()
+            author = save_author(author)
             save_required = False
         patch.submitter = author
         patch.msgid = msgid
         patch.project = project
         patch.state = get_state(mail.get('X-Patchwork-State', '').strip())
         patch.delegate = delegate
-        patch.save()
+        with ingeststats.stage('save_patch'):
+            patch.save()
         if revision:
-            revision.add_patch(patch, content.patch_order)
+            with ingeststats.stage('add_patch'):
+                revision.add_patch(patch, content.patch_order)
         LOGGER.debug('Patch saved')
 
     if comment:
         if save_required:
-            author.save()
+            author = save_author(author)
         # we defer this assignment until we know that we have a saved patch
         if patch:
             comment.patch = patch
         comment.submitter = author
         comment.msgid = msgid
-        comment.save()
+        with ingeststats.stage('save_comment'):
+            comment.save()
         LOGGER.debug('Comment saved')
 
+    if patch or comment:
+        index_message(msgid, content.refs)
+
     series_revision_complete.disconnect(on_revision_complete)
 
     return 0
@@ -836,6 +1091,16 @@ extra_error_message = '''
 '''
 
 
+class MailFilter(logging.Filter):
+    """Give a mail to the records logged without one, for the formatter of
+       the error handler"""
+
+    def filter(self, record):
+        if not hasattr(record, 'mail'):
+            record.mail = '(not available)'
+        return True
+
+
 # Send emails to settings.ADMINS when encountering errors
 def setup_error_handler():
     if settings.DEBUG:
@@ -844,6 +1109,7 @@ def setup_error_handler():
     mail_handler = AdminEmailHandler()
     mail_handler.setLevel(logging.ERROR)
     mail_handler.setFormatter(logging.Formatter(extra_error_message))
+    mail_handler.addFilter(MailFilter())
 
     logger = logging.getLogger('patchwork')
     logger.addHandler(mail_handler)
@@ -851,26 +1117,31 @@ def setup_error_handler():
     return logger
 
 
-_lockref = None
+_lockrefs = {}
 
 
-def lock():
-    global _lockref
+def lock(project=None):
+    """Take the lock serialising the parsing of mails for project, or for
+       all the projects if project is None or PARSEMAIL_LOCK_SCOPE is
+       'global'. Taking a lock already held by this process is allowed."""
+    path = "/tmp/patchwork.parsemail.lock"
+    if project is not None and settings.PARSEMAIL_LOCK_SCOPE == 'project':
+        path = "/tmp/patchwork.parsemail.%s.lock" % project.linkname
 
-    lk = _lockref and _lockref()
+    lockref = _lockrefs.get(path)
+    lk = lockref and lockref()
     if lk is not None and lk.held:
         lk.lock()
         return lk
 
-    lk = lockmod.lock("/tmp/patchwork.parsemail.lock", timeout=60)
-    _lockref = weakref.ref(lk)
+    lk = lockmod.lock(path, timeout=60)
+    _lockrefs[path] = weakref.ref(lk)
     return lk
 
 
 def main(args):
     logger = setup_error_handler()
     parser = argparse.ArgumentParser()
-    parse_lock = None
 
     def list_logging_levels():
         """Give a summary of all available logging levels."""
@@ -879,14 +1150,35 @@ def main(args):
 
     parser.add_argument('--verbosity', choices=list_logging_levels(),
                         help='logging level', default='info')
+    parser.add_argument('--spool', action='store_true',
+                        help='store the mail in PARSEMAIL_SPOOL_DIR, to be '
+                             'parsed by the Celery workers')
 
     args = vars(parser.parse_args())
 
     logging.basicConfig(level=VERBOSITY_LEVELS[args['verbosity']])
 
-    mail = message_from_file(sys.stdin)
+    stdin = sys.stdin.buffer if six.PY3 else sys.stdin
+    if args['spool']:
+        # only needed to spool, not to parse
+        from patchwork.spool import spool_mail
+
+        try:
+            data = b''.join(read_chunks(stdin,
+                                        settings.PARSEMAIL_MAX_MAIL_SIZE))
+        except MailTooLarge as e:
+            LOGGER.warning('Ignoring mail: %s', e)
+            return 1
+        spool_mail(data)
+        return 0
+
+    try:
+        mail = read_mail(stdin, settings.PARSEMAIL_MAX_MAIL_SIZE)
+    except MailTooLarge as e:
+        LOGGER.warning('Ignoring mail: %s', e)
+        return 1
+
     try:
-        parse_lock = lock()
         return parse_mail(mail)
     except Exception:
         if logger:
@@ -894,8 +1186,6 @@ def main(args):
                 'mail': mail.as_string(),
             })
         raise
-    finally:
-        release(parse_lock)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,103 @@
+# Patchwork - automated patch tracking system
+# Copyright (C) 2018 Intel Corporation
+#
+# This file is part of the Patchwork package.
+#
+# Patchwork is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Patchwork is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Patchwork; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Defer the work derived from model changes to the end of a block.
+
+Inside collect(), the work passed to defer() (updating the state of a
+revision, logging an event, ...) is queued instead of being run right away,
+once per key, and run when the block ends. parse_mail() collects the work
+of each mail inside its transaction, so a revision receiving several
+patches is only updated once, just before the commit. Outside collect(),
+defer() runs the work immediately."""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import threading
+
+_local = threading.local()
+
+
+def collecting():
+    return getattr(_local, 'tasks', None) is not None
+
+
+@contextmanager
+def collect():
+    """Run the work deferred in the block when it ends, and drop it if the
+       block raises an exception. Nested blocks are part of the outermost
+       one."""
+    if not start():
+        yield
+        return
+
+    try:
+        yield
+        run()
+    finally:
+        stop()
+
+
+def start():
+    """Start collecting the deferred work, for the blocks that can't be
+       written with collect(). Returns False if the work is already being
+       collected, in which case stop() must not be called."""
+    if collecting():
+        return False
+    _local.tasks = OrderedDict()
+    return True
+
+
+def stop():
+    """Stop collecting, dropping the work that hasn't been run"""
+    _local.tasks = None
+
+
+def run():
+    """Run the work deferred so far, without waiting for the end of the
+       collect() block"""
+    # the deferred work can defer more work
+    while collecting() and _local.tasks:
+        (_, (func, args)) = _local.tasks.popitem(last=False)
+        func(*args)
+
+
+def defer(key, func, *args):
+    """Run func(*args) at the end of the current collect() block. Work
+       deferred again with the same key is only run once, with the latest
+       arguments."""
+    if not collecting():
+        func(*args)
+        return
+
+    _local.tasks[key] = (func, args)
+
+
+def pending(key):
+    """The arguments of the work deferred with key, None if there is none"""
+    if not collecting():
+        return None
+    task = _local.tasks.get(key)
+    return task[1] if task is not None else None
+
+
+def discard(key):
+    """Forget about the work deferred with key, eg. because the objects it
+       works on have been deleted"""
+    if collecting():
+        _local.tasks.pop(key, None)
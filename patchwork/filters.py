@@ -25,6 +25,7 @@ from django.utils.safestring import mark_safe
 from django.utils import six
 from django.utils.six.moves.urllib.parse import quote
 
+from patchwork import search
 from patchwork.models import Person, State
 
 
@@ -242,7 +243,7 @@ class SearchFilter(Filter):
         self.applied = True
 
     def kwargs(self):
-        return {'name__icontains': self.search}
+        return {'pk__in': search.matching(self.search)}
 
     def condition(self):
         return self.search
@@ -0,0 +1,192 @@
+# Patchwork - automated patch tracking system
+# Copyright (C) 2018 Intel Corporation
+#
+# This file is part of the Patchwork package.
+#
+# Patchwork is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Patchwork is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Patchwork; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Time the stages of parsing incoming mails.
+
+When settings.PARSEMAIL_STATS is True (or after enable() has been called),
+parse_mail() records for each mail how long each stage took and how many
+database queries it made, and logs it to the 'patchwork.ingeststats'
+logger. Stages can be nested, the time and queries of a stage include the
+ones of its sub-stages. The stages of all the mails parsed by the process
+are also aggregated in 'histogram', which long running processes
+(parsemail_server, importmail) can dump, along with counters of events
+such as dropped duplicate mails."""
+
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+import functools
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+
+LOGGER = logging.getLogger(__name__)
+
+_local = threading.local()
+_enabled = False
+
+
+def enable():
+    """Record the stages of the mails, regardless of PARSEMAIL_STATS"""
+    global _enabled
+    _enabled = True
+
+
+def enabled():
+    return _enabled or settings.PARSEMAIL_STATS
+
+
+def _query_count():
+    return len(connection.queries_log)
+
+
+class MailStats(object):
+
+    def __init__(self, msgid):
+        self.msgid = msgid
+        # stage name -> [seconds, queries]
+        self.stages = OrderedDict()
+
+    def add(self, name, seconds, queries):
+        stage = self.stages.setdefault(name, [0.0, 0])
+        stage[0] += seconds
+        stage[1] += queries
+
+    def __str__(self):
+        return '%s: %s' % (self.msgid, ', '.join(
+            '%s %.1fms/%dq' % (name, seconds * 1000, queries)
+            for (name, (seconds, queries)) in self.stages.items()))
+
+
+class StageHistogram(object):
+    """Distribution of the time spent in each stage"""
+
+    # upper bounds of the buckets, in milliseconds
+    buckets = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # stage name -> [count, seconds, queries, [count per bucket]]
+        self.stages = OrderedDict()
+        self.counters = Counter()
+
+    def add(self, stats):
+        for (name, (seconds, queries)) in stats.stages.items():
+            stage = self.stages.setdefault(
+                name, [0, 0.0, 0, [0] * (len(self.buckets) + 1)])
+            stage[0] += 1
+            stage[1] += seconds
+            stage[2] += queries
+            i = 0
+            while i < len(self.buckets) and seconds * 1000 > self.buckets[i]:
+                i += 1
+            stage[3][i] += 1
+
+    def format(self):
+        header = ['stage', 'count', 'avg ms', 'avg queries']
+        header += ['<%dms' % b for b in self.buckets]
+        header += ['>%dms' % self.buckets[-1]]
+        rows = [header]
+        for (name, (count, seconds, queries, hist)) in self.stages.items():
+            rows.append([name, str(count),
+                         '%.1f' % (seconds * 1000 / count),
+                         '%.1f' % (float(queries) / count)] +
+                        [str(n) for n in hist])
+
+        widths = [max(len(row[i]) for row in rows)
+                  for i in range(len(header))]
+        lines = [' '.join(cell.rjust(width) if i else cell.ljust(width)
+                          for (i, (cell, width))
+                          in enumerate(zip(row, widths)))
+                 for row in rows]
+        lines += ['%s: %d' % (name, n)
+                  for (name, n) in sorted(self.counters.items())]
+        return '\n'.join(lines)
+
+
+histogram = StageHistogram()
+
+
+def count(name):
+    """Count an event, regardless of the stages being recorded"""
+    histogram.counters[name] += 1
+
+
+@contextmanager
+def stage(name):
+    """Account the time spent in the block to stage name of the current
+       mail, if any"""
+    stats = getattr(_local, 'stats', None)
+    if stats is None:
+        yield
+        return
+
+    start = time.time()
+    queries = _query_count()
+    try:
+        yield
+    finally:
+        stats.add(name, time.time() - start, _query_count() - queries)
+
+
+def timed(name):
+    """Decorator accounting the time spent in a function to stage name"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if getattr(_local, 'stats', None) is None:
+                return func(*args, **kwargs)
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def record_mail(msgid):
+    """Record the stages of parsing the mail msgid. Yields the MailStats
+       object, None when not enabled."""
+    if not enabled() or getattr(_local, 'stats', None) is not None:
+        yield None
+        return
+
+    stats = MailStats(msgid)
+    _local.stats = stats
+    # make the connection log queries so we can count them, in a log of the
+    # mail's own: the log of the connection keeps the last 9000 queries, so
+    # its length stops growing once full, eg. in the Celery workers which
+    # never reset it
+    force_debug_cursor = connection.force_debug_cursor
+    connection.force_debug_cursor = True
+    queries_log = connection.queries_log
+    connection.queries_log = deque()
+    try:
+        with stage('total'):
+            yield stats
+    finally:
+        queries_log.extend(connection.queries_log)
+        connection.queries_log = queries_log
+        connection.force_debug_cursor = force_debug_cursor
+        _local.stats = None
+        histogram.add(stats)
+        LOGGER.info('%s', stats, extra={'ingest_stats': stats.stages})
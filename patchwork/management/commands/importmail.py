@@ -0,0 +1,240 @@
+# Patchwork - automated patch tracking system
+# Copyright (C) 2018 Intel Corporation
+#
+# This file is part of the Patchwork package.
+#
+# Patchwork is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Patchwork is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Patchwork; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import json
+import logging
+import mailbox
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import reset_queries, transaction
+
+from patchwork import ingeststats
+from patchwork.bin.parsemail import (DUPLICATE_MAIL, find_project, lock,
+                                     MailTooLarge, parse_mail, read_mail)
+from patchwork.lock import release
+
+LOGGER = logging.getLogger(__name__)
+
+
+def read_mail_file(path):
+    with open(path, 'rb') as f:
+        return read_mail(f, settings.PARSEMAIL_MAX_MAIL_SIZE)
+
+
+def list_mail_files(path, subdirs=('',)):
+    """List the mail files found in path, oldest first, like 'ls -1rt'"""
+    files = []
+    for subdir in subdirs:
+        dirpath = os.path.join(path, subdir)
+        for filename in os.listdir(dirpath):
+            if filename.startswith('.'):
+                continue
+            filepath = os.path.join(dirpath, filename)
+            if not os.path.isfile(filepath):
+                continue
+            files.append((os.path.getmtime(filepath),
+                          os.path.join(subdir, filename)))
+
+    return [f for (_, f) in sorted(files)]
+
+
+def guess_format(path):
+    if os.path.isfile(path):
+        return 'mbox'
+    if all(os.path.isdir(os.path.join(path, d))
+           for d in ('cur', 'new', 'tmp')):
+        return 'maildir'
+    return 'dir'
+
+
+def open_source(path, fmt):
+    """Return the list of keys identifying the mails of the source, in
+       arrival order, and a function loading a mail from its key"""
+    if fmt == 'auto':
+        fmt = guess_format(path)
+
+    if fmt == 'mbox':
+        box = mailbox.mbox(path, factory=None, create=False)
+
+        def load(key):
+            f = box.get_file(int(key))
+            try:
+                return read_mail(f, settings.PARSEMAIL_MAX_MAIL_SIZE)
+            finally:
+                f.close()
+
+        return ([str(key) for key in box.iterkeys()], load)
+
+    if fmt == 'maildir':
+        keys = list_mail_files(path, ('cur', 'new'))
+    else:
+        keys = list_mail_files(path)
+
+    return (keys, lambda key: read_mail_file(os.path.join(path, key)))
+
+
+class ImportStats(object):
+
+    def __init__(self):
+        self.start = time.time()
+        self.imported = 0
+        self.duplicates = 0
+        self.dropped = 0
+        self.errors = 0
+
+    @property
+    def processed(self):
+        return self.imported + self.duplicates + self.dropped + self.errors
+
+    @property
+    def rate(self):
+        elapsed = time.time() - self.start
+        return self.processed / elapsed if elapsed else 0.0
+
+
+class Command(BaseCommand):
+    help = ('Import the mails of a mbox, a maildir or a directory of mails '
+            '(oldest first), as if they were delivered one by one to '
+            'parsemail.sh')
+
+    def add_arguments(self, parser):
+        parser.add_argument('source',
+                            help='mbox file, maildir or directory of mails')
+        parser.add_argument('--format', default='auto',
+                            choices=['auto', 'mbox', 'maildir', 'dir'],
+                            help='format of the source (default: %(default)s)')
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help='number of mails committed in a single '
+                                 'transaction (default: %(default)s)')
+        parser.add_argument('--checkpoint', metavar='FILE',
+                            help='record the progress in FILE after each '
+                                 'batch and resume from it if it exists')
+        parser.add_argument('--stats', action='store_true',
+                            help='print how long each stage of parsing the '
+                                 'mails took')
+
+    def read_checkpoint(self, path, source, keys):
+        if not path or not os.path.exists(path):
+            return 0
+
+        with open(path) as f:
+            checkpoint = json.load(f)
+
+        count = checkpoint['count']
+        if (checkpoint['source'] != source or count > len(keys) or
+                (count and keys[count - 1] != checkpoint['last'])):
+            raise CommandError("checkpoint '%s' doesn't match '%s'" %
+                               (path, source))
+        return count
+
+    def write_checkpoint(self, path, source, keys, count):
+        if not path:
+            return
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'source': source,
+                'count': count,
+                'last': keys[count - 1] if count else None,
+            }, f)
+        os.rename(tmp_path, path)
+
+    def import_mail(self, key, load, locks, stats):
+        try:
+            mail = load(key)
+            # parse_mail() takes the project lock itself but we need to keep
+            # it until the batch is committed
+            project = find_project(mail)
+            if project is not None and project.pk not in locks:
+                locks[project.pk] = lock(project)
+            with transaction.atomic():
+                ret = parse_mail(mail)
+        except MailTooLarge as e:
+            LOGGER.warning("Ignoring mail '%s': %s", key, e)
+            stats.dropped += 1
+            return
+        except Exception:
+            LOGGER.exception("Error when importing mail '%s'", key)
+            stats.errors += 1
+            return
+        finally:
+            reset_queries()
+
+        if ret == 0:
+            stats.imported += 1
+        elif ret == DUPLICATE_MAIL:
+            stats.duplicates += 1
+        else:
+            stats.dropped += 1
+
+    def import_batch(self, keys, load, stats):
+        locks = {}
+        try:
+            with transaction.atomic():
+                for key in keys:
+                    self.import_mail(key, load, locks, stats)
+        finally:
+            release(*locks.values())
+
+    def handle(self, *args, **options):
+        source = os.path.abspath(options['source'])
+        batch_size = options['batch_size']
+        checkpoint = options['checkpoint']
+        verbosity = options['verbosity']
+
+        if options['stats']:
+            ingeststats.enable()
+
+        if batch_size < 1:
+            raise CommandError('--batch-size must be a positive number')
+        if not os.path.exists(source):
+            raise CommandError("'%s' doesn't exist" % source)
+
+        (keys, load) = open_source(source, options['format'])
+        count = len(keys)
+        start = self.read_checkpoint(checkpoint, source, keys)
+        if start and verbosity > 0:
+            self.stdout.write('resuming after %d mails' % start)
+
+        stats = ImportStats()
+        for i in range(start, count, batch_size):
+            batch = keys[i:i + batch_size]
+            self.import_batch(batch, load, stats)
+            self.write_checkpoint(checkpoint, source, keys, i + len(batch))
+
+            if verbosity > 0:
+                self.stdout.write('%06d/%06d, %.1f mails/s' %
+                                  (i + len(batch), count, stats.rate),
+                                  ending='\r')
+                self.stdout.flush()
+
+        if verbosity > 0:
+            self.stdout.write('\n%d mails imported, %d duplicates, '
+                              '%d dropped, %d errors in %.1fs '
+                              '(%.1f mails/s)' %
+                              (stats.imported, stats.duplicates,
+                               stats.dropped, stats.errors,
+                               time.time() - stats.start, stats.rate))
+
+        if options['stats']:
+            self.stdout.write(ingeststats.histogram.format())
@@ -0,0 +1,378 @@
+# Patchwork - automated patch tracking system
+# Copyright (C) 2018 Intel Corporation
+#
+# This file is part of the Patchwork package.
+#
+# Patchwork is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Patchwork is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Patchwork; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import io
+import logging
+import os
+import signal
+import socket
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, reset_queries
+from django.utils.six.moves import socketserver
+
+from patchwork import ingeststats
+from patchwork.bin.parsemail import (parse_mail, read_mail,
+                                     setup_error_handler, VERBOSITY_LEVELS)
+from patchwork.spool import spool_mail
+
+LOGGER = logging.getLogger(__name__)
+
+# Django verbosity (0-3) to logging level
+LOGGING_LEVELS = ['warning', 'info', 'debug', 'debug']
+
+# Maximum length of a command line, including CRLF (RFC 5321 4.5.3.1.4)
+MAX_COMMAND_LINE = 512
+
+# Maximum length of a line of mail data. RFC 5321 4.5.3.1.6 allows 1000
+# bytes, but longer lines are common enough in patches to be accepted.
+MAX_DATA_LINE = 64 * 1024
+
+# Seconds a client may stay silent before the connection is closed, the
+# server only serves one connection at a time (RFC 5321 4.5.3.2.7)
+IDLE_TIMEOUT = 300
+
+
+class MailSession(object):
+    """The server side of a LMTP (RFC 2033) or SMTP (RFC 5321) session.
+
+    This only implements what a local MTA needs to hand mails over to us.
+    Each received mail is given to deliver(), as bytes, which returns the
+    response line to send back. With LMTP, that response is sent once for
+    each accepted recipient. Mails larger than max_size bytes are refused
+    without being kept in memory."""
+
+    def __init__(self, rfile, wfile, deliver, lmtp=True, hostname=None,
+                 max_size=None):
+        self.rfile = rfile
+        self.wfile = wfile
+        self.deliver = deliver
+        self.lmtp = lmtp
+        self.max_size = max_size
+        self.hostname = hostname or socket.getfqdn()
+        self.greeted = False
+        self.reset()
+
+    def reset(self):
+        self.mail_from = None
+        self.rcpt_to = []
+
+    def reply(self, *lines):
+        for line in lines:
+            self.wfile.write(line.encode('ascii') + b'\r\n')
+        self.wfile.flush()
+
+    def read_data(self):
+        """Return (mail data, None), (None, the response refusing the mail)
+           if it is too large or has too long lines, or None if the
+           connection was closed"""
+        lines = []
+        size = 0
+        refusal = None
+        # whether the line read is the start of a line, or the rest of a
+        # too long one
+        line_start = True
+        while True:
+            line = self.rfile.readline(MAX_DATA_LINE + 1)
+            if not line:
+                return None
+            if line_start:
+                if line in (b'.\r\n', b'.\n'):
+                    break
+                if line.startswith(b'.'):
+                    line = line[1:]
+            line_start = line.endswith(b'\n')
+            if line.endswith(b'\r\n'):
+                line = line[:-2] + b'\n'
+            size += len(line)
+
+            # keep reading until the end of the data, dropping it
+            if refusal is not None:
+                continue
+            if not line_start:
+                LOGGER.warning('Refusing mail with a line longer than %d '
+                               'bytes', MAX_DATA_LINE)
+                refusal = '500 5.5.2 Line too long'
+            elif self.max_size and size > self.max_size:
+                LOGGER.warning('Refusing mail larger than %d bytes',
+                               self.max_size)
+                refusal = '552 5.3.4 Message too big'
+            else:
+                lines.append(line)
+
+        if refusal is not None:
+            return (None, refusal)
+        return (b''.join(lines), None)
+
+    def run(self):
+        self.reply('220 %s Patchwork %s ready' %
+                   (self.hostname, 'LMTP' if self.lmtp else 'ESMTP'))
+
+        while True:
+            line = self.rfile.readline(MAX_COMMAND_LINE + 1)
+            if not line:
+                return
+            if len(line) > MAX_COMMAND_LINE:
+                self.reply('500 5.5.2 Line too long')
+                return
+
+            line = line.decode('ascii', 'replace').rstrip('\r\n')
+            command, _, arg = line.partition(' ')
+            handler = getattr(self, 'cmd_' + command.lower(), None)
+            if handler is None:
+                self.reply('500 5.5.1 Command unrecognized')
+                continue
+
+            if handler(arg.strip()) is False:
+                return
+
+    def _hello(self, arg, extended):
+        if not arg:
+            self.reply('501 5.5.4 Syntax: %s hostname' %
+                       ('LHLO' if self.lmtp else 'EHLO'))
+            return
+        self.greeted = True
+        self.reset()
+        if extended:
+            self.reply('250-%s' % self.hostname, '250-8BITMIME',
+                       '250-SIZE %d' % (self.max_size or 0),
+                       '250 ENHANCEDSTATUSCODES')
+        else:
+            self.reply('250 %s' % self.hostname)
+
+    def cmd_lhlo(self, arg):
+        if not self.lmtp:
+            self.reply('500 5.5.1 Command unrecognized')
+            return
+        self._hello(arg, True)
+
+    def cmd_ehlo(self, arg):
+        if self.lmtp:
+            self.reply('500 5.5.1 Command unrecognized')
+            return
+        self._hello(arg, True)
+
+    def cmd_helo(self, arg):
+        if self.lmtp:
+            self.reply('500 5.5.1 Command unrecognized')
+            return
+        self._hello(arg, False)
+
+    def cmd_mail(self, arg):
+        if not self.greeted:
+            self.reply('503 5.5.1 Send %s first' %
+                       ('LHLO' if self.lmtp else 'HELO/EHLO'))
+            return
+        if self.mail_from is not None:
+            self.reply('503 5.5.1 Nested MAIL command')
+            return
+        if not arg.upper().startswith('FROM:'):
+            self.reply('501 5.5.4 Syntax: MAIL FROM:<address>')
+            return
+        self.mail_from = arg[5:].strip()
+        self.reply('250 2.1.0 OK')
+
+    def cmd_rcpt(self, arg):
+        if self.mail_from is None:
+            self.reply('503 5.5.1 Need MAIL command')
+            return
+        if not arg.upper().startswith('TO:'):
+            self.reply('501 5.5.4 Syntax: RCPT TO:<address>')
+            return
+        self.rcpt_to.append(arg[3:].strip())
+        self.reply('250 2.1.5 OK')
+
+    def cmd_data(self, arg):
+        if not self.rcpt_to:
+            self.reply('503 5.5.1 Need RCPT command')
+            return
+        self.reply('354 End data with <CR><LF>.<CR><LF>')
+
+        result = self.read_data()
+        if result is None:
+            return False
+
+        (data, response) = result
+        if response is None:
+            response = self.deliver(data)
+        if self.lmtp:
+            self.reply(*[response] * len(self.rcpt_to))
+        else:
+            self.reply(response)
+        self.reset()
+
+    def cmd_rset(self, arg):
+        self.reset()
+        self.reply('250 2.0.0 OK')
+
+    def cmd_noop(self, arg):
+        self.reply('250 2.0.0 OK')
+
+    def cmd_vrfy(self, arg):
+        self.reply('252 2.5.2 Cannot VRFY user')
+
+    def cmd_quit(self, arg):
+        self.reply('221 2.0.0 Bye')
+        return False
+
+
+def check_db_connections():
+    """Drop the database connections that went away while we were idle, so
+       the next query can reconnect. Unlike close_old_connections(), usable
+       connections are kept regardless of CONN_MAX_AGE."""
+    for conn in connections.all():
+        if conn.connection is not None and not conn.is_usable():
+            conn.close()
+
+
+def deliver_mail(data):
+    mail = read_mail(io.BytesIO(data))
+
+    check_db_connections()
+    try:
+        parse_mail(mail)
+    except Exception:
+        # also mailed to the admins, by the handler of setup_error_handler()
+        LOGGER.exception('Error when parsing incoming email', extra={
+            'mail': mail.as_string(),
+        })
+        return '451 4.3.0 Error when parsing mail'
+    finally:
+        # don't let DEBUG accumulate queries forever
+        reset_queries()
+
+    return '250 2.0.0 OK'
+
+
+def spool_delivered_mail(data):
+    try:
+        spool_mail(data)
+    except Exception:
+        LOGGER.exception('Error when spooling incoming email')
+        return '451 4.3.0 Error when spooling mail'
+    return '250 2.0.0 OK'
+
+
+class MailRequestHandler(socketserver.StreamRequestHandler):
+
+    def setup(self):
+        # a stalled client, or an MTA caching its connection, would block
+        # the other deliveries
+        self.timeout = self.server.idle_timeout
+        socketserver.StreamRequestHandler.setup(self)
+
+    def handle(self):
+        session = MailSession(self.rfile, self.wfile, self.server.deliver,
+                              lmtp=self.server.lmtp,
+                              max_size=settings.PARSEMAIL_MAX_MAIL_SIZE)
+        try:
+            session.run()
+        except socket.timeout:
+            LOGGER.info('Closing the connection of an idle client')
+            try:
+                session.reply('421 4.4.2 Idle for too long, closing')
+            except socket.error:
+                pass
+
+
+class TCPMailServer(socketserver.TCPServer):
+    allow_reuse_address = True
+
+
+class UnixMailServer(socketserver.UnixStreamServer):
+    pass
+
+
+class Command(BaseCommand):
+    help = ('Receive mails over LMTP (or SMTP) and parse them in a long '
+            'running process, as an alternative to parsemail.sh')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--socket', metavar='PATH',
+                            help='listen on a Unix domain socket')
+        parser.add_argument('--host', default='127.0.0.1',
+                            help='address to listen on (default: %(default)s)')
+        parser.add_argument('--port', type=int, default=8024,
+                            help='port to listen on (default: %(default)s)')
+        parser.add_argument('--smtp', action='store_true',
+                            help='speak SMTP instead of LMTP')
+        parser.add_argument('--spool', action='store_true',
+                            help='only store the mails in '
+                                 'PARSEMAIL_SPOOL_DIR, to be parsed by the '
+                                 'Celery workers')
+        parser.add_argument('--timeout', type=int, default=IDLE_TIMEOUT,
+                            help='seconds before closing the connection of '
+                                 'an idle client (default: %(default)s)')
+        parser.add_argument('--stats', action='store_true',
+                            help='record how long each stage of parsing the '
+                                 'mails takes, SIGUSR1 logs the histogram')
+
+    def create_server(self, options):
+        if options['socket']:
+            path = options['socket']
+            if os.path.exists(path):
+                os.unlink(path)
+            return UnixMailServer(path, MailRequestHandler)
+
+        return TCPMailServer((options['host'], options['port']),
+                             MailRequestHandler)
+
+    def handle(self, *args, **options):
+        logging.basicConfig(level=VERBOSITY_LEVELS[
+            LOGGING_LEVELS[options['verbosity']]])
+        setup_error_handler()
+
+        if options['spool'] and not settings.PARSEMAIL_SPOOL_DIR:
+            raise CommandError('PARSEMAIL_SPOOL_DIR is not set')
+
+        try:
+            server = self.create_server(options)
+        except (socket.error, OSError) as e:
+            raise CommandError('failed to listen: %s' % e)
+
+        server.lmtp = not options['smtp']
+        server.idle_timeout = options['timeout']
+        if options['spool']:
+            server.deliver = spool_delivered_mail
+        else:
+            server.deliver = deliver_mail
+
+        def terminate(signum, frame):
+            sys.exit(0)
+        signal.signal(signal.SIGTERM, terminate)
+
+        def dump_stats(signum, frame):
+            LOGGER.info('Parsing stages:\n%s',
+                        ingeststats.histogram.format())
+        if options['stats']:
+            ingeststats.enable()
+        signal.signal(signal.SIGUSR1, dump_stats)
+
+        LOGGER.info('Listening on %s (%s)', server.server_address,
+                    'SMTP' if options['smtp'] else 'LMTP')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            if options['socket']:
+                os.unlink(options['socket'])
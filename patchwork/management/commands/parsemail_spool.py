@@ -0,0 +1,89 @@
+# Patchwork - automated patch tracking system
+# Copyright (C) 2018 Intel Corporation
+#
+# This file is part of the Patchwork package.
+#
+# Patchwork is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Patchwork is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Patchwork; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from patchwork.spool import Spool, SpoolError
+from patchwork.tasks import parse_spooled_file, parse_spooled_mail
+
+
+class Command(BaseCommand):
+    help = ('Manage the spool of incoming mails: show its status, queue the '
+            'pending mails again, retry the mails that failed to parse or '
+            'parse the pending mails without going through Celery')
+
+    def add_arguments(self, parser):
+        parser.add_argument('action',
+                            choices=['status', 'requeue', 'retry', 'process'])
+        parser.add_argument('names', nargs='*',
+                            help='failed mails to retry (default: all)')
+        parser.add_argument('--stale-after', type=int, default=3600,
+                            metavar='SECONDS',
+                            help='with requeue, mails being parsed for more '
+                                 'than SECONDS are considered abandoned by '
+                                 'a dead worker (default: %(default)s)')
+
+    def status(self, spool):
+        for subdir in ('new', 'cur', 'failed'):
+            self.stdout.write('%s: %d' % (subdir, len(spool.list(subdir))))
+
+        for name in spool.list('failed'):
+            self.stdout.write('\n== %s' % name)
+            error_path = os.path.join(spool.dir('failed'), name + '.error')
+            if os.path.exists(error_path):
+                with open(error_path) as f:
+                    self.stdout.write(f.read().rstrip('\n'))
+
+    def queue(self, keys):
+        for key in keys:
+            parse_spooled_mail.delay(key)
+        self.stdout.write('%d threads queued' % len(keys))
+
+    def handle(self, *args, **options):
+        try:
+            spool = Spool()
+        except SpoolError as e:
+            raise CommandError(str(e))
+
+        action = options['action']
+        if options['names'] and action != 'retry':
+            raise CommandError('only retry takes mail names')
+
+        if action == 'status':
+            self.status(spool)
+
+        elif action == 'requeue':
+            spool.recover(options['stale_after'])
+            self.queue(spool.keys())
+
+        elif action == 'retry':
+            try:
+                keys = spool.retry(options['names'] or None)
+            except SpoolError as e:
+                raise CommandError(str(e))
+            self.queue(keys)
+
+        elif action == 'process':
+            count = 0
+            for key in spool.keys():
+                count += spool.process(key, parse_spooled_file)
+            self.stdout.write('%d mails parsed, %d failed' %
+                              (count, len(spool.list('failed'))))
@@ -0,0 +1,58 @@
+# Patchwork - automated patch tracking system
+# Copyright (C) 2018 Intel Corporation
+#
+# This file is part of the Patchwork package.
+#
+# Patchwork is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Patchwork is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Patchwork; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from patchwork import search
+from patchwork.models import Patch, search_documents
+
+# patches indexed per transaction
+BATCH = 500
+
+
+class Command(BaseCommand):
+    help = ('Index the patches for search. Without patch ids, the index is '
+            'created again from scratch')
+
+    def add_arguments(self, parser):
+        parser.add_argument('patch_ids', nargs='*', type=int)
+
+    def handle(self, *args, **options):
+        pks = options['patch_ids']
+
+        if not pks:
+            backend = search.get_backend()
+            if not backend.create_sql():
+                self.stdout.write('no index to build')
+                return
+            with connection.cursor() as cursor:
+                for sql in backend.drop_sql() + backend.create_sql():
+                    cursor.execute(sql)
+            pks = Patch.objects.order_by('pk').values_list('pk', flat=True)
+
+        pks = list(pks)
+        count = len(pks)
+        for i in range(0, count, BATCH):
+            with transaction.atomic():
+                search.index(search_documents(pks[i:i + BATCH]))
+            self.stdout.write('%06d/%06d\r' % (min(i + BATCH, count), count),
+                              ending='')
+            self.stdout.flush()
+        self.stdout.write('\ndone')
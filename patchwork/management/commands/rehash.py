@@ -22,8 +22,13 @@
 
 from django.core.management.base import BaseCommand
 
+from patchwork import deferred
 from patchwork.models import Patch
 
+# the work derived from saving patches (eg. updating the state of their
+# revisions) is run once for this many patches
+DEFERRED_BATCH = 1000
+
 
 class Command(BaseCommand):
     help = 'Update the hashes on existing patches'
@@ -39,10 +44,13 @@ class Command(BaseCommand):
 
         count = query.count()
 
-        for i, patch in enumerate(query.iterator()):
-            patch.hash = None
-            patch.save()
-            if (i % 10) == 0:
-                self.stdout.write('%06d/%06d\r' % (i, count), ending='')
-                self.stdout.flush()
+        with deferred.collect():
+            for i, patch in enumerate(query.iterator()):
+                patch.hash = None
+                patch.save()
+                if (i % 10) == 0:
+                    self.stdout.write('%06d/%06d\r' % (i, count), ending='')
+                    self.stdout.flush()
+                if (i % DEFERRED_BATCH) == DEFERRED_BATCH - 1:
+                    deferred.run()
         self.stdout.write('\ndone')
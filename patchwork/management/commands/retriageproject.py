@@ -21,8 +21,9 @@ from email.parser import HeaderParser
 import sys
 
 from django.core.management.base import BaseCommand
+from patchwork import deferred
 from patchwork.models import Patch, Project
-from patchwork.bin.parsemail import find_project
+from patchwork.bin.parsemail import find_project, get_project_routes
 
 
 class Command(BaseCommand):
@@ -43,25 +44,29 @@ class Command(BaseCommand):
             sys.exit(1)
 
         parser = HeaderParser()
+        # saving patches and series doesn't touch the projects, the routing
+        # table can be kept for the whole run
+        routes = get_project_routes()
         query = Patch.objects.filter(project=project)
         count = query.count()
-        for i, patch in enumerate(query.iterator()):
-            if (i % 10) == 0:
-                sys.stdout.write("%06d/%06d\r" % (i, count))
-                sys.stdout.flush()
+        with deferred.collect():
+            for i, patch in enumerate(query.iterator()):
+                if (i % 10) == 0:
+                    sys.stdout.write("%06d/%06d\r" % (i, count))
+                    sys.stdout.flush()
 
-            headers = parser.parsestr(patch.headers)
-            new_project = find_project(headers)
-            if new_project == patch.project:
-                continue
+                headers = parser.parsestr(patch.headers)
+                new_project = find_project(headers, routes)
+                if new_project == patch.project:
+                    continue
 
-            patch.project = new_project
-            patch.save()
-            series = patch.series()
-            if not series:
-                continue
-            series.project = new_project
-            series.save()
+                patch.project = new_project
+                patch.save()
+                series = patch.series()
+                if not series:
+                    continue
+                series.project = new_project
+                series.save()
 
         sys.stdout.write("%06d/%06d\r" % (count, count))
         sys.stdout.write('\ndone\n')
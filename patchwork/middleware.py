@@ -1,3 +1,6 @@
+from patchwork import deferred
+
+
 class AccessControlAllowOriginMiddleware:
     """Allow all API GET (read-only) requests from any domain"""
     def process_response(self, request, response):
@@ -6,3 +9,13 @@ class AccessControlAllowOriginMiddleware:
             response['Access-Control-Allow-Origin'] = '*'
             response['Access-Control-Allow-Headers'] = 'Content-Type'
         return response
+
+
+class DeferredWorkMiddleware:
+    """Run the work derived from the changes made by a view (eg. the state of
+       the revisions of the patches updated) once, when the view returns.
+       The view is called from here, so this must be the last middleware with
+       a process_view() method."""
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        with deferred.collect():
+            return view_func(request, *view_args, **view_kwargs)
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from email.parser import HeaderParser
+
+from django.db import migrations, models
+import jsonfield.fields
+
+
+def header_references(parser, headers):
+    headers = parser.parsestr(headers)
+    in_reply_to = headers['In-Reply-To']
+    references = headers['References']
+
+    refs = []
+    if in_reply_to:
+        refs.append(in_reply_to)
+    if references:
+        rs = references.split()
+        rs.reverse()
+        for r in rs:
+            if r not in refs:
+                refs.append(r)
+    return refs
+
+
+def index_threads(apps, schema_editor):
+    Patch = apps.get_model("patchwork", "Patch")
+    Comment = apps.get_model("patchwork", "Comment")
+    ThreadIndex = apps.get_model("patchwork", "ThreadIndex")
+
+    # msgid -> references found in the headers. When a msgid has several
+    # objects, parsemail used to pick the most recent patch, then the most
+    # recent comment.
+    parser = HeaderParser()
+    parents = {}
+    for model in (Comment, Patch):
+        query = model.objects.order_by('date').values_list('msgid', 'headers')
+        for (msgid, headers) in query.iterator():
+            parents[msgid] = header_references(parser, headers)
+
+    # walk up the thread through the highest known ancestor, the way
+    # parsemail used to do it when receiving each mail
+    entries = []
+    for (msgid, refs) in parents.items():
+        refs = list(refs)
+        seen = set([msgid])
+        while refs and refs[-1] not in seen and parents.get(refs[-1]):
+            seen.add(refs[-1])
+            refs += parents[refs[-1]]
+
+        entries.append(ThreadIndex(msgid=msgid,
+                                   parent_msgid=refs[0] if refs else None,
+                                   root_msgid=refs[-1] if refs else msgid,
+                                   references=refs))
+        if len(entries) >= 1000:
+            ThreadIndex.objects.bulk_create(entries)
+            entries = []
+
+    ThreadIndex.objects.bulk_create(entries)
+
+
+def noop(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patchwork', '0029_seriesrevision_is_rerun'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ThreadIndex',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('msgid', models.CharField(max_length=255, unique=True)),
+                ('parent_msgid', models.CharField(blank=True, max_length=255, null=True)),
+                ('root_msgid', models.CharField(db_index=True, max_length=255)),
+                ('references', jsonfield.fields.JSONField(default=list)),
+            ],
+        ),
+
+        migrations.RunPython(index_threads, noop),
+    ]
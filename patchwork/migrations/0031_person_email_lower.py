@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def fill_email_lower(apps, schema_editor):
+    Person = apps.get_model("patchwork", "Person")
+
+    # people whose address only differs by its case from the one of an
+    # older person are left out of the index
+    seen = set()
+    query = Person.objects.order_by('pk').values_list('pk', 'email')
+    for (pk, email) in query.iterator():
+        email_lower = email.lower()
+        if email_lower in seen:
+            continue
+        seen.add(email_lower)
+        Person.objects.filter(pk=pk).update(email_lower=email_lower)
+
+
+def noop(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patchwork', '0030_threadindex'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='person',
+            name='email_lower',
+            field=models.CharField(editable=False, max_length=255, null=True),
+        ),
+
+        migrations.RunPython(fill_email_lower, noop),
+
+        migrations.AlterField(
+            model_name='person',
+            name='email_lower',
+            field=models.CharField(editable=False, max_length=255, null=True, unique=True),
+        ),
+    ]
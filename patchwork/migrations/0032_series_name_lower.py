@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def fill_name_lower(apps, schema_editor):
+    Series = apps.get_model("patchwork", "Series")
+
+    query = Series.objects.order_by('pk').values_list('pk', 'name')
+    for (pk, name) in query.iterator():
+        Series.objects.filter(pk=pk).update(name_lower=name.lower()[:200])
+
+
+def noop(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patchwork', '0031_person_email_lower'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='series',
+            name='name_lower',
+            field=models.CharField(default='', editable=False, max_length=200),
+        ),
+
+        migrations.RunPython(fill_name_lower, noop),
+
+        migrations.AlterIndexTogether(
+            name='series',
+            index_together=set([('project', 'name_lower')]),
+        ),
+    ]
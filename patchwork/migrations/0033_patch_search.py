@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+from patchwork import search
+
+# patches indexed at once
+BATCH = 500
+
+
+def create_index(apps, schema_editor):
+    backend = search.get_backend(schema_editor.connection.vendor)
+    if not backend.create_sql():
+        return
+
+    for sql in backend.create_sql():
+        schema_editor.execute(sql)
+
+    # index the existing patches, so that searches don't miss them
+    Patch = apps.get_model('patchwork', 'Patch')
+    Comment = apps.get_model('patchwork', 'Comment')
+    pks = list(Patch.objects.order_by('pk').values_list('pk', flat=True))
+    for i in range(0, len(pks), BATCH):
+        batch = pks[i:i + BATCH]
+        backend.index(search.documents(Patch.objects.filter(pk__in=batch),
+                                       Comment.objects.filter(
+                                           patch__in=batch)))
+
+
+def drop_index(apps, schema_editor):
+    backend = search.get_backend(schema_editor.connection.vendor)
+    for sql in backend.drop_sql():
+        schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patchwork', '0032_series_name_lower'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
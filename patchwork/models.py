@@ -18,11 +18,12 @@
 # along with Patchwork; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
-from collections import Counter, OrderedDict
+from collections import Counter
 import datetime
 import jsonfield
 import random
 import re
+import time
 import patchwork.threadlocalrequest as threadlocalrequest
 
 from django.conf import settings
@@ -30,20 +31,27 @@ from django.contrib import auth
 from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
 from django.core.urlresolvers import reverse
-from django.db import models
-from django.db.models import Q
+from django.db import IntegrityError, models, transaction
+from django.db.models import F, Q
+import django.core.signals
 import django.dispatch
 from django.utils.encoding import python_2_unicode_compatible
 from django.utils.functional import cached_property
 from django.utils.six.moves import filter
 
+from patchwork import deferred, ingeststats, search
 from patchwork.fields import HashField
-from patchwork.parser import hash_patch, extract_tags
+from patchwork.parser import DelegationMatcher, hash_patch, TagMatcher
 
 
 @python_2_unicode_compatible
 class Person(models.Model):
     email = models.CharField(max_length=255, unique=True)
+    # email in lowercase, to look people up without a case-insensitive
+    # query. NULL for people created before it, whose address only differs
+    # by its case from the one of an older person.
+    email_lower = models.CharField(max_length=255, unique=True, null=True,
+                                   editable=False)
     name = models.CharField(max_length=255, null=True, blank=True)
     user = models.ForeignKey(User, null=True, blank=True,
                              on_delete=models.SET_NULL)
@@ -71,6 +79,75 @@ class Person(models.Model):
         verbose_name_plural = 'People'
 
 
+def _person_pre_save_callback(sender, instance, **kwargs):
+    if instance._state.adding or instance.email_lower is not None:
+        instance.email_lower = instance.email.lower()
+
+
+models.signals.pre_save.connect(_person_pre_save_callback, sender=Person)
+
+
+# (project.pk, project.use_tags) -> TagMatcher, see Project.tag_matcher
+_tag_matchers = {}
+
+# project.pk -> DelegationMatcher, see Project.delegation_matcher
+_delegation_matchers = {}
+
+# model -> all its instances, for the small tables that are looked up
+# all the time and rarely change (State, Event and Tag), see _registered()
+_registry = {}
+
+
+def _registered(model):
+    """All the instances of model, in its default ordering, loaded once
+       and shared until one of them is saved or deleted"""
+    instances = _registry.get(model)
+    if instances is None:
+        instances = list(model.objects.all())
+        _registry[model] = instances
+    return instances
+
+
+def _registry_invalidate_callback(sender, **kwargs):
+    _registry.pop(sender, None)
+
+
+# The caches of the configuration above, and the ones registered with
+# register_cache(), are invalidated by the signals of the process changing
+# it. The other processes (web workers, parsemail_server, Celery workers)
+# drop them once they are CONFIG_CACHE_TIMEOUT seconds old, checked by
+# expire_caches() before each request, mail and task.
+_cache_clear_functions = [_tag_matchers.clear, _delegation_matchers.clear,
+                          _registry.clear]
+_caches_cleared = time.time()
+
+
+def register_cache(clear):
+    """Have clear(), which empties a cache, called by clear_caches()"""
+    _cache_clear_functions.append(clear)
+
+
+def clear_caches():
+    global _caches_cleared
+
+    for clear in _cache_clear_functions:
+        clear()
+    _caches_cleared = time.time()
+
+
+def expire_caches():
+    """Clear the caches if they are older than CONFIG_CACHE_TIMEOUT"""
+    if time.time() - _caches_cleared >= settings.CONFIG_CACHE_TIMEOUT:
+        clear_caches()
+
+
+def _expire_caches_callback(sender, **kwargs):
+    expire_caches()
+
+
+django.core.signals.request_started.connect(_expire_caches_callback)
+
+
 def get_comma_separated_field(value):
     if not value:
         return []
@@ -97,9 +174,38 @@ class Project(models.Model):
 
     @cached_property
     def tags(self):
-        if not self.use_tags:
-            return []
-        return list(Tag.objects.all())
+        return self.tag_matcher.tags
+
+    @property
+    def tag_matcher(self):
+        """The TagMatcher counting this project's tags. It's compiled once
+           and shared by all the instances of the project."""
+        key = (self.pk, self.use_tags)
+        matcher = _tag_matchers.get(key)
+        if matcher is None:
+            tags = []
+            if self.use_tags:
+                tags = _registered(Tag)
+            matcher = TagMatcher(tags)
+            if self.pk is not None:
+                _tag_matchers[key] = matcher
+        return matcher
+
+    @property
+    def delegation_matcher(self):
+        """The DelegationMatcher of this project's delegation rules. It's
+           compiled once and shared by all the instances of the project."""
+        matcher = _delegation_matchers.get(self.pk)
+        if matcher is None:
+            rules = []
+            if self.pk is not None:
+                rules = DelegationRule.objects.filter(project=self) \
+                                              .select_related('user')
+            matcher = DelegationMatcher((rule.path, rule.user)
+                                        for rule in rules)
+            if self.pk is not None:
+                _delegation_matchers[self.pk] = matcher
+        return matcher
 
     def get_subject_prefix_tags(self):
         return get_comma_separated_field(self.subject_prefix_tags)
@@ -139,6 +245,23 @@ class DelegationRule(models.Model):
         unique_together = (('path', 'project'))
 
 
+def _delegation_matchers_invalidate_callback(sender, instance, **kwargs):
+    if sender == Project:
+        _delegation_matchers.pop(instance.pk, None)
+    else:
+        _delegation_matchers.pop(instance.project_id, None)
+
+
+models.signals.post_save.connect(_delegation_matchers_invalidate_callback,
+                                 sender=DelegationRule)
+models.signals.post_delete.connect(_delegation_matchers_invalidate_callback,
+                                   sender=DelegationRule)
+models.signals.post_save.connect(_delegation_matchers_invalidate_callback,
+                                 sender=Project)
+models.signals.post_delete.connect(_delegation_matchers_invalidate_callback,
+                                   sender=Project)
+
+
 @python_2_unicode_compatible
 class UserProfile(models.Model):
     user = models.OneToOneField(User, unique=True, related_name='profile',
@@ -215,9 +338,20 @@ class State(models.Model):
     ordering = models.IntegerField(unique=True)
     action_required = models.BooleanField(default=True)
 
+    @classmethod
+    def from_pk(cls, pk):
+        for state in _registered(State):
+            if state.pk == pk:
+                return state
+        return State.objects.get(pk=pk)
+
     @classmethod
     def from_string(cls, name):
-        return State.objects.get(name__iexact=name)
+        name = name.lower()
+        for state in _registered(State):
+            if state.name.lower() == name:
+                return state
+        raise State.DoesNotExist("no state '%s'" % name)
 
     def __str__(self):
         return self.name
@@ -248,6 +382,24 @@ class Tag(models.Model):
         ordering = ['abbrev']
 
 
+def _tag_matchers_invalidate_callback(sender, instance, **kwargs):
+    if sender == Project:
+        _tag_matchers.pop((instance.pk, True), None)
+        _tag_matchers.pop((instance.pk, False), None)
+    else:
+        _tag_matchers.clear()
+
+
+models.signals.post_save.connect(_tag_matchers_invalidate_callback,
+                                 sender=Tag)
+models.signals.post_delete.connect(_tag_matchers_invalidate_callback,
+                                   sender=Tag)
+models.signals.post_save.connect(_tag_matchers_invalidate_callback,
+                                 sender=Project)
+models.signals.post_delete.connect(_tag_matchers_invalidate_callback,
+                                   sender=Project)
+
+
 class PatchTag(models.Model):
     patch = models.ForeignKey('Patch', on_delete=models.CASCADE)
     tag = models.ForeignKey('Tag', on_delete=models.CASCADE)
@@ -258,41 +410,51 @@ class PatchTag(models.Model):
 
 
 def get_default_initial_patch_state():
-    return State.objects.get(ordering=0)
-
-
-class PatchQuerySet(models.query.QuerySet):
-
-    def with_tag_counts(self, project):
-        if not project.use_tags:
-            return self
-
-        # We need the project's use_tags field loaded for Project.tags().
-        # Using prefetch_related means we'll share the one instance of
-        # Project, and share the project.tags cache between all patch.project
-        # references.
-        qs = self.prefetch_related('project')
-        select = OrderedDict()
-        select_params = []
-        for tag in project.tags:
-            select[tag.attr_name] = (
-                "coalesce("
-                     "(SELECT count FROM patchwork_patchtag "
-                     "WHERE patchwork_patchtag.patch_id=patchwork_patch.id "
-                     "AND patchwork_patchtag.tag_id=%s), 0)")
-            select_params.append(tag.id)
-
-        return qs.extra(select=select, select_params=select_params)
+    for state in _registered(State):
+        if state.ordering == 0:
+            return state
+    raise State.DoesNotExist('no initial state')
+
+
+def set_tag_counts(patches, project):
+    """Set the tag_<id>_count attributes of the patches to the counts of the
+       tags of project, eg. for the page of a patch list. The counts of all
+       the patches are looked up with a single query, whatever the number of
+       tags."""
+    if not project.use_tags:
+        return
 
+    patches = list(patches)
+    tags = project.tags
+    counts = {}
+    if patches:
+        query = PatchTag.objects.filter(
+            patch__in=[patch.pk for patch in patches],
+            tag__in=[tag.pk for tag in tags])
+        for (patch_id, tag_id, count) in query.values_list(
+                'patch_id', 'tag_id', 'count'):
+            counts[(patch_id, tag_id)] = count
+
+    for patch in patches:
+        for tag in tags:
+            setattr(patch, tag.attr_name, counts.get((patch.pk, tag.pk), 0))
 
-class PatchManager(models.Manager):
-    use_for_related_fields = True
 
-    def get_queryset(self):
-        return PatchQuerySet(self.model, using=self.db)
+def set_series_ids(patches):
+    """Look the ids of the series of the patches up with a single query, for
+       their next save, eg. when changing the state of many patches at once.
+       Without it, logging the state change of a patch queries its series."""
+    patches = list(patches)
+    series_ids = {}
+    if patches:
+        query = SeriesRevisionPatch.objects.filter(
+            patch__in=[patch.pk for patch in patches])
+        for (patch_id, series_id) in query.values_list(
+                'patch_id', 'revision__series_id'):
+            series_ids.setdefault(patch_id, series_id)
 
-    def with_tag_counts(self, project):
-        return self.get_queryset().with_tag_counts(project)
+    for patch in patches:
+        patch._known_series_id = series_ids.get(patch.pk)
 
 
 def filename(name, ext):
@@ -320,8 +482,6 @@ class Patch(models.Model):
     hash = HashField(null=True, blank=True)
     tags = models.ManyToManyField(Tag, through=PatchTag)
 
-    objects = PatchManager()
-
     def commit_message(self):
         """Retrieves the commit message"""
         return Comment.objects.filter(patch=self, msgid=self.msgid)
@@ -342,6 +502,32 @@ class Patch(models.Model):
         except Exception:
             return None
 
+    def _series_id(self):
+        # looked up by set_series_ids() for the current save only, the
+        # patch may be moved to another series later
+        if '_known_series_id' in self.__dict__:
+            return self._known_series_id
+        return SeriesRevisionPatch.objects.filter(patch=self) \
+                                          .values_list('revision__series_id',
+                                                       flat=True).first()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        patch = super(Patch, cls).from_db(db, field_names, values)
+        patch._remember_state()
+        return patch
+
+    def refresh_from_db(self, *args, **kwargs):
+        super(Patch, self).refresh_from_db(*args, **kwargs)
+        self._remember_state()
+
+    def _remember_state(self):
+        # the state and name the patch has in the database, None if we don't
+        # know (eg. they weren't loaded)
+        self._orig_state = None
+        if 'state_id' in self.__dict__ and 'name' in self.__dict__:
+            self._orig_state = (self.state_id, self.name)
+
     def _set_tag(self, tag, count):
         if count == 0:
             self.patchtag_set.filter(tag=tag).delete()
@@ -352,14 +538,61 @@ class Patch(models.Model):
             patchtag.save()
 
     def refresh_tag_counts(self):
-        tags = self.project.tags
+        """Recount the tags of all the comments of this patch"""
+        # the recount includes the differences not applied yet
+        deferred.discard(('tag_counts', self.pk))
+        matcher = self.project.tag_matcher
         counter = Counter()
-        for comment in self.comment_set.all():
-            counter = counter + extract_tags(comment.content, tags)
+        for content in self.comment_set.values_list('content', flat=True):
+            counter.update(matcher.count(content))
 
-        for tag in tags:
+        for tag in matcher.tags:
             self._set_tag(tag, counter[tag])
 
+    def _add_to_tag(self, tag, delta):
+        if delta == 0:
+            return
+
+        tags = PatchTag.objects.filter(patch=self, tag=tag)
+        if tags.update(count=F('count') + delta):
+            if delta < 0:
+                tags.filter(count__lte=0).delete()
+            return
+
+        if delta < 0:
+            return
+
+        try:
+            with transaction.atomic():
+                PatchTag.objects.create(patch=self, tag=tag, count=delta)
+        except IntegrityError:
+            # someone else created it in the meantime
+            tags.update(count=F('count') + delta)
+
+    def _add_to_tags(self, counter):
+        for tag in self.project.tag_matcher.tags:
+            self._add_to_tag(tag, counter[tag])
+
+    def update_tag_counts(self, old_content=None, new_content=None):
+        """Update the tag counts when a comment of this patch changes from
+           old_content to new_content, None meaning the comment didn't exist
+           before or doesn't exist anymore. Only the difference between the
+           two is applied, with atomic updates. When deferring work, the
+           differences are summed up and applied once."""
+        matcher = self.project.tag_matcher
+        counter = Counter()
+        if new_content:
+            counter.update(matcher.count(new_content))
+        if old_content:
+            counter.subtract(matcher.count(old_content))
+
+        key = ('tag_counts', self.pk)
+        args = deferred.pending(key)
+        if args is not None:
+            args[0].update(counter)
+            return
+        deferred.defer(key, self._add_to_tags, counter)
+
     def save(self):
         if not hasattr(self, 'state') or not self.state:
             self.state = get_default_initial_patch_state()
@@ -368,6 +601,7 @@ class Patch(models.Model):
             self.hash = hash_patch(self.content).hexdigest()
 
         super(Patch, self).save()
+        self._remember_state()
 
     def filename(self):
         return filename(self.name, '.patch')
@@ -404,19 +638,99 @@ class Comment(models.Model):
         return ''.join([match.group(0) + '\n' for match in
                         self.response_re.finditer(self.content)])
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        comment = super(Comment, cls).from_db(db, field_names, values)
+        comment._remember_tag_state()
+        return comment
+
+    def _remember_tag_state(self):
+        # what the tag counts of the patch currently account for, None if we
+        # don't know (eg. content wasn't loaded)
+        self._tag_state = None
+        if 'content' in self.__dict__ and 'patch_id' in self.__dict__:
+            self._tag_state = (self.patch_id, self.content)
+
+    def _update_tag_counts(self, created=False, deleted=False):
+        state = getattr(self, '_tag_state', None)
+        new_content = None if deleted else self.content
+
+        if created:
+            self.patch.update_tag_counts(None, new_content)
+        elif state is None:
+            self.patch.refresh_tag_counts()
+        elif state[0] == self.patch_id:
+            self.patch.update_tag_counts(state[1], new_content)
+        else:
+            # the comment moved to another patch
+            Patch.objects.get(pk=state[0]).update_tag_counts(state[1], None)
+            self.patch.update_tag_counts(None, new_content)
+
+    def _update_search_index(self, created=False):
+        state = getattr(self, '_tag_state', None)
+        if created:
+            _defer_search_index_update(self.patch_id, self.content)
+        elif state != (self.patch_id, self.content):
+            if state is not None and state[0] != self.patch_id:
+                _defer_search_index_update(state[0])
+            _defer_search_index_update(self.patch_id)
+
     def save(self, *args, **kwargs):
+        created = self._state.adding and self.pk is None
         super(Comment, self).save(*args, **kwargs)
-        self.patch.refresh_tag_counts()
+        self._update_tag_counts(created=created)
+        self._update_search_index(created=created)
+        self._remember_tag_state()
 
     def delete(self, *args, **kwargs):
         super(Comment, self).delete(*args, **kwargs)
-        self.patch.refresh_tag_counts()
+        self._update_tag_counts(deleted=True)
+        _defer_search_index_update(self.patch_id)
 
     class Meta:
         ordering = ['date']
         unique_together = [('msgid', 'patch')]
 
 
+def search_documents(patch_pks):
+    """The search.documents() indexing the patches"""
+    return search.documents(Patch.objects.filter(pk__in=patch_pks),
+                            Comment.objects.filter(patch__in=patch_pks))
+
+
+def _update_search_index(patch_pk, contents=None):
+    if contents is not None:
+        if not search.append([(patch_pk, '\n'.join(contents))]):
+            return
+    search.index(search_documents([patch_pk]))
+
+
+def _defer_search_index_update(patch_pk, content=None):
+    """Update the search index of the patch: add the content of a new comment
+       to its document, like for the tag counts, or index it again if content
+       is None. When deferring work, the contents of the new comments are
+       added at once."""
+    key = ('search_index', patch_pk)
+    args = deferred.pending(key)
+    if content is not None and args is not None:
+        # the patch is already indexed again when args[1] is None
+        if args[1] is not None:
+            args[1].append(content)
+        return
+    contents = [content] if content is not None else None
+    deferred.defer(key, _update_search_index, patch_pk, contents)
+
+
+class ThreadIndex(models.Model):
+    """Position of a patch or comment mail in its thread, so parsemail can
+       find the ancestors of a new mail without walking up the thread"""
+    msgid = models.CharField(max_length=255, unique=True)
+    parent_msgid = models.CharField(max_length=255, null=True, blank=True)
+    root_msgid = models.CharField(max_length=255, db_index=True)
+    # msgids of the known ancestors, from the parent up to the root
+    references = jsonfield.JSONField(default=list)
+
+
 class Bundle(models.Model):
     owner = models.ForeignKey(User, on_delete=models.CASCADE)
     project = models.ForeignKey(Project, on_delete=models.CASCADE)
@@ -509,6 +823,8 @@ class TestState:
 class Series(models.Model):
     project = models.ForeignKey(Project, on_delete=models.CASCADE)
     name = models.CharField(max_length=200, default=SERIES_DEFAULT_NAME)
+    # lowercase name, to look up the previous versions of a series
+    name_lower = models.CharField(max_length=200, default='', editable=False)
     submitter = models.ForeignKey(Person, related_name='submitters',
                                   on_delete=models.CASCADE)
     reviewer = models.ForeignKey(User, related_name='reviewers', null=True,
@@ -564,6 +880,14 @@ class Series(models.Model):
     class Meta:
         verbose_name_plural = 'Series'
         ordering = ["-id"]
+        index_together = [('project', 'name_lower')]
+
+
+def _series_pre_save_callback(sender, instance, **kwargs):
+    instance.name_lower = instance.name.lower()[:200]
+
+
+models.signals.pre_save.connect(_series_pre_save_callback, sender=Series)
 
 
 # Signal one can listen to to know when a revision is complete (ie. has all of
@@ -633,6 +957,22 @@ class SeriesRevision(models.Model):
         if self.patches_count == self.n_patches:
             series_revision_complete.send(sender=self.__class__, revision=self)
 
+    def add_patches(self, patches):
+        """Add the (patch, order) pairs of patches at once, with a single
+           insert and a single update of the revision state"""
+        links = [SeriesRevisionPatch(revision=self, patch=patch, order=order)
+                 for (patch, order) in patches]
+        if not links:
+            return
+
+        before = self.patches_count
+        # bulk_create() doesn't send post_save for each link
+        SeriesRevisionPatch.objects.bulk_create(links)
+        _defer_revision_update_state(self)
+
+        if before < self.n_patches <= before + len(links):
+            series_revision_complete.send(sender=self.__class__, revision=self)
+
     @property
     def patches_count(self):
         return self.patches.count()
@@ -677,12 +1017,10 @@ class SeriesRevision(models.Model):
            exclude_patch (a list of 'order's) can be used to exclude
            patches from the operation"""
         new = self.duplicate_meta()
-        order = 0
-        for p in self.ordered_patches():
-            order += 1
-            if order in exclude_patches:
-                continue
-            new.add_patch(p, order)
+        patches = self.ordered_patches().only('pk')
+        new.add_patches((patch, order)
+                        for (order, patch) in enumerate(patches, 1)
+                        if order not in exclude_patches)
         return new
 
     def refresh_test_state(self):
@@ -719,6 +1057,24 @@ class SeriesRevisionPatch(models.Model):
 class Event(models.Model):
     name = models.CharField(max_length=20)
 
+    @classmethod
+    def from_string(cls, name):
+        for event in _registered(Event):
+            if event.name == name:
+                return event
+        raise Event.DoesNotExist("no event '%s'" % name)
+
+
+models.signals.post_save.connect(_registry_invalidate_callback, sender=State)
+models.signals.post_delete.connect(_registry_invalidate_callback,
+                                   sender=State)
+models.signals.post_save.connect(_registry_invalidate_callback, sender=Event)
+models.signals.post_delete.connect(_registry_invalidate_callback,
+                                   sender=Event)
+models.signals.post_save.connect(_registry_invalidate_callback, sender=Tag)
+models.signals.post_delete.connect(_registry_invalidate_callback,
+                                   sender=Tag)
+
 
 class EventLog(models.Model):
     event = models.ForeignKey(Event, on_delete=models.CASCADE)
@@ -857,42 +1213,42 @@ class PatchChangeNotification(models.Model):
     orig_state = models.ForeignKey(State, on_delete=models.CASCADE)
 
 
-def _patch_change_log_event(old_patch, new_patch):
+def _patch_change_log_event(patch, old_state):
     # If state changed, log the event
-    event_state_change = Event.objects.get(name='patch-state-change')
+    event_state_change = Event.from_string('patch-state-change')
     curr_user = threadlocalrequest.get_current_user()
-    previous_state = str(old_patch.state)
-    new_state = str(new_patch.state)
+    previous_state = str(old_state)
+    new_state = str(patch.state)
 
     # Do not log patch-state-change events for Patches that are not part of a
     # Series (ie patches older than the introduction of Series)
-    series = old_patch.series()
-    if series:
+    series_id = patch._series_id()
+    if series_id:
         log = EventLog(event=event_state_change,
                        user=curr_user,
-                       series_id=series.id,
-                       patch=old_patch,
+                       series_id=series_id,
+                       patch=patch,
                        parameters={'previous_state': previous_state,
                                    'new_state': new_state,
                                   })
         log.save()
 
 
-def _patch_change_send_notification(old_patch, new_patch):
-    if not new_patch.project.send_notifications:
+def _patch_change_send_notification(patch, old_state):
+    if not patch.project.send_notifications:
         return
 
     notification = None
     try:
-        notification = PatchChangeNotification.objects.get(patch=new_patch)
+        notification = PatchChangeNotification.objects.get(patch=patch)
     except PatchChangeNotification.DoesNotExist:
         pass
 
     if notification is None:
-        notification = PatchChangeNotification(patch=new_patch,
-                                               orig_state=old_patch.state)
+        notification = PatchChangeNotification(patch=patch,
+                                               orig_state=old_state)
 
-    elif notification.orig_state == new_patch.state:
+    elif notification.orig_state_id == patch.state_id:
         # If we're back at the original state, there is no need to notify
         notification.delete()
         return
@@ -908,6 +1264,7 @@ def _revision_is_done(revision, summary):
     return True
 
 
+@ingeststats.timed('revision_update_state')
 def _revision_update_state(revision):
     # the order_by() clears the default ordering (from the Meta class) which
     # would be used in the GROUP BY clause otherwise. See:
@@ -943,7 +1300,35 @@ def _revision_update_state(revision):
     else:
         revision.state = RevisionState.IN_PROGRESS
 
-    revision.save()
+    revision.save(update_fields=['state', 'state_summary'])
+
+
+def refresh_revision_state(revision_pk):
+    """Update the state of the revision revision_pk, if it still exists"""
+    try:
+        revision = SeriesRevision.objects.get(pk=revision_pk)
+    except SeriesRevision.DoesNotExist:
+        return
+    _revision_update_state(revision)
+
+
+def _queue_revision_update_state(revision_pk):
+    # importing Celery is only worth it when REVISION_STATE_ASYNC is set
+    from patchwork.celery import app as celery_app
+
+    # the worker has to see the changes made by the current transaction
+    transaction.on_commit(lambda: celery_app.send_task(
+        'update_revision_state', (revision_pk,)))
+
+
+def _defer_revision_update_state(revision):
+    # the state of a revision is only updated once per request, mail parsed
+    # or management command, see patchwork.deferred
+    key = ('revision_state', revision.pk)
+    if settings.REVISION_STATE_ASYNC:
+        deferred.defer(key, _queue_revision_update_state, revision.pk)
+    else:
+        deferred.defer(key, _revision_update_state, revision)
 
 
 def _patch_change_update_revision_state(new_patch):
@@ -957,7 +1342,7 @@ def _patch_change_update_revision_state(new_patch):
         return
 
     for rev in revisions:
-        _revision_update_state(rev)
+        _defer_revision_update_state(rev)
 
 
 def _patch_pre_change_callback(sender, instance, **kwargs):
@@ -965,24 +1350,35 @@ def _patch_pre_change_callback(sender, instance, **kwargs):
     if instance.pk is None:
         return
 
-    if instance.project is None:
+    if instance.project_id is None:
         return
 
-    try:
-        orig_patch = Patch.objects.get(pk=instance.pk)
-    except Patch.DoesNotExist:
-        return
+    # the state the patch was loaded with, when we know it
+    orig_state = getattr(instance, '_orig_state', None)
+    if orig_state is None:
+        orig_state = Patch.objects.filter(pk=instance.pk) \
+                                  .values_list('state_id', 'name')[:1]
+        if not orig_state:
+            return
+        orig_state = instance._orig_state = orig_state[0]
+    (orig_state_id, _) = orig_state
 
     # If there's no interesting changes, abort without creating the
     # notification or log
-    if orig_patch.state == instance.state:
+    if orig_state_id == instance.state_id:
         return
 
-    _patch_change_log_event(orig_patch, instance)
-    _patch_change_send_notification(orig_patch, instance)
+    old_state = None
+    if orig_state_id is not None:
+        old_state = State.from_pk(orig_state_id)
+    _patch_change_log_event(instance, old_state)
+    _patch_change_send_notification(instance, old_state)
 
 
 def _patch_post_change_callback(sender, instance, created, **kwargs):
+    # see set_series_ids()
+    instance.__dict__.pop('_known_series_id', None)
+
     # We filter out brand new patches because the SeriesRevisionPatch m2m table
     # isn't populated at that point and so we can't query for the
     # SeriesRevision <-> Patch relationship.
@@ -996,14 +1392,25 @@ def _patch_pull_request_log_event(instance, created, **kwargs):
     if not instance.pull_url or not created:
         return
 
-    event_pull_req = Event.objects.get(name='pull-request-new')
+    event_pull_req = Event.from_string('pull-request-new')
     curr_user = threadlocalrequest.get_current_user()
 
     log = EventLog(event=event_pull_req,
                    user=curr_user,
                    patch=instance,
                    parameters={'pull_url': instance.pull_url})
-    log.save()
+    deferred.defer(('pull_request_event', instance.pk), log.save)
+
+
+def _patch_search_index_callback(sender, instance, created, **kwargs):
+    # the index only has to follow the name of existing patches
+    orig_state = getattr(instance, '_orig_state', None)
+    if created or orig_state is None or orig_state[1] != instance.name:
+        _defer_search_index_update(instance.pk)
+
+
+def _patch_delete_search_index_callback(sender, instance, **kwargs):
+    search.remove([instance.pk])
 
 
 def _series_revision_patch_post_change_callback(sender, instance, created,
@@ -1014,12 +1421,15 @@ def _series_revision_patch_post_change_callback(sender, instance, created,
     if not created:
         return
 
-    _revision_update_state(instance.revision)
+    _defer_revision_update_state(instance.revision)
 
 
 models.signals.pre_save.connect(_patch_pre_change_callback, sender=Patch)
 models.signals.post_save.connect(_patch_post_change_callback, sender=Patch)
 models.signals.post_save.connect(_patch_pull_request_log_event, sender=Patch)
+models.signals.post_save.connect(_patch_search_index_callback, sender=Patch)
+models.signals.post_delete.connect(_patch_delete_search_index_callback,
+                                   sender=Patch)
 models.signals.post_save.connect(_series_revision_patch_post_change_callback,
                                  sender=SeriesRevisionPatch)
 
@@ -1032,11 +1442,27 @@ def _on_revision_complete(sender, revision, **kwargs):
     series.save()
 
     # log event
-    new_revision = Event.objects.get(name='series-new-revision')
+    new_revision = Event.from_string('series-new-revision')
     log = EventLog(event=new_revision, series=series,
                    user=series.submitter.user,
                    parameters={'revision': revision.version})
-    log.save()
+    deferred.defer(('revision_complete_event', revision.pk), log.save)
 
 
 series_revision_complete.connect(_on_revision_complete)
+
+
+def _discard_deferred_callback(sender, instance, **kwargs):
+    # the objects the deferred work was about are gone
+    if sender == Patch:
+        deferred.discard(('tag_counts', instance.pk))
+        deferred.discard(('pull_request_event', instance.pk))
+        deferred.discard(('search_index', instance.pk))
+    else:
+        deferred.discard(('revision_state', instance.pk))
+        deferred.discard(('revision_complete_event', instance.pk))
+
+
+models.signals.post_delete.connect(_discard_deferred_callback, sender=Patch)
+models.signals.post_delete.connect(_discard_deferred_callback,
+                                   sender=SeriesRevision)
@@ -19,8 +19,20 @@
 
 from __future__ import absolute_import
 
+import base64
+import datetime
+import hashlib
+import json
+
 from django.conf import settings
 from django.core import paginator
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet, ValidationError
+from django.db import models
+from django.db.models import Q
+from django.utils import six
+from django.utils.dateparse import parse_datetime
+from django.utils.encoding import force_bytes, force_text
 from django.utils.six.moves import range
 
 
@@ -33,35 +45,32 @@ TRAILING_PAGE_RANGE = 2
 NUM_PAGES_OUTSIDE_RANGE = 2
 ADJACENT_PAGES = 1
 
+# how long KeysetPaginator keeps the number of patches of a list, in seconds
+COUNT_CACHE_TIMEOUT = 60
+
 # parts from:
 #  http://blog.localkinegrinds.com/2007/09/06/digg-style-pagination-in-django/
 
 
-class Paginator(paginator.Paginator):
-
-    def __init__(self, request, objects):
+def patches_per_page(request):
+    patches_per_page = settings.DEFAULT_PATCHES_PER_PAGE
 
-        patches_per_page = settings.DEFAULT_PATCHES_PER_PAGE
+    if request.user.is_authenticated():
+        patches_per_page = request.user.profile.patches_per_page
 
-        if request.user.is_authenticated():
-            patches_per_page = request.user.profile.patches_per_page
+    ppp = request.META.get('ppp')
+    if ppp:
+        try:
+            patches_per_page = int(ppp)
+        except ValueError:
+            pass
 
-        ppp = request.META.get('ppp')
-        if ppp:
-            try:
-                patches_per_page = int(ppp)
-            except ValueError:
-                pass
+    return patches_per_page
 
-        super(Paginator, self).__init__(objects, patches_per_page)
 
-        try:
-            page_no = int(request.GET.get('page'))
-            self.current_page = self.page(int(page_no))
-        except Exception:
-            page_no = 1
-            self.current_page = self.page(page_no)
+class PageRangesMixin(object):
 
+    def set_page_ranges(self, page_no):
         self.leading_set = self.trailing_set = []
 
         pages = self.num_pages
@@ -93,3 +102,221 @@ class Paginator(paginator.Paginator):
         self.leading_set.reverse()
         self.long_page = len(
             self.current_page.object_list) >= LONG_PAGE_THRESHOLD
+
+
+class Paginator(PageRangesMixin, paginator.Paginator):
+
+    def __init__(self, request, objects):
+
+        super(Paginator, self).__init__(objects, patches_per_page(request))
+
+        try:
+            page_no = int(request.GET.get('page'))
+            self.current_page = self.page(int(page_no))
+        except Exception:
+            page_no = 1
+            self.current_page = self.page(page_no)
+
+        self.set_page_ranges(page_no)
+
+
+def _encode_cursor(values):
+    values = [['dt', v.isoformat()] if isinstance(v, datetime.datetime)
+              else v for v in values]
+    return force_text(base64.urlsafe_b64encode(
+        force_bytes(json.dumps(values))))
+
+
+def _decode_value(field, value):
+    """The value of a cursor for a key of type field, None if the cursor is
+       invalid. The keys are never NULL."""
+    if isinstance(field, models.DateTimeField):
+        if (not isinstance(value, list) or len(value) != 2 or
+                value[0] != 'dt' or
+                not isinstance(value[1], six.string_types)):
+            return None
+        try:
+            return parse_datetime(value[1])
+        except ValueError:
+            return None
+    if isinstance(field, (models.CharField, models.TextField)):
+        if isinstance(value, six.string_types):
+            return value
+        return None
+    if isinstance(field, (models.IntegerField, models.AutoField)):
+        if (isinstance(value, six.integer_types) and
+                not isinstance(value, bool)):
+            return value
+        return None
+    return None
+
+
+def _decode_cursor(cursor, fields):
+    """The values of the keys of type fields in cursor, None if the cursor
+       is invalid"""
+    try:
+        values = json.loads(force_text(base64.urlsafe_b64decode(
+            force_bytes(cursor))))
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(values, list) or len(values) != len(fields):
+        return None
+    values = [_decode_value(field, value)
+              for (field, value) in zip(fields, values)]
+    if None in values:
+        return None
+    return values
+
+
+class KeysetPage(object):
+
+    def __init__(self, object_list, number, paginator, has_previous,
+                 has_next):
+        self.object_list = object_list
+        self.number = number
+        self.paginator = paginator
+        self._has_previous = has_previous
+        self._has_next = has_next
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self._has_previous or self._has_next
+
+    def next_page_number(self):
+        return self.number + 1
+
+    def previous_page_number(self):
+        return self.number - 1
+
+    def next_cursor(self):
+        if not self._has_next:
+            return None
+        return self.paginator.cursor(self.object_list[-1])
+
+    def previous_cursor(self):
+        if not self._has_previous or not self.object_list:
+            return None
+        return self.paginator.cursor(self.object_list[0])
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+class KeysetPaginator(PageRangesMixin):
+    """Paginate patches sorted with a patchwork.utils.Order by seeking past
+       the last patch of the previous page (or before the first patch of
+       the next one) rather than with an OFFSET, so that browsing deep in a
+       list doesn't get slower. The previous and next page links carry a
+       cursor, the values the patches are sorted on for that patch. The
+       other page links, eg. to the last pages, still use an offset.
+
+       The total number of patches is only used to number the pages: it's
+       cached for COUNT_CACHE_TIMEOUT seconds, and so can be a bit off."""
+
+    def __init__(self, request, objects, order):
+        self.per_page = patches_per_page(request)
+        self.keys = order.keys()
+        self.aliases = ['order_key_%d' % i for i in range(len(self.keys))]
+        counted = objects
+        objects = objects.annotate(**dict(zip(self.aliases,
+                                              [key for (key, _)
+                                               in self.keys])))
+        fields = [objects.query.annotations[alias].output_field
+                  for alias in self.aliases]
+
+        try:
+            page_no = max(int(request.GET.get('page')), 1)
+        except (TypeError, ValueError):
+            page_no = 1
+
+        after = before = None
+        if request.GET.get('after'):
+            after = _decode_cursor(request.GET['after'], fields)
+        elif request.GET.get('before'):
+            before = _decode_cursor(request.GET['before'], fields)
+
+        count = None
+        if after is not None or before is not None:
+            try:
+                rows = list(self._seek(objects, after or before,
+                                       backwards=before is not None)
+                            [:self.per_page + 1])
+            except (ValidationError, TypeError, ValueError):
+                # the cursor comes from the URL, fall back to the offset
+                after = before = None
+
+        if after is not None:
+            has_previous = True
+            has_next = len(rows) > self.per_page
+            page_no = max(page_no, 2)
+        elif before is not None:
+            has_previous = len(rows) > self.per_page
+            has_next = True
+            rows = rows[:self.per_page]
+            rows.reverse()
+            if not has_previous:
+                page_no = 1
+        else:
+            while True:
+                offset = (page_no - 1) * self.per_page
+                rows = list(objects[offset:offset + self.per_page + 1])
+                if rows or page_no == 1:
+                    break
+                # past the end of the list
+                page_no = 1
+            has_previous = page_no > 1
+            has_next = len(rows) > self.per_page
+            if not has_next:
+                count = offset + len(rows)
+
+        rows = rows[:self.per_page]
+        # the cached count may be a bit off, but not to the point of hiding
+        # the patches we've found
+        self.count = max(self._count(counted, count),
+                         (page_no - 1) * self.per_page + len(rows) +
+                         int(has_next))
+        self.num_pages = max(-(-self.count // self.per_page),
+                             page_no + int(has_next))
+        self.current_page = KeysetPage(rows, page_no, self, has_previous,
+                                       has_next)
+        self.set_page_ranges(page_no)
+
+    def cursor(self, obj):
+        return _encode_cursor([getattr(obj, alias)
+                               for alias in self.aliases])
+
+    def _seek(self, objects, values, backwards=False):
+        """The objects sorted after the values of the sort keys, or before
+           them, in reverse order, if backwards"""
+        seek = Q()
+        for (i, (_, descending)) in enumerate(self.keys):
+            lookup = 'lt' if descending != backwards else 'gt'
+            q = Q(**{'%s__%s' % (self.aliases[i], lookup): values[i]})
+            for j in range(i):
+                q &= Q(**{self.aliases[j]: values[j]})
+            seek |= q
+
+        ordering = [('-' if descending != backwards else '') + alias
+                    for (alias, (_, descending))
+                    in zip(self.aliases, self.keys)]
+        return objects.filter(seek).order_by(*ordering)
+
+    def _count(self, objects, count=None):
+        try:
+            key = 'patch-list-count:%s' % hashlib.sha1(
+                force_bytes(str(objects.query))).hexdigest()
+        except EmptyResultSet:
+            return 0
+
+        if count is None:
+            count = cache.get(key)
+            if count is not None:
+                return count
+            count = objects.count()
+        cache.set(key, count, COUNT_CACHE_TIMEOUT)
+        return count
@@ -22,21 +22,189 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
-from collections import Counter
+from collections import Counter, namedtuple, OrderedDict
+import fnmatch
 import hashlib
+import os
 import re
 
+from django.utils.functional import cached_property
 from django.utils.six.moves import map
 
 
 _hunk_re = re.compile(r'^\@\@ -\d+(?:,(\d+))? \+\d+(?:,(\d+))? \@\@')
 _filename_re = re.compile(r'^(---|\+\+\+) (\S+)')
 
+# Result of parse_patch_spans(): 'lines' is the parsed text split on '\n',
+# 'patch' and 'comment' are lists of [start, end) ranges of line numbers in
+# 'lines'.
+PatchSpans = namedtuple('PatchSpans', ['lines', 'patch', 'comment'])
+
+
+def _add_line(spans, n):
+    # merge consecutive lines into a single span
+    if spans and spans[-1][1] == n:
+        spans[-1][1] = n + 1
+    else:
+        spans.append([n, n + 1])
+
+
+def _add_spans(spans, other):
+    for (start, end) in other:
+        if spans and spans[-1][1] == start:
+            spans[-1][1] = end
+        else:
+            spans.append([start, end])
+
+
+def join_spans(lines, spans):
+    """Build the text covered by spans, or None if there's no such text"""
+    if not spans:
+        return None
+    return ''.join(['\n'.join(lines[start:end]) + '\n'
+                    for (start, end) in spans])
+
+
+def _span_lines(lines, spans):
+    return [line for (start, end) in spans for line in lines[start:end]]
+
+
+def _hunk_counts(hunk_match):
+    def fn(x):
+        if not x:
+            return 1
+        return int(x)
+
+    return list(map(fn, hunk_match.groups()))
+
+
+def _strip_p1(filename):
+    # normalise -p1 top-directories
+    return '/'.join(filename.split('/')[1:])
+
+
+def _diff_filename(line):
+    """File name of a ---/+++ diff header line, None for /dev/null"""
+    match = _filename_re.match(line)
+    if not match or match.group(2).startswith('/dev/null'):
+        return None
+    return _strip_p1(match.group(2))
+
+
+def _normalise_lines(lines):
+    """Normalise patch lines as if we were doing
+       '\\n'.join(lines).replace('\\r', '').strip().split('\\n')"""
+    lines = [line.replace('\r', '') for line in lines]
+
+    first = 0
+    while first < len(lines) and not lines[first].strip():
+        first += 1
+    if first == len(lines):
+        return []
+
+    last = len(lines) - 1
+    while not lines[last].strip():
+        last -= 1
+
+    lines = lines[first:last + 1]
+    lines[0] = lines[0].lstrip()
+    lines[-1] = lines[-1].rstrip()
+    return lines
+
+
+def _digest_lines(lines):
+    """Return the hash of the patch made of lines and the sorted list of the
+       files it touches"""
+    normalised = []
+    filenames = set()
+
+    for line in _normalise_lines(lines):
+
+        if len(line) <= 0:
+            continue
+
+        if line[0] in '-+':
+            filename_match = None
+            if line.startswith(('--- ', '+++ ')):
+                filename_match = _filename_re.match(line)
+            if filename_match:
+                filename = _strip_p1(filename_match.group(2))
+                if not filename_match.group(2).startswith('/dev/null'):
+                    filenames.add(filename)
+
+                if filename_match.group(1) == '---':
+                    filename = 'a/' + filename
+                else:
+                    filename = 'b/' + filename
+                line = filename_match.group(1) + ' ' + filename
+
+            # otherwise, we have a + or - line, leave as-is
+
+        elif line[0] == '@':
+            hunk_match = _hunk_re.match(line)
+            if not hunk_match:
+                continue
+            # remove line numbers, but leave line counts
+            line = '@@ -%d +%d @@' % tuple(_hunk_counts(hunk_match))
+
+        elif line[0] != ' ':
+            # other lines are ignored, context lines are left as-is
+            continue
+
+        normalised.append(line)
+
+    hash = hashlib.sha1()
+    if normalised:
+        hash.update(('\n'.join(normalised) + '\n').encode('utf-8'))
+
+    return (hash, sorted(filenames))
 
-def parse_patch(text):
-    patchbuf = ''
-    commentbuf = ''
-    buf = ''
+
+class PatchAnalysis(object):
+    """Result of analyse_patch()"""
+
+    def __init__(self, lines):
+        self.spans = PatchSpans(lines, [], [])
+        # lines added and removed per file, in patch order
+        self.diffstat = OrderedDict()
+
+    @cached_property
+    def patch(self):
+        return join_spans(self.spans.lines, self.spans.patch)
+
+    @cached_property
+    def comment(self):
+        return join_spans(self.spans.lines, self.spans.comment)
+
+    @cached_property
+    def _digest(self):
+        (lines, patch, _) = self.spans
+        return _digest_lines(_span_lines(lines, patch))
+
+    @property
+    def hash(self):
+        """Same as hash_patch(self.patch), None if there's no patch"""
+        if not self.spans.patch:
+            return None
+        return self._digest[0]
+
+    @property
+    def filenames(self):
+        """Same as patch_get_filenames(self.patch)"""
+        return self._digest[1]
+
+
+def analyse_patch(text):
+    """Split text into patch and comment, count the lines added and removed
+       per file and give access to the hash and file names of the patch.
+
+       text is split and scanned once, the hash and file names are then
+       computed from the patch lines found during that scan, only when
+       asked for."""
+    lines = text.split('\n')
+    analysis = PatchAnalysis(lines)
+    (_, patch, comment) = analysis.spans
+    buf = []
 
     # state specified the line we just saw, and what to expect next
     state = 0
@@ -61,33 +229,40 @@ def parse_patch(text):
     #  6 -> 1 (other text)
     #
     # Suspected patch header is stored into buf, and appended to
-    # patchbuf if we find a following hunk. Otherwise, append to
+    # patch if we find a following hunk. Otherwise, append to
     # comment after parsing.
 
     # line counts while parsing a patch hunk
     lc = (0, 0)
     hunk = 0
 
-    for line in text.split('\n'):
-        line += '\n'
+    # file names from the last ---/+++ lines and the diffstat entry of the
+    # file the current hunk applies to
+    old_filename = None
+    new_filename = None
+    stat = None
+
+    for (n, line) in enumerate(lines):
 
         if state == 0:
             if line.startswith('diff ') or line.startswith('===') \
                     or line.startswith('Index: '):
                 state = 1
-                buf += line
+                _add_line(buf, n)
 
             elif line.startswith('--- '):
                 state = 2
-                buf += line
+                old_filename = _diff_filename(line)
+                _add_line(buf, n)
 
             else:
-                commentbuf += line
+                _add_line(comment, n)
 
         elif state == 1:
-            buf += line
+            _add_line(buf, n)
             if line.startswith('--- '):
                 state = 2
+                old_filename = _diff_filename(line)
 
             if line.startswith(('rename from ', 'rename to ')):
                 state = 6
@@ -95,56 +270,65 @@ def parse_patch(text):
         elif state == 2:
             if line.startswith('+++ '):
                 state = 3
-                buf += line
+                new_filename = _diff_filename(line)
+                _add_line(buf, n)
 
             elif hunk:
                 state = 1
-                buf += line
+                _add_line(buf, n)
 
             else:
                 state = 0
-                commentbuf += buf + line
-                buf = ''
+                _add_spans(comment, buf)
+                _add_line(comment, n)
+                buf = []
 
         elif state == 3:
             match = _hunk_re.match(line)
             if match:
-
-                def fn(x):
-                    if not x:
-                        return 1
-                    return int(x)
-
-                lc = list(map(fn, match.groups()))
+                lc = _hunk_counts(match)
 
                 state = 4
-                patchbuf += buf + line
-                buf = ''
+                _add_spans(patch, buf)
+                _add_line(patch, n)
+                buf = []
+
+                filename = new_filename or old_filename
+                stat = None
+                if filename is not None:
+                    stat = analysis.diffstat.setdefault(filename, [0, 0])
 
             elif line.startswith('--- '):
-                patchbuf += buf + line
-                buf = ''
+                _add_spans(patch, buf)
+                _add_line(patch, n)
+                buf = []
                 state = 2
+                old_filename = _diff_filename(line)
 
             elif hunk and line.startswith('\\ No newline at end of file'):
                 # If we had a hunk and now we see this, it's part of the patch,
                 # and we're still expecting another @@ line.
-                patchbuf += line
+                _add_line(patch, n)
 
             elif hunk:
                 state = 1
-                buf += line
+                _add_line(buf, n)
 
             else:
                 state = 0
-                commentbuf += buf + line
-                buf = ''
+                _add_spans(comment, buf)
+                _add_line(comment, n)
+                buf = []
 
         elif state == 4 or state == 5:
             if line.startswith('-'):
                 lc[0] -= 1
+                if stat is not None:
+                    stat[1] += 1
             elif line.startswith('+'):
                 lc[1] -= 1
+                if stat is not None:
+                    stat[0] += 1
             elif line.startswith('\\ No newline at end of file'):
                 # Special case: Not included as part of the hunk's line count
                 pass
@@ -152,7 +336,7 @@ def parse_patch(text):
                 lc[0] -= 1
                 lc[1] -= 1
 
-            patchbuf += line
+            _add_line(patch, n)
 
             if lc[0] <= 0 and lc[1] <= 0:
                 state = 3
@@ -162,116 +346,171 @@ def parse_patch(text):
 
         elif state == 6:
             if line.startswith(('rename to ', 'rename from ')):
-                patchbuf += buf + line
-                buf = ''
+                _add_spans(patch, buf)
+                _add_line(patch, n)
+                buf = []
 
             elif line.startswith('--- '):
-                patchbuf += buf + line
-                buf = ''
+                _add_spans(patch, buf)
+                _add_line(patch, n)
+                buf = []
                 state = 2
+                old_filename = _diff_filename(line)
 
             else:
-                buf += line
+                _add_line(buf, n)
                 state = 1
 
         else:
             raise Exception("Unknown state %d! (line '%s')" % (state, line))
 
-    commentbuf += buf
+    _add_spans(comment, buf)
 
-    if patchbuf == '':
-        patchbuf = None
+    return analysis
 
-    if commentbuf == '':
-        commentbuf = None
 
-    return (patchbuf, commentbuf)
+def parse_patch_spans(text):
+    """Split text into patch and comment without building any new string.
 
+       The text is only split into lines and the result is given as spans of
+       those lines, see PatchSpans."""
+    return analyse_patch(text).spans
 
-def hash_patch(str):
-    # normalise spaces
-    str = str.replace('\r', '')
-    str = str.strip() + '\n'
 
-    prefixes = ['-', '+', ' ']
-    hash = hashlib.sha1()
+def parse_patch(text):
+    analysis = analyse_patch(text)
+    return (analysis.patch, analysis.comment)
 
-    for line in str.split('\n'):
 
-        if len(line) <= 0:
-            continue
+def hash_patch_spans(lines, spans):
+    return _digest_lines(_span_lines(lines, spans))[0]
 
-        hunk_match = _hunk_re.match(line)
-        filename_match = _filename_re.match(line)
 
-        if filename_match:
-            # normalise -p1 top-directories
-            if filename_match.group(1) == '---':
-                filename = 'a/'
-            else:
-                filename = 'b/'
-            filename += '/'.join(filename_match.group(2).split('/')[1:])
+def hash_patch(str):
+    return _digest_lines(str.split('\n'))[0]
 
-            line = filename_match.group(1) + ' ' + filename
 
-        elif hunk_match:
-            # remove line numbers, but leave line counts
-            def fn(x):
-                if not x:
-                    return 1
-                return int(x)
-            line_nos = list(map(fn, hunk_match.groups()))
-            line = '@@ -%d +%d @@' % tuple(line_nos)
+# tag patterns that can't be merged with others: backreferences and global
+# inline flags would apply to (or refer to groups of) the other patterns
+_unmergeable_tag_re = re.compile(r'\\[1-9]|\(\?P=|\(\?[aiLmsux]+\)')
 
-        elif line[0] in prefixes:
-            # if we have a +, - or context line, leave as-is
-            pass
 
-        else:
-            # other lines are ignored
-            continue
+class TagMatcher(object):
+    """Count the occurrences of a list of tags in a text.
 
-        hash.update((line + '\n').encode('utf-8'))
+       The tag patterns are merged into a single regex, one named group per
+       tag, so the text is scanned once whatever the number of tags. A piece
+       of text matching several patterns is counted for the first of those
+       tags only. If the patterns can't be merged, each tag is searched for
+       separately."""
 
-    return hash
+    flags = re.MULTILINE | re.IGNORECASE
 
+    def __init__(self, tags):
+        self.tags = list(tags)
+        self._regex = None
+        self._regexes = None
 
-def extract_tags(content, tags):
-    counts = Counter()
+        patterns = [tag.pattern for tag in self.tags]
+        if not any(_unmergeable_tag_re.search(p) for p in patterns):
+            try:
+                self._regex = re.compile(
+                    '|'.join(['(?P<_tag%d>%s)' % (i, pattern)
+                              for (i, pattern) in enumerate(patterns)]),
+                    self.flags)
+            except re.error:
+                pass
 
-    for tag in tags:
-        regex = re.compile(tag.pattern, re.MULTILINE | re.IGNORECASE)
-        counts[tag] = len(regex.findall(content))
+        if self._regex is None:
+            self._regexes = [re.compile(p, self.flags) for p in patterns]
+        else:
+            # lastindex is the group of the outermost alternative
+            self._group_tags = dict(
+                (self._regex.groupindex['_tag%d' % i], tag)
+                for (i, tag) in enumerate(self.tags))
 
-    return counts
+    def count(self, content):
+        """Return a Counter of the number of matches of each tag"""
+        counts = Counter(dict((tag, 0) for tag in self.tags))
 
+        if not self.tags:
+            return counts
 
-def patch_get_filenames(str):
-    # normalise spaces
-    str = str.replace('\r', '')
-    str = str.strip() + '\n'
+        if self._regex is None:
+            for (tag, regex) in zip(self.tags, self._regexes):
+                counts[tag] = len(regex.findall(content))
+            return counts
 
-    filenames = {}
+        for match in self._regex.finditer(content):
+            counts[self._group_tags[match.lastindex]] += 1
 
-    for line in str.split('\n'):
+        return counts
 
-        if len(line) <= 0:
-            continue
 
-        filename_match = _filename_re.match(line)
-        if not filename_match:
-            continue
+def extract_tags(content, tags):
+    return TagMatcher(tags).count(content)
+
+
+def _fnmatch_regex(pattern):
+    regex = fnmatch.translate(os.path.normcase(pattern))
+    # before python 3.6, translate() appends the flags to the regex
+    if regex.endswith('(?ms)'):
+        regex = regex[:-len('(?ms)')]
+    return regex
+
+
+class DelegationMatcher(object):
+    """Find the delegate of a file from a list of (path, delegate) rules,
+       the first rule whose fnmatch path matches the file wins.
+
+       The paths are merged into regexes of up to chunk_size alternatives,
+       one named group per rule, so a file is matched against a whole chunk
+       of rules at once. The regex engine tries the alternatives in order,
+       which keeps the priority of the rules."""
+
+    # the sre of python 2 counts group 0 in its limit of 100 groups, and
+    # raises an AssertionError above it
+    chunk_size = 99
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self._regexes = []
+
+        for start in range(0, len(self.rules), self.chunk_size):
+            chunk = list(enumerate(self.rules[start:start + self.chunk_size],
+                                   start))
+            try:
+                self._regexes.append(self._compile(chunk))
+            except (re.error, AssertionError):
+                # fall back to one regex per rule
+                self._regexes.extend(self._compile([rule]) for rule in chunk)
+
+    def _compile(self, chunk):
+        regex = re.compile(
+            '|'.join(['(?P<_rule%d>%s)' % (i, _fnmatch_regex(path))
+                      for (i, (path, _)) in chunk]),
+            re.DOTALL)
+        # lastindex is the group of the outermost alternative
+        delegates = dict((regex.groupindex['_rule%d' % i], delegate)
+                         for (i, (_, delegate)) in chunk)
+        return (regex, delegates)
+
+    def delegate(self, filename):
+        """Return the delegate of filename, None if no rule matches"""
+        filename = os.path.normcase(filename)
+        for (regex, delegates) in self._regexes:
+            match = regex.match(filename)
+            if match:
+                return delegates[match.lastindex]
+        return None
 
-        filename = filename_match.group(2)
-        if filename.startswith('/dev/null'):
-            continue
 
-        filename = '/'.join(filename.split('/')[1:])
-        filenames[filename] = True
+def spans_get_filenames(lines, spans):
+    return _digest_lines(_span_lines(lines, spans))[1]
 
-    filenames = sorted(filenames.keys())
 
-    return filenames
+def patch_get_filenames(str):
+    return _digest_lines(str.split('\n'))[1]
 
 
 def main(args):
@@ -286,16 +525,21 @@ def main(args):
                       dest='print_hash', help='print patch hash')
     parser.add_option('-f', '--filenames', action='store_true',
                       dest='print_filenames', help='print file names')
+    parser.add_option('-s', '--diffstat', action='store_true',
+                      dest='print_diffstat',
+                      help='print lines added/removed per file')
 
     (options, args) = parser.parse_args()
 
     # decode from (assumed) UTF-8
     content = sys.stdin.read().decode('utf-8')
 
-    (patch, comment) = parse_patch(content)
+    analysis = analyse_patch(content)
+    patch = analysis.patch
+    comment = analysis.comment
 
     if options.print_hash and patch:
-        print(hash_patch(patch).hexdigest())
+        print(analysis.hash.hexdigest())
 
     if options.print_patch and patch:
         print("Patch: ------\n" + patch)
@@ -307,6 +551,11 @@ def main(args):
         filenames = patch_get_filenames(content)
         print("File names: ----\n" + '\n'.join(filenames))
 
+    if options.print_diffstat:
+        print("Diffstat: -----")
+        for (filename, (added, removed)) in analysis.diffstat.items():
+            print("%s +%d -%d" % (filename, added, removed))
+
 
 if __name__ == '__main__':
     import sys
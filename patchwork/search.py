@@ -0,0 +1,238 @@
+# Patchwork - automated patch tracking system
+# Copyright (C) 2018 Intel Corporation
+#
+# This file is part of the Patchwork package.
+#
+# Patchwork is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Patchwork is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Patchwork; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Full-text search over the patches.
+
+Each patch is indexed as a document made of its name and the content of its
+comments, the commit message being the comment with the msgid of the patch.
+The index is kept in the patchwork_patchsearch table, whose layout depends
+on the backend: an FTS5 table with SQLite, a tsvector column with a GIN
+index with PostgreSQL. The other databases get a backend without index,
+searching with LIKE.
+
+The backend is picked from the database vendor, unless SEARCH_BACKEND is
+the dotted path of a SearchBackend subclass."""
+
+import re
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+from django.utils.module_loading import import_string
+
+TABLE = 'patchwork_patchsearch'
+
+
+class RawSubquery(RawSQL):
+    """A raw SELECT for the right hand side of __in lookups, which already
+       put it in parentheses"""
+
+    def as_sql(self, compiler, connection):
+        return (self.sql, self.params)
+
+
+class SearchBackend(object):
+    """Search without an index, matching the words of the query in the name
+       of the patches and in the content of their comments"""
+
+    def create_sql(self):
+        """The statements creating the index"""
+        return []
+
+    def drop_sql(self):
+        """The statements dropping the index"""
+        return []
+
+    def index(self, documents):
+        """Index (patch pk, name, text) documents, replacing the previous
+           documents of these patches"""
+        pass
+
+    def append(self, documents):
+        """Add the (patch pk, text) documents to the documents of these
+           patches, returning the pks of the patches that aren't indexed"""
+        return []
+
+    def remove(self, patch_pks):
+        """Remove the documents of the patches from the index"""
+        pass
+
+    def matching(self, query):
+        """What the pks of the patches matching the query are in, for a
+           pk__in lookup"""
+        Patch = apps.get_model('patchwork', 'Patch')
+        Comment = apps.get_model('patchwork', 'Comment')
+        patches = Patch.objects.all()
+        for word in query.split():
+            comments = Comment.objects.filter(content__icontains=word)
+            patches = patches.filter(
+                Q(name__icontains=word) |
+                Q(pk__in=comments.values('patch_id')))
+        return patches.values('pk')
+
+    def _execute(self, sql, params_list):
+        with connection.cursor() as cursor:
+            cursor.executemany(sql, params_list)
+
+    def _update(self, sql, documents):
+        missing = []
+        with connection.cursor() as cursor:
+            for (pk, text) in documents:
+                cursor.execute(sql, (text, pk))
+                if cursor.rowcount == 0:
+                    missing.append(pk)
+        return missing
+
+
+class SqliteSearchBackend(SearchBackend):
+    """Search an FTS5 table, whose rowid is the pk of the patch"""
+
+    def create_sql(self):
+        return ['CREATE VIRTUAL TABLE %s USING fts5(name, text)' % TABLE]
+
+    def drop_sql(self):
+        return ['DROP TABLE IF EXISTS %s' % TABLE]
+
+    def index(self, documents):
+        self.remove([pk for (pk, _, _) in documents])
+        self._execute('INSERT INTO %s (rowid, name, text) '
+                      'VALUES (%%s, %%s, %%s)' % TABLE, documents)
+
+    def append(self, documents):
+        return self._update("UPDATE %s SET text = text || char(10) || %%s "
+                            "WHERE rowid = %%s" % TABLE, documents)
+
+    def remove(self, patch_pks):
+        self._execute('DELETE FROM %s WHERE rowid = %%s' % TABLE,
+                      [(pk,) for pk in patch_pks])
+
+    def matching(self, query):
+        # each word of the query is a phrase, so that punctuation isn't
+        # taken for the FTS5 query syntax: "drm/i915" matches "drm" followed
+        # by "i915". Its last token is a prefix, like with LIKE "i91" matches
+        # "i915".
+        phrases = ['"%s"*' % word.replace('"', '""')
+                   for word in query.split() if re.search(r'\w', word, re.U)]
+        if not phrases:
+            return []
+        return RawSubquery('SELECT rowid FROM %s WHERE %s MATCH %%s' %
+                           (TABLE, TABLE), (' '.join(phrases),))
+
+
+class PostgresSearchBackend(SearchBackend):
+    """Search a tsvector column with a GIN index"""
+
+    config = 'english'
+
+    def create_sql(self):
+        return ['CREATE TABLE %s (patch_id integer PRIMARY KEY, '
+                'document tsvector NOT NULL)' % TABLE,
+                'CREATE INDEX %s_document ON %s USING GIN (document)' %
+                (TABLE, TABLE)]
+
+    def drop_sql(self):
+        return ['DROP TABLE IF EXISTS %s' % TABLE]
+
+    def index(self, documents):
+        self.remove([pk for (pk, _, _) in documents])
+        self._execute(
+            "INSERT INTO %s (patch_id, document) VALUES (%%s, "
+            "setweight(to_tsvector('%s', %%s), 'A') || "
+            "to_tsvector('%s', %%s))" % (TABLE, self.config, self.config),
+            documents)
+
+    def append(self, documents):
+        return self._update("UPDATE %s SET document = document || "
+                            "to_tsvector('%s', %%s) WHERE patch_id = %%s" %
+                            (TABLE, self.config), documents)
+
+    def remove(self, patch_pks):
+        self._execute('DELETE FROM %s WHERE patch_id = %%s' % TABLE,
+                      [(pk,) for pk in patch_pks])
+
+    def matching(self, query):
+        # all the words of the query, as prefixes
+        words = re.findall(r'\w+', query, re.U)
+        if not words:
+            return []
+        return RawSubquery("SELECT patch_id FROM %s WHERE "
+                           "document @@ to_tsquery('%s', %%s)" %
+                           (TABLE, self.config),
+                           (' & '.join('%s:*' % word for word in words),))
+
+
+vendor_backends = {
+    'sqlite': SqliteSearchBackend,
+    'postgresql': PostgresSearchBackend,
+}
+
+_backends = {}
+
+
+def get_backend(vendor=None):
+    """The search backend for the database vendor, the one of the default
+       database if None"""
+    if vendor is None:
+        vendor = connection.vendor
+
+    backend = _backends.get(vendor)
+    if backend is None:
+        cls = getattr(settings, 'SEARCH_BACKEND', None)
+        if cls is None:
+            cls = vendor_backends.get(vendor, SearchBackend)
+        else:
+            cls = import_string(cls)
+        backend = _backends[vendor] = cls()
+    return backend
+
+
+def documents(patches, comments):
+    """The (pk, name, text) documents indexing the patches for search, the
+       text being the content of their comments, from querysets of the
+       patches and of their comments"""
+    texts = {}
+    comments = comments.order_by('date', 'pk').values_list('patch_id',
+                                                           'content')
+    for (patch_pk, content) in comments:
+        texts.setdefault(patch_pk, []).append(content)
+
+    return [(pk, name, '\n'.join(texts.get(pk, [])))
+            for (pk, name) in patches.values_list('pk', 'name')]
+
+
+def index(documents):
+    if documents:
+        get_backend().index(documents)
+
+
+def append(documents):
+    if not documents:
+        return []
+    return get_backend().append(documents)
+
+
+def remove(patch_pks):
+    if patch_pks:
+        get_backend().remove(patch_pks)
+
+
+def matching(query):
+    return get_backend().matching(query)
@@ -42,6 +42,9 @@ MIDDLEWARE_CLASSES = [
 MIDDLEWARE_CLASSES.append(
     'django.contrib.admindocs.middleware.XViewMiddleware')
 
+# calls the views, must stay last
+MIDDLEWARE_CLASSES.append('patchwork.middleware.DeferredWorkMiddleware')
+
 # Globalization
 
 TIME_ZONE = 'Australia/Canberra'
@@ -148,6 +151,44 @@ CONFIRMATION_VALIDITY_DAYS = 7
 NOTIFICATION_DELAY_MINUTES = 10
 NOTIFICATION_FROM_EMAIL = DEFAULT_FROM_EMAIL
 
+# Scope of the lock serialising the parsing of incoming mails: 'global'
+# parses a single mail at a time, 'project' lets mails for different
+# projects be parsed concurrently
+PARSEMAIL_LOCK_SCOPE = 'project'
+
+# Set to True to log how long each stage of parsing a mail takes, and how
+# many database queries it makes
+PARSEMAIL_STATS = False
+
+# The configuration edited through the web interface (projects, delegation
+# rules, tags, states, events) and the people are cached by the processes
+# that use them. Changes made by another process are seen after at most
+# CONFIG_CACHE_TIMEOUT seconds.
+CONFIG_CACHE_TIMEOUT = 60
+
+# Number of people a long running mail parser (parsemail_server, importmail)
+# keeps in memory to find the author of mails without querying the database
+PARSEMAIL_PERSON_CACHE_SIZE = 10000
+
+# Mails larger than PARSEMAIL_MAX_MAIL_SIZE bytes are dropped, and the text
+# parts larger than PARSEMAIL_MAX_PART_SIZE bytes are ignored when looking
+# for patches and comments. 0 means no limit.
+PARSEMAIL_MAX_MAIL_SIZE = 64 * 1024 * 1024
+PARSEMAIL_MAX_PART_SIZE = 16 * 1024 * 1024
+
+# Directory where 'parsemail.sh --spool' and 'parsemail_server --spool'
+# store incoming mails, until they are parsed by the Celery workers
+PARSEMAIL_SPOOL_DIR = None
+
+# Set to True to have the Celery workers update the state of the revisions
+# whose patches changed, instead of the process making the change
+REVISION_STATE_ASYNC = False
+
+# Dotted path of the patchwork.search.SearchBackend subclass indexing the
+# patches for search. None picks one for the database: an FTS5 table with
+# SQLite, a tsvector column with PostgreSQL, no index with the others.
+SEARCH_BACKEND = None
+
 # Set to True to enable the Patchwork XML-RPC interface
 ENABLE_XMLRPC = False
 
@@ -0,0 +1,253 @@
+# Patchwork - automated patch tracking system
+# Copyright (C) 2018 Intel Corporation
+#
+# This file is part of the Patchwork package.
+#
+# Patchwork is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Patchwork is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Patchwork; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Durable spool of incoming mails, parsed asynchronously.
+
+Accepting a mail only writes it to the spool directory, the way a maildir
+delivery does: the mail is written and synced in tmp/ then renamed to new/.
+It is then parsed by a Celery worker (see patchwork.tasks).
+
+The mails of a thread have to be parsed in the order they were received
+(a patch before its replies, the patches of a series in order), so each
+spooled mail is tagged with a key derived from the root msgid of its
+thread. A worker processes all the pending mails of a thread, oldest first,
+holding a lock for that thread. While a mail is being parsed it sits in
+cur/; mails that failed to parse are moved to failed/, along with a
+.error file holding the traceback, until they are retried."""
+
+from email.parser import HeaderParser
+import errno
+import hashlib
+import itertools
+import logging
+import os
+import time
+import traceback
+
+from django.conf import settings
+from django.db import reset_queries
+from django.utils import six
+from django.utils.encoding import force_bytes
+
+from patchwork import lock as lockmod
+from patchwork.celery import app
+
+LOGGER = logging.getLogger(__name__)
+
+SUBDIRS = ('tmp', 'new', 'cur', 'failed')
+
+_counter = itertools.count()
+
+
+class SpoolError(Exception):
+    pass
+
+
+def thread_key(data):
+    """The key of the thread of the raw mail data: a hash of the first
+       References msgid, the In-Reply-To msgid or its own Message-Id"""
+    data = data.replace(b'\r\n', b'\n').split(b'\n\n', 1)[0]
+    if six.PY3:
+        data = data.decode('ascii', 'replace')
+    headers = HeaderParser().parsestr(data, headersonly=True)
+
+    refs = (headers.get('References') or '').split()
+    if refs:
+        root = refs[0]
+    else:
+        root = (headers.get('In-Reply-To') or
+                headers.get('Message-Id') or '').strip()
+
+    return hashlib.sha1(force_bytes(root)).hexdigest()[:16]
+
+
+def key_of(name):
+    return name.rsplit('.', 1)[-1]
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Spool(object):
+
+    def __init__(self, path=None):
+        if path is None:
+            path = settings.PARSEMAIL_SPOOL_DIR
+        if not path:
+            raise SpoolError('PARSEMAIL_SPOOL_DIR is not set')
+        self.path = path
+
+    def dir(self, subdir):
+        return os.path.join(self.path, subdir)
+
+    def create(self):
+        for subdir in SUBDIRS:
+            try:
+                os.makedirs(self.dir(subdir))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def accept(self, data):
+        """Durably write the raw mail data to the spool, returning the name
+           of the spooled mail. Names sort in the order mails are
+           accepted."""
+        self.create()
+        now = time.time()
+        name = '%010d.%06d.%d_%d.%s' % (now, (now % 1) * 1000000, os.getpid(),
+                                        next(_counter), thread_key(data))
+
+        tmp_path = os.path.join(self.dir('tmp'), name)
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, os.path.join(self.dir('new'), name))
+        _fsync_dir(self.dir('new'))
+        return name
+
+    def list(self, subdir='new', key=None):
+        try:
+            names = os.listdir(self.dir(subdir))
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return []
+            raise
+        names = [n for n in names if not n.endswith('.error')]
+        if key is not None:
+            names = [n for n in names if key_of(n) == key]
+        return sorted(names)
+
+    def keys(self):
+        """The keys of the threads with pending mails, oldest first"""
+        keys = []
+        for name in self.list('new'):
+            key = key_of(name)
+            if key not in keys:
+                keys.append(key)
+        return keys
+
+    def lock(self, key, timeout=600):
+        return lockmod.lock(os.path.join(self.dir('tmp'), '.lock.' + key),
+                            timeout=timeout)
+
+    def process(self, key, parse, timeout=600):
+        """Parse the pending mails of the thread key, oldest first, with
+           parse(file), including the ones arriving in the meantime. Waits
+           up to timeout seconds for another worker processing the same
+           thread. Returns the number of mails processed."""
+        count = 0
+        lk = self.lock(key, timeout)
+        try:
+            names = self.list('new', key)
+            while names:
+                for name in names:
+                    if self.claim(name):
+                        self.process_one(name, parse)
+                        count += 1
+                names = self.list('new', key)
+        finally:
+            lk.release()
+        return count
+
+    def claim(self, name):
+        cur_path = os.path.join(self.dir('cur'), name)
+        try:
+            os.rename(os.path.join(self.dir('new'), name), cur_path)
+        except OSError as e:
+            # taken by someone else
+            if e.errno == errno.ENOENT:
+                return False
+            raise
+        # recover() looks at how long mails have been in cur/
+        os.utime(cur_path, None)
+        return True
+
+    def process_one(self, name, parse):
+        cur_path = os.path.join(self.dir('cur'), name)
+        try:
+            with open(cur_path, 'rb') as f:
+                parse(f)
+        except Exception:
+            LOGGER.exception("Error when parsing spooled mail '%s'", name)
+            failed_path = os.path.join(self.dir('failed'), name)
+            with open(failed_path + '.error', 'w') as f:
+                f.write(traceback.format_exc())
+            os.rename(cur_path, failed_path)
+            return False
+        finally:
+            # don't let DEBUG accumulate queries forever
+            reset_queries()
+
+        os.unlink(cur_path)
+        return True
+
+    def retry(self, names=None):
+        """Move failed mails (all of them if names is None) back to new/,
+           returning the keys of their threads"""
+        if names is None:
+            names = self.list('failed')
+        keys = []
+        for name in names:
+            failed_path = os.path.join(self.dir('failed'), name)
+            if not os.path.exists(failed_path):
+                raise SpoolError("no failed mail '%s'" % name)
+            os.rename(failed_path, os.path.join(self.dir('new'), name))
+            if os.path.exists(failed_path + '.error'):
+                os.unlink(failed_path + '.error')
+            if key_of(name) not in keys:
+                keys.append(key_of(name))
+        return keys
+
+    def recover(self, max_age=3600):
+        """Move back to new/ the mails left in cur/ for more than max_age
+           seconds, by a worker that died while parsing them. Returns the
+           keys of their threads."""
+        keys = []
+        now = time.time()
+        for name in self.list('cur'):
+            cur_path = os.path.join(self.dir('cur'), name)
+            try:
+                if now - os.path.getmtime(cur_path) < max_age:
+                    continue
+                os.rename(cur_path, os.path.join(self.dir('new'), name))
+            except OSError as e:
+                if e.errno == errno.ENOENT:
+                    continue
+                raise
+            if key_of(name) not in keys:
+                keys.append(key_of(name))
+        return keys
+
+
+def spool_mail(data):
+    """Accept the raw mail data into the spool and queue its parsing,
+       without touching the database. If the queue is unavailable, the mail
+       stays in the spool until 'parsemail_spool requeue' is run."""
+    name = Spool().accept(data)
+    try:
+        app.send_task('parse_spooled_mail', (key_of(name),), retry=False)
+    except Exception:
+        LOGGER.exception("Failed to queue spooled mail '%s'", name)
+    return name
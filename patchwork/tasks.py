@@ -20,16 +20,27 @@
 from __future__ import absolute_import
 
 from celery import task
+from celery.signals import task_prerun
 from celery.utils.log import get_task_logger
+from django.conf import settings
 from django.contrib.auth.models import User
 
+from patchwork.bin.parsemail import parse_mail, read_mail
 from patchwork.email import (PreviousReviewerNotification,
                              NewReviewerNotification)
-from patchwork.models import Series
+from patchwork.lock import LockHeld
+from patchwork.models import Series, expire_caches, refresh_revision_state
+from patchwork.spool import Spool
 
 logger = get_task_logger(__name__)
 
 
+@task_prerun.connect
+def _expire_caches_callback(**kwargs):
+    # see the changes of the configuration made by other processes
+    expire_caches()
+
+
 @task(name="send_reviewer_notification")
 def send_reviewer_notification(series_pk, series_url, user_pk,
                                old_reviewer_pk, new_reviewer_pk):
@@ -47,3 +58,27 @@ def send_reviewer_notification(series_pk, series_url, user_pk,
         new_reviewer = User.objects.get(pk=new_reviewer_pk)
         email = NewReviewerNotification(series, series_url, user, new_reviewer)
         email.send()
+
+
+def parse_spooled_file(f):
+    parse_mail(read_mail(f, settings.PARSEMAIL_MAX_MAIL_SIZE))
+
+
+@task(name="parse_spooled_mail", bind=True, max_retries=60)
+def parse_spooled_mail(self, key):
+    """Parse the spooled mails of the thread key, in order"""
+    try:
+        count = Spool().process(key, parse_spooled_file, timeout=0)
+    except LockHeld as e:
+        # another worker is busy with that thread, it may have missed our
+        # mail if it was about to release the lock. After max_retries, the
+        # mails stay in the spool for 'parsemail_spool requeue'.
+        raise self.retry(exc=e, countdown=5)
+    logger.info("Parsed %d spooled mails of thread %s" % (count, key))
+
+
+@task(name="update_revision_state")
+def update_revision_state(revision_pk):
+    """Update the state of a revision after changes to its patches, see
+       REVISION_STATE_ASYNC"""
+    refresh_revision_state(revision_pk)
@@ -33,6 +33,10 @@ register = template.Library()
 # params to preserve across views
 list_params = [c.param for c in filterclasses] + ['order', 'page']
 
+# params only used by the links they're given to, eg. the cursors of the
+# previous and next pages (see patchwork.paginator.KeysetPaginator)
+link_params = ['after', 'before']
+
 
 class ListURLNode(template.defaulttags.URLNode):
 
@@ -40,7 +44,7 @@ class ListURLNode(template.defaulttags.URLNode):
         super(ListURLNode, self).__init__(None, [], {}, False)
         self.params = {}
         for (k, v) in kwargs.items():
-            if k in list_params:
+            if k in list_params or k in link_params:
                 self.params[k] = v
 
     def render(self, context):
@@ -69,7 +73,10 @@ class ListURLNode(template.defaulttags.URLNode):
             pass
 
         for (k, v) in self.params.items():
-            params[smart_str(k, 'ascii')] = v.resolve(context)
+            value = v.resolve(context)
+            if k in link_params and not value:
+                continue
+            params[smart_str(k, 'ascii')] = value
 
         if not params:
             return str
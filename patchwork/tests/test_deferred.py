@@ -0,0 +1,155 @@
+# Patchwork - automated patch tracking system
+# Copyright (C) 2018 Intel Corporation
+#
+# This file is part of the Patchwork package.
+#
+# Patchwork is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Patchwork is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Patchwork; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+from django.db.models import signals
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase
+
+from patchwork import deferred
+from patchwork.bin.parsemail import parse_mail
+from patchwork.middleware import DeferredWorkMiddleware
+from patchwork.models import (EventLog, Patch, Person, RevisionState, Series,
+                              SeriesRevision, State, refresh_revision_state)
+from patchwork.tests.utils import defaults, TestSeries
+
+
+class DeferredTest(SimpleTestCase):
+
+    def setUp(self):
+        self.calls = []
+
+    def work(self, *args):
+        self.calls.append(args)
+
+    def testImmediate(self):
+        deferred.defer('a', self.work, 1)
+        self.assertEqual(self.calls, [(1,)])
+
+    def testCollect(self):
+        with deferred.collect():
+            deferred.defer('a', self.work, 1)
+            deferred.defer('b', self.work, 2)
+            deferred.defer('a', self.work, 3)
+            self.assertEqual(self.calls, [])
+            self.assertEqual(deferred.pending('a'), (3,))
+        self.assertEqual(self.calls, [(3,), (2,)])
+
+    def testNested(self):
+        with deferred.collect():
+            with deferred.collect():
+                deferred.defer('a', self.work, 1)
+            self.assertEqual(self.calls, [])
+        self.assertEqual(self.calls, [(1,)])
+
+    def testDeferFromWork(self):
+        with deferred.collect():
+            deferred.defer('a', deferred.defer, 'b', self.work, 1)
+        self.assertEqual(self.calls, [(1,)])
+
+    def testDiscard(self):
+        with deferred.collect():
+            deferred.defer('a', self.work, 1)
+            deferred.discard('a')
+        self.assertEqual(self.calls, [])
+
+    def testException(self):
+        try:
+            with deferred.collect():
+                deferred.defer('a', self.work, 1)
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(self.calls, [])
+        self.assertFalse(deferred.collecting())
+
+
+class TransactionalParseMailTest(TestCase):
+    fixtures = ['default_states', 'default_events']
+
+    def setUp(self):
+        defaults.project.save()
+
+    def testRollback(self):
+        """A failure while parsing a mail doesn't leave anything behind"""
+        def fail(sender, **kwargs):
+            raise ValueError
+
+        mails = TestSeries(2, has_cover_letter=False).create_mails()
+        signals.post_save.connect(fail, sender=Patch)
+        try:
+            self.assertRaises(ValueError, parse_mail, mails[0])
+        finally:
+            signals.post_save.disconnect(fail, sender=Patch)
+
+        self.assertEqual(Person.objects.count(), 0)
+        self.assertEqual(Series.objects.count(), 0)
+        self.assertEqual(SeriesRevision.objects.count(), 0)
+        self.assertEqual(EventLog.objects.count(), 0)
+
+    def testDeferredWork(self):
+        mails = TestSeries(2).create_mails()
+        for mail in mails:
+            parse_mail(mail)
+
+        revision = SeriesRevision.objects.get()
+        self.assertEqual(revision.state, RevisionState.INITIAL)
+        self.assertEqual(revision.state_summary[0]['count'], 2)
+        self.assertEqual(EventLog.objects.filter(
+            event__name='series-new-revision').count(), 1)
+
+
+class RevisionStateTest(TestCase):
+    fixtures = ['default_states', 'default_events']
+
+    def setUp(self):
+        defaults.project.save()
+        TestSeries(3, has_cover_letter=False).insert()
+        self.revision = SeriesRevision.objects.get()
+        self.accepted = State.objects.get(name='Accepted')
+
+    def accept_patches(self):
+        for patch in Patch.objects.all():
+            patch.state = self.accepted
+            patch.save()
+
+    def state(self):
+        return SeriesRevision.objects.get(pk=self.revision.pk).state
+
+    def testMiddleware(self):
+        def view(request):
+            self.accept_patches()
+            self.assertEqual(self.state(), RevisionState.INITIAL)
+            return HttpResponse()
+
+        request = RequestFactory().post('/')
+        middleware = DeferredWorkMiddleware()
+        middleware.process_view(request, view, (), {})
+        self.assertEqual(self.state(), RevisionState.DONE)
+        self.assertFalse(deferred.collecting())
+
+    def testRefresh(self):
+        with deferred.collect():
+            self.accept_patches()
+            deferred.discard(('revision_state', self.revision.pk))
+        self.assertEqual(self.state(), RevisionState.INITIAL)
+
+        refresh_revision_state(self.revision.pk)
+        self.assertEqual(self.state(), RevisionState.DONE)
+        # the revision may be gone when the worker gets to it
+        refresh_revision_state(self.revision.pk + 1)
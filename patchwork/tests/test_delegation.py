@@ -0,0 +1,175 @@
+# Patchwork - automated patch tracking system
+# Copyright (C) 2018 Intel Corporation
+#
+# This file is part of the Patchwork package.
+#
+# Patchwork is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Patchwork is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Patchwork; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+from fnmatch import fnmatch
+
+from django.test import SimpleTestCase, TestCase
+
+from patchwork.bin.parsemail import auto_delegate, parse_mail
+from patchwork.models import DelegationRule, Patch
+from patchwork.parser import DelegationMatcher
+from patchwork.tests.utils import create_email, create_user, defaults
+
+
+def reference_delegate(rules, filename):
+    for (path, delegate) in rules:
+        if fnmatch(filename, path):
+            return delegate
+    return None
+
+
+class DelegationMatcherTest(SimpleTestCase):
+
+    rules = [
+        ('drivers/gpu/drm/i915/gvt/*', 'gvt'),
+        ('drivers/gpu/drm/i915/*', 'i915'),
+        ('drivers/gpu/drm/*.[ch]', 'drm-core'),
+        ('drivers/gpu/*', 'gpu'),
+        ('include/uapi/drm/i915_drm.h', 'i915-uapi'),
+        ('Documentation/gpu/?915.rst', 'i915-doc'),
+        ('lib/[!a-m]*', 'lib'),
+        ('*', 'everything'),
+    ]
+
+    filenames = [
+        'drivers/gpu/drm/i915/gvt/gtt.c',
+        'drivers/gpu/drm/i915/intel_display.c',
+        'drivers/gpu/drm/drm_crtc.c',
+        'drivers/gpu/drm/drm_crtc.o',
+        'drivers/gpu/host1x/dev.c',
+        'include/uapi/drm/i915_drm.h',
+        'include/uapi/drm/i915_drmXh',
+        'Documentation/gpu/i915.rst',
+        'lib/string.c',
+        'lib/idr.c',
+        'Makefile',
+        'a\nb',
+    ]
+
+    def testPriority(self):
+        matcher = DelegationMatcher(self.rules)
+        for filename in self.filenames:
+            self.assertEqual(matcher.delegate(filename),
+                             reference_delegate(self.rules, filename),
+                             filename)
+
+    def testNoMatch(self):
+        matcher = DelegationMatcher(self.rules[:-1])
+        self.assertEqual(matcher.delegate('Makefile'), None)
+        self.assertEqual(DelegationMatcher([]).delegate('Makefile'), None)
+
+    def assertDelegates(self, rules, filenames):
+        matcher = DelegationMatcher(rules)
+        for filename in filenames:
+            self.assertEqual(matcher.delegate(filename),
+                             reference_delegate(rules, filename), filename)
+
+    def testManyRules(self):
+        # more rules than fit in a single regex
+        rules = [('dir%d/*' % i, i) for i in range(250)]
+        rules.insert(120, ('dir2*/file', 'dir2x'))
+        self.assertDelegates(rules, ('dir0/file', 'dir99/file', 'dir100/file',
+                                     'dir249/file', 'dir20/file',
+                                     'dir200/file', 'dir250/file', 'file'))
+
+        # around the limit of groups per regex
+        for count in (100, 101):
+            rules = [('dir%d/*' % i, i) for i in range(count)]
+            self.assertDelegates(rules, ('dir0/file', 'dir98/file',
+                                         'dir99/file', 'dir100/file',
+                                         'file'))
+
+    def testCompileError(self):
+        # chunks the regex engine rejects are matched rule by rule
+        chunk_size = DelegationMatcher.chunk_size
+        DelegationMatcher.chunk_size = 1000
+        self.addCleanup(setattr, DelegationMatcher, 'chunk_size', chunk_size)
+        compile = DelegationMatcher._compile
+
+        def _compile(self, chunk):
+            if len(chunk) > 1:
+                raise AssertionError('too many groups')
+            return compile(self, chunk)
+
+        DelegationMatcher._compile = _compile
+        self.addCleanup(setattr, DelegationMatcher, '_compile', compile)
+
+        rules = [('dir%d/*' % i, i) for i in range(150)]
+        rules.insert(0, ('dir1*/file', 'dir1x'))
+        self.assertDelegates(rules, ('dir0/file', 'dir1/file', 'dir149/file',
+                                     'dir150/file'))
+
+
+class AutoDelegateTest(TestCase):
+    fixtures = ['default_states', 'default_events']
+
+    patch = """--- a/drivers/gpu/a.c
++++ b/drivers/gpu/a.c
+@@ -1 +1 @@
+-a
++b
+"""
+
+    def setUp(self):
+        defaults.project.save()
+        self.user1 = create_user()
+        self.user2 = create_user()
+
+    def add_rule(self, path, user, priority=0):
+        DelegationRule(project=defaults.project, path=path, user=user,
+                       priority=priority).save()
+
+    def testNoRules(self):
+        self.assertEqual(auto_delegate(defaults.project, ['a']), None)
+
+    def testDelegate(self):
+        self.add_rule('drivers/*', self.user1)
+        self.add_rule('drivers/gpu/*', self.user2, priority=1)
+
+        self.assertEqual(auto_delegate(defaults.project,
+                                       ['drivers/gpu/a', 'drivers/gpu/b']),
+                         self.user2)
+        self.assertEqual(auto_delegate(defaults.project,
+                                       ['drivers/net/a', 'drivers/gpu/b']),
+                         None)
+        self.assertEqual(auto_delegate(defaults.project,
+                                       ['drivers/net/a', 'lib/b']),
+                         None)
+
+    def testCached(self):
+        self.add_rule('*', self.user1)
+        self.assertEqual(auto_delegate(defaults.project, ['a']), self.user1)
+        with self.assertNumQueries(0):
+            self.assertEqual(auto_delegate(defaults.project, ['a']),
+                             self.user1)
+
+    def testInvalidate(self):
+        self.add_rule('*', self.user1)
+        self.assertEqual(auto_delegate(defaults.project, ['a']), self.user1)
+
+        self.add_rule('a', self.user2, priority=1)
+        self.assertEqual(auto_delegate(defaults.project, ['a']), self.user2)
+
+        DelegationRule.objects.get(path='a').delete()
+        self.assertEqual(auto_delegate(defaults.project, ['a']), self.user1)
+
+    def testParseMail(self):
+        self.add_rule('drivers/*', self.user1)
+        parse_mail(create_email(self.patch))
+        self.assertEqual(Patch.objects.get().delegate, self.user1)
@@ -0,0 +1,169 @@
+# Patchwork - automated patch tracking system
+# Copyright (C) 2018 Intel Corporation
+#
+# This file is part of the Patchwork package.
+#
+# Patchwork is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Patchwork is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Patchwork; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import json
+import mailbox
+import os
+import shutil
+import tempfile
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+from django.utils.six import StringIO
+
+from patchwork.bin.parsemail import parse_mail
+from patchwork.models import Comment, Patch, Person, Project, Series
+from patchwork.tests.utils import read_mail
+
+series_mails = sorted(os.listdir(os.path.join(os.path.dirname(__file__),
+                                              'mail', 'series')))
+
+
+def snapshot():
+    series = []
+    for s in Series.objects.all():
+        revisions = [(r.version, r.root_msgid, r.n_patches,
+                      [p.msgid for p in r.ordered_patches()])
+                     for r in s.seriesrevision_set.order_by('version')]
+        series.append((s.name, s.submitter.email, revisions))
+
+    return {
+        'series': sorted(series),
+        'patches': sorted(Patch.objects.values_list('msgid', 'name',
+                                                    'state__name')),
+        'comments': sorted(Comment.objects.values_list('msgid',
+                                                       'patch__msgid')),
+    }
+
+
+class ImportMailTest(TestCase):
+    fixtures = ['default_states', 'default_events']
+
+    def setUp(self):
+        self.project = Project(linkname='intel-gfx',
+                               name='Intel Gfx',
+                               listid='intel-gfx.lists.freedesktop.org',
+                               listemail='intel-gfx@lists.freedesktop.org')
+        self.project.save()
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.mails = [read_mail(os.path.join('series', f))
+                      for f in series_mails]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def create_dir(self, path):
+        os.makedirs(path)
+        # name the files in reverse order to check we sort them by mtime
+        for i, mail in enumerate(self.mails):
+            filename = os.path.join(path, '%04d' % (len(self.mails) - i))
+            with open(filename, 'w') as f:
+                f.write(mail.as_string())
+            os.utime(filename, (1000000000 + i, 1000000000 + i))
+        return path
+
+    def create_maildir(self):
+        path = os.path.join(self.tmpdir, 'maildir')
+        self.create_dir(os.path.join(path, 'cur'))
+        os.mkdir(os.path.join(path, 'new'))
+        os.mkdir(os.path.join(path, 'tmp'))
+        return path
+
+    def create_mbox(self):
+        path = os.path.join(self.tmpdir, 'mbox')
+        box = mailbox.mbox(path)
+        for mail in self.mails:
+            box.add(mail)
+        box.close()
+        return path
+
+    def parse_mails(self, mails):
+        for mail in mails:
+            parse_mail(mail)
+
+    def clear(self):
+        Series.objects.all().delete()
+        Patch.objects.all().delete()
+        Person.objects.all().delete()
+
+    def importmail(self, *args, **kwargs):
+        call_command('importmail', *args, stdout=StringIO(), **kwargs)
+
+    def assertImportEqual(self, source, **kwargs):
+        self.importmail(source, **kwargs)
+        imported = snapshot()
+        self.assertTrue(imported['patches'])
+
+        self.clear()
+        self.parse_mails(self.mails)
+        self.assertEqual(imported, snapshot())
+
+    def testDir(self):
+        path = self.create_dir(os.path.join(self.tmpdir, 'dir'))
+        self.assertImportEqual(path, batch_size=4)
+
+    def testMaildir(self):
+        self.assertImportEqual(self.create_maildir(), batch_size=1)
+
+    def testMbox(self):
+        self.assertImportEqual(self.create_mbox())
+
+    def testReimport(self):
+        path = self.create_mbox()
+        self.importmail(path)
+        imported = snapshot()
+
+        out = StringIO()
+        call_command('importmail', path, stdout=out)
+        # cover letters aren't in the thread index, parsing them again is
+        # harmless
+        self.assertTrue('1 mails imported, %d duplicates' %
+                        (len(self.mails) - 1) in out.getvalue())
+        self.assertEqual(imported, snapshot())
+
+    def testCheckpointResume(self):
+        path = self.create_mbox()
+        checkpoint = os.path.join(self.tmpdir, 'checkpoint')
+
+        # pretend a previous run stopped after 5 mails
+        self.parse_mails(self.mails[:5])
+        with open(checkpoint, 'w') as f:
+            json.dump({'source': path, 'count': 5, 'last': '4'}, f)
+
+        self.importmail(path, checkpoint=checkpoint, batch_size=3)
+        imported = snapshot()
+
+        self.clear()
+        self.parse_mails(self.mails)
+        self.assertEqual(imported, snapshot())
+
+        with open(checkpoint) as f:
+            self.assertEqual(json.load(f)['count'], len(self.mails))
+
+    def testCheckpointMismatch(self):
+        path = self.create_mbox()
+        checkpoint = os.path.join(self.tmpdir, 'checkpoint')
+        with open(checkpoint, 'w') as f:
+            json.dump({'source': path, 'count': 5, 'last': '3'}, f)
+
+        self.assertRaises(CommandError, self.importmail, path,
+                          checkpoint=checkpoint)
+        self.assertEqual(Patch.objects.count(), 0)
@@ -0,0 +1,101 @@
+# Patchwork - automated patch tracking system
+# Copyright (C) 2018 Intel Corporation
+#
+# This file is part of the Patchwork package.
+#
+# Patchwork is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Patchwork is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Patchwork; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+from collections import deque
+import logging
+
+from django.db import connection
+from django.test import TestCase, override_settings
+
+from patchwork import ingeststats
+from patchwork.bin.parsemail import parse_mail
+from patchwork.tests.utils import defaults, TestSeries
+
+
+class RecordHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class IngestStatsTest(TestCase):
+    fixtures = ['default_states', 'default_events']
+
+    def setUp(self):
+        defaults.project.save()
+        ingeststats.histogram.reset()
+        self.handler = RecordHandler()
+        self.logger = logging.getLogger('patchwork.ingeststats')
+        self.logger.addHandler(self.handler)
+        self.level = self.logger.level
+        self.logger.setLevel(logging.INFO)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+        self.logger.setLevel(self.level)
+
+    def testDisabled(self):
+        parse_mail(TestSeries(1).create_mails()[0])
+        self.assertEqual(ingeststats.histogram.stages, {})
+        self.assertEqual(self.handler.records, [])
+
+    @override_settings(PARSEMAIL_STATS=True)
+    def testStages(self):
+        mails = TestSeries(2).create_mails()
+        for mail in mails:
+            parse_mail(mail)
+
+        self.assertEqual(len(self.handler.records), len(mails))
+        stages = self.handler.records[-1].ingest_stats
+        for stage in ('find_project', 'lock', 'find_author', 'find_content',
+                      'analyse_patch', 'build_references_list',
+                      'find_series_for_mail', 'save_patch', 'add_patch',
+                      'revision_update_state', 'save_comment',
+                      'index_message', 'deferred', 'total'):
+            self.assertTrue(stage in stages, stage)
+
+        # stages include their sub-stages
+        (seconds, queries) = stages['total']
+        self.assertTrue(queries > 0)
+        self.assertTrue(stages['revision_update_state'][1] <=
+                        stages['deferred'][1] <= queries)
+        self.assertTrue(stages['find_content'][1] >=
+                        stages['find_series_for_mail'][1])
+
+        histogram = ingeststats.histogram.stages
+        self.assertEqual(histogram['total'][0], len(mails))
+        self.assertEqual(histogram['save_series'][0], len(mails))
+        self.assertEqual(histogram['save_patch'][0], len(mails) - 1)
+        self.assertEqual(sum(histogram['total'][3]), len(mails))
+
+        # the queries are counted once the log of the connection is full
+        queries_log = connection.queries_log
+        self.addCleanup(setattr, connection, 'queries_log', queries_log)
+        connection.queries_log = deque([{}] * 10, maxlen=10)
+        parse_mail(TestSeries(1).create_mails()[0])
+        self.assertTrue(self.handler.records[-1].ingest_stats['total'][1] > 0)
+        self.assertEqual(len(connection.queries_log), 10)
+
+        lines = ingeststats.histogram.format().split('\n')
+        self.assertEqual(len(lines), len(histogram) + 1)
+        self.assertTrue(lines[0].startswith('stage'))
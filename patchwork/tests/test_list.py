@@ -19,14 +19,20 @@
 
 from __future__ import absolute_import
 
+import base64
 import datetime
+import json
 import re
 
+from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.utils.six.moves import zip
 
-from patchwork.models import Person, Patch
+from patchwork.models import Comment, Person, Patch, State
 from patchwork.tests.utils import defaults
 
 
@@ -140,3 +146,138 @@ class PatchOrderTest(TestCase):
             self.assertGreaterEqual(p1.submitter.name.lower(),
                                     p2.submitter.name.lower())
         self._test_sequence(response, test_fn)
+
+
+class PatchListQueriesTest(TestCase):
+    fixtures = ['default_states', 'default_tags']
+
+    def setUp(self):
+        defaults.project.save()
+        self.person = Person(name='Test', email='test@example.com')
+        self.person.save()
+        self.n_patches = 0
+        self.url = reverse('patch_list',
+                           kwargs={'project_id': defaults.project.linkname})
+
+    def add_patches(self, n):
+        for i in range(self.n_patches, self.n_patches + n):
+            patch = Patch(project=defaults.project, msgid='<%d@a>' % i,
+                          name='patch %d' % i, submitter=self.person,
+                          content='')
+            patch.save()
+            Comment(patch=patch, msgid=patch.msgid, submitter=self.person,
+                    content='Acked-by: Test <test@example.com>\n' * i).save()
+        self.n_patches += n
+
+    def count_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        tag_queries = [q for q in queries.captured_queries
+                       if 'patchwork_patchtag' in q['sql']]
+        # the counts of all the tags are fetched at once, for all the patches
+        self.assertEqual(len(tag_queries), 1)
+        self.assertEqual(tag_queries[0]['sql'].count('SELECT'), 1)
+        return (len(queries), response.content.decode())
+
+    def testTagCounts(self):
+        """The number of queries doesn't depend on the number of patches or
+           tags listed"""
+        self.add_patches(3)
+        (n_queries, _) = self.count_queries()
+
+        self.add_patches(7)
+        (n_more_queries, content) = self.count_queries()
+        self.assertEqual(n_more_queries, n_queries)
+
+        self.assertIn('<span title="9 Acked-by">9</span>', content)
+        self.assertIn('<span title="0 Acked-by"></span>', content)
+        self.assertIn('<span title="0 Reviewed-by"></span>', content)
+
+
+class PatchListPaginationTest(TestCase):
+    fixtures = ['default_states']
+
+    orders = ['date', '-date', 'name', '-name', 'submitter', '-submitter',
+              'delegate', '-delegate', 'state', '-state']
+    next_re = re.compile(r'<a href="([^"]*)"\s+title="Next Page"')
+    previous_re = re.compile(r'<a href="([^"]*)"\s+title="Previous Page"')
+
+    def setUp(self):
+        # the counts of the lists are cached across tests
+        cache.clear()
+        defaults.project.save()
+        people = [Person(name=name, email='%s@example.com' % i)
+                  for (i, name) in enumerate(['B', None, 'A'])]
+        for person in people:
+            person.save()
+        delegate = User.objects.create_user('delegate', 'd@example.com')
+        states = list(State.objects.all())
+
+        # ties on every order, NULL submitter names and delegates
+        date = datetime.datetime(2014, 3, 16, 13, 4, 50)
+        for i in range(23):
+            patch = Patch(project=defaults.project, msgid='<%d@a>' % i,
+                          name='patch %d' % (i % 5), submitter=people[i % 3],
+                          state=states[i % 2], content='',
+                          date=date + datetime.timedelta(days=i % 4))
+            if i % 4 == 0:
+                patch.delegate = delegate
+            patch.save()
+
+        self.url = reverse('patch_list',
+                           kwargs={'project_id': defaults.project.linkname})
+
+    def get(self, url):
+        response = self.client.get(url, ppp=5)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def walk(self, url, link_re):
+        ids = []
+        while url:
+            response = self.get(url)
+            ids.append([patch.id for patch
+                        in response.context['page'].object_list])
+            link = link_re.search(response.content.decode())
+            url = link.group(1).replace('&amp;', '&') if link else None
+        return ids
+
+    def testKeyset(self):
+        for order in self.orders:
+            url = self.url + '?order=%s' % order
+            pages = self.walk(url, self.next_re)
+
+            # the pages seen with cursors are the pages found with offsets
+            expected = [self.get(url + '&page=%d' % i).context['page']
+                        for i in range(1, 6)]
+            self.assertEqual(pages, [[patch.id for patch in page.object_list]
+                                     for page in expected], order)
+            self.assertEqual(expected[0].paginator.num_pages, 5)
+            self.assertEqual(len(set(sum(pages, []))), 23)
+
+            # and back
+            response = self.get(url + '&page=5')
+            link = self.previous_re.search(response.content.decode())
+            url = link.group(1).replace('&amp;', '&')
+            self.assertIn('before=', url)
+            self.assertEqual(self.walk(url, self.previous_re),
+                             list(reversed(pages[:-1])), order)
+
+    def testInvalidCursor(self):
+        response = self.get(self.url + '?page=2&after=foo')
+        self.assertEqual(len(response.context['page'].object_list), 5)
+
+        # cursors that decode, but don't match the keys of the order
+        for values in (['foo', 1], [['dt', 'garbage'], 1], [None, None],
+                       [{'a': 1}, 1], [['dt', '2014-13-45T00:00:00'], 1],
+                       [1, 2, 3], 'foo'):
+            cursor = base64.urlsafe_b64encode(
+                json.dumps(values).encode('ascii')).decode('ascii')
+            for order in ('date', 'name', '-state'):
+                for param in ('after', 'before'):
+                    response = self.get(self.url + '?order=%s&page=2&%s=%s' %
+                                        (order, param, cursor))
+                    self.assertEqual(response.context['page'].number, 2)
+        response = self.get(self.url + '?page=12')
+        self.assertEqual(response.context['page'].number, 1)
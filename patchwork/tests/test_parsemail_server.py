@@ -0,0 +1,184 @@
+# Patchwork - automated patch tracking system
+# Copyright (C) 2018 Intel Corporation
+#
+# This file is part of the Patchwork package.
+#
+# Patchwork is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Patchwork is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Patchwork; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import io
+import socket
+
+from django.core import mail as django_mail
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from patchwork.bin.parsemail import setup_error_handler
+from patchwork.management.commands import parsemail_server
+from patchwork.management.commands.parsemail_server import (
+    MailRequestHandler, MailSession, deliver_mail, MAX_DATA_LINE)
+from patchwork.models import Patch, Comment
+from patchwork.tests.utils import defaults, create_email
+
+
+def run_session(commands, lmtp=True, max_size=None):
+    delivered = []
+
+    def deliver(data):
+        delivered.append(data)
+        return '250 2.0.0 OK'
+
+    rfile = io.BytesIO(b''.join([c + b'\r\n' for c in commands]))
+    wfile = io.BytesIO()
+    MailSession(rfile, wfile, deliver, lmtp=lmtp, hostname='pw',
+                max_size=max_size).run()
+    # only keep the last line of multi-line replies
+    replies = [r for r in wfile.getvalue().decode('ascii').split('\r\n')[:-1]
+               if r[3] != '-']
+    return (replies, delivered)
+
+
+class MailSessionTest(SimpleTestCase):
+
+    def testLMTP(self):
+        (replies, delivered) = run_session([
+            b'LHLO mta', b'MAIL FROM:<a@example.com>',
+            b'RCPT TO:<pw@example.com>', b'RCPT TO:<pw2@example.com>',
+            b'DATA', b'Subject: foo', b'', b'..bar', b'baz', b'.', b'QUIT'])
+        self.assertEqual([r[:3] for r in replies], [
+            '220', '250', '250', '250', '250', '354', '250', '250', '221'])
+        self.assertEqual(delivered, [b'Subject: foo\n\n.bar\nbaz\n'])
+
+    def testSMTP(self):
+        (replies, delivered) = run_session([
+            b'LHLO mta', b'HELO mta', b'MAIL FROM:<a@example.com>',
+            b'RCPT TO:<pw@example.com>', b'RCPT TO:<pw2@example.com>',
+            b'DATA', b'foo', b'.', b'QUIT'], lmtp=False)
+        self.assertEqual([r[:3] for r in replies], [
+            '220', '500', '250', '250', '250', '250', '354', '250', '221'])
+        self.assertEqual(delivered, [b'foo\n'])
+
+    def testSequence(self):
+        (replies, delivered) = run_session([
+            b'MAIL FROM:<a@example.com>', b'LHLO mta', b'DATA',
+            b'RCPT TO:<pw@example.com>', b'MAIL FROM:<a@example.com>',
+            b'RSET', b'RCPT TO:<pw@example.com>', b'FOO', b'QUIT'])
+        self.assertEqual([r[:3] for r in replies], [
+            '220', '503', '250', '503', '503', '250', '250', '503', '500',
+            '221'])
+        self.assertEqual(delivered, [])
+
+    def testTruncatedData(self):
+        (replies, delivered) = run_session([
+            b'LHLO mta', b'MAIL FROM:<a@example.com>',
+            b'RCPT TO:<pw@example.com>', b'DATA', b'foo'])
+        self.assertEqual(replies[-1][:3], '354')
+        self.assertEqual(delivered, [])
+
+    def testTooLarge(self):
+        (replies, delivered) = run_session([
+            b'LHLO mta', b'MAIL FROM:<a@example.com>',
+            b'RCPT TO:<pw@example.com>', b'DATA', b'x' * 20, b'.',
+            b'MAIL FROM:<a@example.com>', b'RCPT TO:<pw@example.com>',
+            b'DATA', b'x' * 10, b'.', b'QUIT'], max_size=16)
+        self.assertEqual([r[:3] for r in replies], [
+            '220', '250', '250', '250', '354', '552', '250', '250', '354',
+            '250', '221'])
+        self.assertEqual(delivered, [b'x' * 10 + b'\n'])
+
+    def testLineTooLong(self):
+        # the rest of the line is '.', which doesn't end the data
+        (replies, delivered) = run_session([
+            b'LHLO mta', b'MAIL FROM:<a@example.com>',
+            b'RCPT TO:<pw@example.com>', b'DATA',
+            b'x' * (MAX_DATA_LINE + 1) + b'.', b'.',
+            b'MAIL FROM:<a@example.com>', b'RCPT TO:<pw@example.com>',
+            b'DATA', b'x' * (MAX_DATA_LINE - 2), b'.', b'QUIT'])
+        self.assertEqual([r[:3] for r in replies], [
+            '220', '250', '250', '250', '354', '500', '250', '250', '354',
+            '250', '221'])
+        self.assertEqual(delivered, [b'x' * (MAX_DATA_LINE - 2) + b'\n'])
+
+
+class MailRequestHandlerTest(SimpleTestCase):
+
+    class Server(object):
+        lmtp = True
+        idle_timeout = 0.1
+
+        def deliver(self, data):
+            return '250 2.0.0 OK'
+
+    def testIdleTimeout(self):
+        (client, server) = socket.socketpair()
+        self.addCleanup(client.close)
+        # returns once the idle connection is closed
+        MailRequestHandler(server, None, self.Server())
+        server.close()
+        replies = client.makefile('rb').read().decode('ascii')
+        self.assertEqual([r[:3] for r in replies.split('\r\n')[:-1]],
+                         ['220', '421'])
+
+
+class DeliverMailTest(TestCase):
+    fixtures = ['default_states', 'default_events']
+
+    def testPatchAndComment(self):
+        patch = create_email(defaults.patch)
+        comment = create_email('comment', in_reply_to=patch['Message-Id'])
+
+        for mail in (patch, comment):
+            data = mail.as_string().encode('utf-8')
+            self.assertEqual(deliver_mail(data), '250 2.0.0 OK')
+
+        patch = Patch.objects.get(msgid=patch['Message-Id'])
+        self.assertEqual(Comment.objects.filter(patch=patch).count(), 2)
+
+    def testNoProject(self):
+        mail = create_email(defaults.patch)
+        del mail['List-Id']
+        data = mail.as_string().encode('utf-8')
+        self.assertEqual(deliver_mail(data), '250 2.0.0 OK')
+        self.assertEqual(Patch.objects.count(), 0)
+
+
+@override_settings(DEBUG=False, ADMINS=[('admin', 'admin@example.com')])
+class ErrorHandlerTest(TestCase):
+    fixtures = ['default_states', 'default_events']
+
+    def setUp(self):
+        logger = setup_error_handler()
+        self.addCleanup(logger.removeHandler, logger.handlers[-1])
+
+    def testParseError(self):
+        def parse_mail(mail):
+            raise ValueError('oops')
+        self.addCleanup(setattr, parsemail_server, 'parse_mail',
+                        parsemail_server.parse_mail)
+        parsemail_server.parse_mail = parse_mail
+
+        patch = create_email(defaults.patch)
+        data = patch.as_string().encode('utf-8')
+        self.assertEqual(deliver_mail(data),
+                         '451 4.3.0 Error when parsing mail')
+        self.assertEqual(len(django_mail.outbox), 1)
+        self.assertIn(patch['Message-Id'], django_mail.outbox[0].body)
+        self.assertIn('Exception Value: oops', django_mail.outbox[0].body)
+
+    def testNoProject(self):
+        patch = create_email(defaults.patch)
+        del patch['List-Id']
+        data = patch.as_string().encode('utf-8')
+        self.assertEqual(deliver_mail(data), '250 2.0.0 OK')
+        self.assertEqual(len(django_mail.outbox), 1)
+        self.assertIn('(not available)', django_mail.outbox[0].body)
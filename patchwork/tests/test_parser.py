@@ -0,0 +1,176 @@
+# Patchwork - automated patch tracking system
+# Copyright (C) 2018 Intel Corporation
+#
+# This file is part of the Patchwork package.
+#
+# Patchwork is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Patchwork is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Patchwork; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import hashlib
+import json
+import os
+
+from django.test import SimpleTestCase
+
+from patchwork.parser import (analyse_patch, parse_patch, parse_patch_spans,
+                              join_spans, hash_patch, hash_patch_spans,
+                              patch_get_filenames, spans_get_filenames)
+from patchwork.tests.utils import (_test_mail_dir, _test_patch_dir,
+                                   read_mail, read_patch)
+
+
+# The expected results were generated with the original, string
+# concatenating, implementation of parse_patch() and must stay byte
+# identical.
+_corpus_file = os.path.join(_test_patch_dir, 'parser-corpus.json')
+
+
+def digest(text):
+    if text is None:
+        return None
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def parser_corpus():
+    """Yield (name, text) tuples to feed to the patch parser"""
+
+    for filename in sorted(os.listdir(_test_patch_dir)):
+        if not filename.endswith('.patch'):
+            continue
+        patch = read_patch(filename, 'utf-8')
+        yield (filename, patch)
+        yield (filename + ':comment', 'Test comment\nmore comment\n' + patch)
+        yield (filename + ':signature', 'Test comment\n-- \nsig\n' + patch)
+        yield (filename + ':update',
+               'Test comment\n---\nUpdate: test update\n' + patch)
+        yield (filename + ':crlf', patch.replace('\n', '\r\n'))
+        yield (filename + ':twice', patch + patch)
+        yield (filename + ':no-newline', patch.rstrip('\n'))
+
+    for dirpath, _, filenames in sorted(os.walk(_test_mail_dir)):
+        for filename in sorted(filenames):
+            path = os.path.relpath(os.path.join(dirpath, filename),
+                                   _test_mail_dir)
+            mail = read_mail(path)
+            for i, part in enumerate(mail.walk()):
+                if part.get_content_maintype() != 'text':
+                    continue
+                payload = part.get_payload(decode=True)
+                yield ('%s:%d' % (path, i), payload.decode('utf-8', 'replace'))
+
+
+class ParsePatchCorpusTest(SimpleTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(ParsePatchCorpusTest, cls).setUpClass()
+        with open(_corpus_file) as f:
+            cls.expected = json.load(f)
+
+    def testCorpusComplete(self):
+        names = [name for (name, _) in parser_corpus()]
+        self.assertEqual(sorted(names), sorted(self.expected.keys()))
+
+    def testParsePatch(self):
+        for (name, text) in parser_corpus():
+            (patch, comment) = parse_patch(text)
+            self.assertEqual(digest(patch), self.expected[name]['patch'],
+                             name)
+            self.assertEqual(digest(comment), self.expected[name]['comment'],
+                             name)
+
+    def testHashPatch(self):
+        for (name, text) in parser_corpus():
+            (patch, _) = parse_patch(text)
+            if patch is None:
+                continue
+            self.assertEqual(hash_patch(patch).hexdigest(),
+                             self.expected[name]['hash'], name)
+
+    def testFilenames(self):
+        for (name, text) in parser_corpus():
+            (patch, _) = parse_patch(text)
+            if patch is None:
+                continue
+            self.assertEqual(patch_get_filenames(patch),
+                             self.expected[name]['filenames'], name)
+
+    def testSpans(self):
+        for (name, text) in parser_corpus():
+            (lines, patch, comment) = parse_patch_spans(text)
+            self.assertEqual(digest(join_spans(lines, patch)),
+                             self.expected[name]['patch'], name)
+            self.assertEqual(digest(join_spans(lines, comment)),
+                             self.expected[name]['comment'], name)
+            if not patch:
+                continue
+            self.assertEqual(hash_patch_spans(lines, patch).hexdigest(),
+                             self.expected[name]['hash'], name)
+            self.assertEqual(spans_get_filenames(lines, patch),
+                             self.expected[name]['filenames'], name)
+
+    def testAnalysePatch(self):
+        for (name, text) in parser_corpus():
+            analysis = analyse_patch(text)
+            self.assertEqual(digest(analysis.patch),
+                             self.expected[name]['patch'], name)
+            self.assertEqual(digest(analysis.comment),
+                             self.expected[name]['comment'], name)
+            if analysis.patch is None:
+                self.assertEqual(analysis.hash, None)
+                continue
+            self.assertEqual(analysis.hash.hexdigest(),
+                             self.expected[name]['hash'], name)
+            self.assertEqual(analysis.filenames,
+                             self.expected[name]['filenames'], name)
+
+
+class ParsePatchTest(SimpleTestCase):
+
+    def testEmpty(self):
+        self.assertEqual(parse_patch(''), (None, '\n'))
+
+    def testCommentOnly(self):
+        self.assertEqual(parse_patch('foo\nbar'), (None, 'foo\nbar\n'))
+
+    def testHashLeadingWhitespace(self):
+        patch = read_patch('0001-add-line.patch')
+        self.assertEqual(hash_patch('\n \n' + patch + '\n\n').hexdigest(),
+                         hash_patch(patch).hexdigest())
+
+
+class DiffstatTest(SimpleTestCase):
+
+    def testSingleFile(self):
+        analysis = analyse_patch(read_patch('0001-add-line.patch'))
+        self.assertEqual(list(analysis.diffstat.items()),
+                         [('meep.text', [1, 0])])
+
+    def testMultipleFiles(self):
+        mail = read_mail('0011-no-newline-at-end-of-file.mbox')
+        analysis = analyse_patch(mail.get_payload(decode=True).decode())
+        self.assertEqual(list(analysis.diffstat.items()), [
+            ('tools/testing/selftests/powerpc/Makefile', [1, 1]),
+            ('tools/testing/selftests/powerpc/vphn/vphn.c', [1, 0]),
+            ('tools/testing/selftests/powerpc/vphn/vphn.h', [1, 0]),
+        ])
+
+    def testDeletedFile(self):
+        patch = ('--- a/foo\n'
+                 '+++ /dev/null\n'
+                 '@@ -1,2 +0,0 @@\n'
+                 '--- not a header\n'
+                 '-bar\n')
+        analysis = analyse_patch(patch)
+        self.assertEqual(list(analysis.diffstat.items()), [('foo', [0, 2])])
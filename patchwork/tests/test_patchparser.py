@@ -18,17 +18,28 @@
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
 from email import message_from_string
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.utils import make_msgid
+import io
 
-from django.test import TestCase
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase, override_settings
 
 from patchwork.bin.parsemail import (find_content, find_author, find_project,
                                      parse_mail, split_prefixes, clean_subject,
-                                     parse_series_marker)
+                                     parse_series_marker, lock, save_author,
+                                     find_patch_by_refs, get_project_routes,
+                                     person_cache, PersonCache,
+                                     MailTooLarge, mail_headers,
+                                     DUPLICATE_MAIL)
+from patchwork.bin import parsemail
+from patchwork import ingeststats
+from patchwork.lock import release
 from patchwork.models import (Project, Person, Patch, Comment, State, EventLog,
-                              Event, SeriesRevision,
-                              get_default_initial_patch_state)
+                              Event, SeriesRevision, clear_caches,
+                              expire_caches, get_default_initial_patch_state)
 from patchwork.tests.utils import (read_patch, read_mail, create_email,
                                    defaults, create_user)
 
@@ -294,6 +305,97 @@ class SenderCorrelationTest(TestCase):
         self.person.delete()
 
 
+class PersonCacheTest(TransactionTestCase):
+    sender = 'Cached Sender <cached@example.com>'
+
+    def mail(self, sender):
+        return message_from_string('Message-Id: %s\n' % make_msgid() +
+                                   'From: %s\n' % sender +
+                                   'Subject: Tests\n\ntest\n')
+
+    def setUp(self):
+        person_cache.clear()
+
+    def tearDown(self):
+        person_cache.clear()
+
+    def testEmailLower(self):
+        person = Person(email='Mixed.Case@Example.com')
+        person.save()
+        self.assertEqual(person.email_lower, 'mixed.case@example.com')
+
+    def testCacheHit(self):
+        (person, _) = find_author(self.mail(self.sender))
+        person = save_author(person)
+
+        mail = self.mail('Cached Sender <CACHED@example.com>')
+        with self.assertNumQueries(0):
+            (cached, save_required) = find_author(mail)
+        self.assertEqual(cached.pk, person.pk)
+        self.assertFalse(save_required)
+
+    def testUpdateName(self):
+        (person, _) = find_author(self.mail(self.sender))
+        person = save_author(person)
+
+        (renamed, save_required) = find_author(
+            self.mail('New Name <cached@example.com>'))
+        self.assertTrue(save_required)
+        # the cached person is only renamed once saved
+        self.assertEqual(find_author(self.mail(self.sender)),
+                         (person, False))
+        save_author(renamed)
+        self.assertEqual(Person.objects.get(pk=person.pk).name, 'New Name')
+        (cached, save_required) = find_author(
+            self.mail('New Name <cached@example.com>'))
+        self.assertFalse(save_required)
+
+    def testRollback(self):
+        try:
+            with transaction.atomic():
+                (person, _) = find_author(self.mail(self.sender))
+                save_author(person)
+                raise ValueError
+        except ValueError:
+            pass
+
+        self.assertEqual(person_cache.get('cached@example.com'), None)
+        (person, save_required) = find_author(self.mail(self.sender))
+        self.assertTrue(save_required)
+        self.assertEqual(person.pk, None)
+
+    def testDelete(self):
+        (person, _) = find_author(self.mail(self.sender))
+        person = save_author(person)
+        person.delete()
+        (person, save_required) = find_author(self.mail(self.sender))
+        self.assertTrue(save_required)
+
+    def testEviction(self):
+        cache = PersonCache(2)
+        people = [Person(email='%d@example.com' % i, email_lower=str(i))
+                  for i in range(3)]
+        cache.add(people[0])
+        cache.add(people[1])
+        cache.get('0')
+        cache.add(people[2])
+        self.assertEqual(cache.get('0'), people[0])
+        self.assertEqual(cache.get('1'), None)
+        self.assertEqual(cache.get('2'), people[2])
+
+    def testExpiry(self):
+        (person, _) = find_author(self.mail(self.sender))
+        person = save_author(person)
+        # renamed by another process
+        Person.objects.filter(pk=person.pk).update(name='New Name')
+
+        with override_settings(CONFIG_CACHE_TIMEOUT=0):
+            expire_caches()
+        (person, save_required) = find_author(
+            self.mail('New Name <cached@example.com>'))
+        self.assertFalse(save_required)
+
+
 class MultipleProjectPatchTest(TestCase):
     """ Test that patches sent to multiple patchwork projects are
         handled correctly """
@@ -507,6 +609,197 @@ class MultipleProjectsPerMailingListTest(TestCase):
         self.assertEquals(patch.name, 'Subject')
 
 
+class ProjectRoutesTest(TestCase):
+    """Is the list-id -> project routing table kept up to date?"""
+
+    def setUp(self):
+        self.project1 = Project(linkname='test-project-1', name='Project 1',
+                                listid='list.example.com',
+                                listemail='1@example.com')
+        self.project1.save()
+        self.project2 = Project(linkname='test-project-2', name='Project 2',
+                                listid='list.example.com',
+                                listemail='2@example.com',
+                                subject_prefix_tags='i-g-t, igt')
+        self.project2.save()
+
+    def testRoutes(self):
+        routes = get_project_routes()
+        self.assertEquals(routes.get('list.example.com'),
+                          [(self.project1, []),
+                           (self.project2, ['i-g-t', 'igt'])])
+        self.assertEquals(routes.get('other.example.com'), [])
+
+    def testNoQueries(self):
+        email = create_email(defaults.patch, project=self.project1,
+                             subject='[PATCH igt] Subject')
+        self.assertEquals(find_project(email), self.project2)
+        with self.assertNumQueries(0):
+            self.assertEquals(find_project(email), self.project2)
+
+    def testInvalidateOnSave(self):
+        routes = get_project_routes()
+        self.project2.subject_prefix_tags = 'foo'
+        self.project2.save()
+        self.assertTrue(get_project_routes() is not routes)
+
+        email = create_email(defaults.patch, project=self.project1,
+                             subject='[PATCH foo] Subject')
+        self.assertEquals(find_project(email), self.project2)
+
+    def testInvalidateOnDelete(self):
+        email = create_email(defaults.patch, project=self.project1,
+                             subject='[PATCH i-g-t] Subject')
+        self.assertEquals(find_project(email), self.project2)
+        self.project2.delete()
+        self.assertEquals(find_project(email), self.project1)
+
+    def testExpiry(self):
+        clear_caches()
+        email = create_email(defaults.patch, project=self.project1)
+        email.replace_header('List-Id', '<new.example.com>')
+        self.assertEquals(find_project(email), None)
+        # a project changed by another process, which the signals of this
+        # one don't see
+        Project.objects.filter(pk=self.project1.pk).update(
+            listid='new.example.com')
+
+        expire_caches()
+        self.assertEquals(find_project(email), None)
+        with override_settings(CONFIG_CACHE_TIMEOUT=0):
+            expire_caches()
+        self.assertEquals(find_project(email), self.project1)
+
+
+class ReadMailTest(TestCase):
+    fixtures = ['default_states', 'default_events']
+
+    def setUp(self):
+        defaults.project.save()
+
+    def attachment_mail(self, patch):
+        mail = MIMEMultipart()
+        mail['Subject'] = 'Test Subject'
+        mail['From'] = defaults.sender
+        mail['List-Id'] = defaults.project.listid
+        mail['Message-Id'] = make_msgid()
+        mail.attach(MIMEText('comment\n'))
+        mail.attach(MIMEText(patch, 'x-patch'))
+        mail.attach(MIMEApplication(b'\0' * 100000))
+        return mail
+
+    def testChunks(self):
+        mail = self.attachment_mail(defaults.patch)
+        data = mail.as_string().encode('utf-8')
+        chunk_size = parsemail.READ_CHUNK_SIZE
+        parsemail.READ_CHUNK_SIZE = 1000
+        try:
+            parsed = parsemail.read_mail(io.BytesIO(data))
+        finally:
+            parsemail.READ_CHUNK_SIZE = chunk_size
+
+        self.assertEqual(mail_headers(parsed), mail_headers(mail))
+        parts = list(parsed.walk())
+        self.assertEqual(parts[2].get_payload(decode=True).decode('utf-8'),
+                         defaults.patch)
+        # the payload of the binary attachment isn't kept
+        self.assertEqual(parts[3].get_payload(), '')
+
+        parse_mail(parsed)
+        self.assertEqual(Patch.objects.get().content, defaults.patch)
+
+    def testTooLarge(self):
+        data = self.attachment_mail(defaults.patch).as_string()
+        f = io.BytesIO(data.encode('utf-8'))
+        self.assertRaises(MailTooLarge, parsemail.read_mail, f, 1000)
+        # the whole mail has been read
+        self.assertEqual(f.read(), b'')
+
+        f = io.BytesIO(data.encode('utf-8'))
+        self.assertTrue(parsemail.read_mail(f, len(data)) is not None)
+
+    def testUnencoded8bitHeaders(self):
+        data = (u'From: J\xf6rg Foo <jorg@example.com>\n'
+                u'Subject: [PATCH] f\xe9e\n'
+                u'Message-Id: <8bit@example.com>\n'
+                u'List-Id: Liste f\xfcr <%s>\n\n%s' %
+                (defaults.project.listid, defaults.patch)).encode('utf-8')
+        parse_mail(parsemail.read_mail(io.BytesIO(data)))
+        patch = Patch.objects.get()
+        self.assertEqual(patch.name, u'f\xe9e')
+        self.assertEqual(patch.submitter.name, u'J\xf6rg Foo')
+
+        # not UTF-8
+        data = data.replace(b'f\xc3\xa9e', b'f\xe9e').replace(b'<8bit@',
+                                                               b'<latin@')
+        parse_mail(parsemail.read_mail(io.BytesIO(data)))
+        self.assertEqual(Patch.objects.get(msgid='<latin@example.com>').name,
+                         u'f\xe9e')
+
+    @override_settings(PARSEMAIL_MAX_PART_SIZE=1000)
+    def testPartTooLarge(self):
+        patch = defaults.patch + '+a\n' * 1000
+        parse_mail(self.attachment_mail(patch))
+        self.assertEqual(Patch.objects.count(), 0)
+        self.assertEqual(Comment.objects.count(), 0)
+
+        parse_mail(self.attachment_mail(defaults.patch))
+        self.assertEqual(Patch.objects.count(), 1)
+
+
+class DuplicateMailTest(TestCase):
+    fixtures = ['default_states', 'default_events']
+
+    def setUp(self):
+        defaults.project.save()
+        ingeststats.histogram.reset()
+
+    def testPatch(self):
+        mail = create_email(defaults.patch)
+        self.assertEqual(parse_mail(mail), 0)
+        # two lookups, in the savepoint of the parse transaction
+        with self.assertNumQueries(4):
+            self.assertEqual(parse_mail(mail), DUPLICATE_MAIL)
+        self.assertEqual(Patch.objects.count(), 1)
+        self.assertEqual(ingeststats.histogram.counters['duplicate'], 1)
+
+    def testConcurrentDelivery(self):
+        mail = create_email(defaults.patch)
+
+        # the same mail is parsed while this delivery waits for the lock
+        def lock_after_delivery(project=None):
+            parsemail.lock = lock
+            self.assertEqual(parse_mail(mail), 0)
+            return lock(project)
+        self.addCleanup(setattr, parsemail, 'lock', lock)
+        parsemail.lock = lock_after_delivery
+
+        self.assertEqual(parse_mail(mail), DUPLICATE_MAIL)
+        self.assertEqual(Patch.objects.count(), 1)
+
+    def testComment(self):
+        patch = create_email(defaults.patch)
+        comment = create_email('comment', in_reply_to=patch['Message-Id'])
+        for mail in (patch, comment, comment):
+            parse_mail(mail)
+        self.assertEqual(parse_mail(comment), DUPLICATE_MAIL)
+        self.assertEqual(Comment.objects.count(), 2)
+        self.assertEqual(ingeststats.histogram.counters['duplicate'], 2)
+
+    def testOtherProject(self):
+        project = Project(linkname='test-project-2', name='Project 2',
+                          listid='list2.example.com',
+                          listemail='2@example.com')
+        project.save()
+        mail = create_email(defaults.patch)
+        self.assertEqual(parse_mail(mail), 0)
+
+        del mail['List-Id']
+        mail['List-Id'] = project.listid
+        self.assertEqual(parse_mail(mail), 0)
+        self.assertEqual(Patch.objects.count(), 2)
+
+
 class MBoxPatchTest(PatchTest):
 
     def setUp(self):
@@ -989,3 +1282,109 @@ class SubjectTest(TestCase):
                          ('[bar] meep', ['bar']))
         self.assertEqual(clean_subject('[FOO] [bar] meep', ['foo']),
                          ('[bar] meep', ['bar']))
+
+
+class ParsemailLockTest(TestCase):
+
+    def setUp(self):
+        self.p1 = Project(linkname='test-project-1', name='Project 1',
+                          listid='1.example.com')
+        self.p2 = Project(linkname='test-project-2', name='Project 2',
+                          listid='2.example.com')
+
+    def testProjectScope(self):
+        lk1 = lock(self.p1)
+        lk2 = lock(self.p2)
+        try:
+            self.assertNotEqual(lk1.f, lk2.f)
+            # taking the lock again in the same process is fine
+            self.assertIs(lock(self.p1), lk1)
+            self.assertEqual(lk1.held, 2)
+            release(lk1)
+        finally:
+            release(lk1, lk2)
+        self.assertFalse(lk1.held)
+
+    @override_settings(PARSEMAIL_LOCK_SCOPE='global')
+    def testGlobalScope(self):
+        lk1 = lock(self.p1)
+        lk2 = lock(self.p2)
+        try:
+            self.assertIs(lk1, lk2)
+            self.assertIs(lock(), lk1)
+            release(lk1)
+        finally:
+            release(lk1, lk2)
+
+
+class SaveAuthorTest(TestCase):
+
+    def testNewPerson(self):
+        author = save_author(Person(name='Foo', email='foo@example.com'))
+        self.assertEqual(Person.objects.get(pk=author.pk).name, 'Foo')
+
+    def testConcurrentPerson(self):
+        (author, save_required) = find_author(
+            create_email('test', sender='Foo <foo@example.com>'))
+        self.assertTrue(save_required)
+
+        # someone else created the same person in the meantime
+        person = Person(name='Bar', email='foo@example.com')
+        person.save()
+
+        self.assertEqual(save_author(author), person)
+        self.assertEqual(Person.objects.count(), 1)
+        self.assertEqual(Person.objects.get().name, 'Foo')
+
+
+class FindPatchByRefsTest(TestCase):
+    fixtures = ['default_states']
+
+    def setUp(self):
+        self.project = defaults.project
+        self.project.save()
+        self.person = defaults.patch_author_person
+        self.person.save()
+        self.patch_1 = self.create_patch('patch-1')
+        self.patch_2 = self.create_patch('patch-2')
+        Comment(patch=self.patch_2, msgid='comment-2',
+                submitter=self.person, content='').save()
+
+    def create_patch(self, msgid):
+        patch = Patch(project=self.project, msgid=msgid, name=msgid,
+                      submitter=self.person, content='')
+        patch.save()
+        return patch
+
+    def testNoRefs(self):
+        self.assertEqual(find_patch_by_refs(self.project, []), None)
+        self.assertEqual(find_patch_by_refs(self.project, ['foo', 'bar'],
+                                            comments=True), None)
+
+    def testPatch(self):
+        with self.assertNumQueries(1):
+            patch = find_patch_by_refs(self.project,
+                                       ['foo', 'patch-2', 'patch-1'])
+        self.assertEqual(patch, self.patch_2)
+
+    def testComment(self):
+        refs = ['foo', 'comment-2', 'patch-1']
+        self.assertEqual(find_patch_by_refs(self.project, refs),
+                         self.patch_1)
+        with self.assertNumQueries(3):
+            patch = find_patch_by_refs(self.project, refs, comments=True)
+        self.assertEqual(patch, self.patch_2)
+
+    def testPatchBeforeComment(self):
+        refs = ['patch-1', 'comment-2']
+        with self.assertNumQueries(1):
+            patch = find_patch_by_refs(self.project, refs, comments=True)
+        self.assertEqual(patch, self.patch_1)
+
+    def testOtherProject(self):
+        project = Project(linkname='other', name='Other',
+                          listid='other.example.com')
+        project.save()
+        self.assertEqual(find_patch_by_refs(project, ['patch-1',
+                                                      'comment-2'],
+                                            comments=True), None)
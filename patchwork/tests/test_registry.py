@@ -0,0 +1,62 @@
+# Patchwork - automated patch tracking system
+# Copyright (C) 2018 Intel Corporation
+#
+# This file is part of the Patchwork package.
+#
+# Patchwork is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Patchwork is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Patchwork; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+from django.test import TestCase
+
+from patchwork.bin.parsemail import get_state
+from patchwork.models import (Event, State, Tag,
+                              get_default_initial_patch_state)
+from patchwork.tests.utils import defaults
+
+
+class RegistryTest(TestCase):
+    fixtures = ['default_states', 'default_events', 'default_tags']
+
+    def testNoQueries(self):
+        get_default_initial_patch_state()
+        Event.from_string('series-new-revision')
+        with self.assertNumQueries(0):
+            self.assertEqual(get_default_initial_patch_state().ordering, 0)
+            self.assertEqual(get_state('accepted').name, 'Accepted')
+            self.assertEqual(get_state('foo').ordering, 0)
+            self.assertEqual(Event.from_string('series-new-revision').name,
+                             'series-new-revision')
+
+    def testMissing(self):
+        self.assertRaises(State.DoesNotExist, State.from_string, 'foo')
+        self.assertRaises(Event.DoesNotExist, Event.from_string, 'foo')
+
+    def testInvalidation(self):
+        state = State.from_string('New')
+        state.name = 'Fresh'
+        state.save()
+        self.assertEqual(get_default_initial_patch_state().name, 'Fresh')
+
+        State.objects.create(name='Later', ordering=100)
+        self.assertEqual(State.from_string('later').ordering, 100)
+
+        State.objects.get(name='Later').delete()
+        self.assertRaises(State.DoesNotExist, State.from_string, 'later')
+
+    def testTags(self):
+        defaults.project.save()
+        n_tags = len(defaults.project.tag_matcher.tags)
+        Tag.objects.create(name='Tested-by', pattern='^Tested-by:',
+                           abbrev='X')
+        self.assertEqual(len(defaults.project.tag_matcher.tags), n_tags + 1)
@@ -0,0 +1,150 @@
+# Patchwork - automated patch tracking system
+# Copyright (C) 2018 Intel Corporation
+#
+# This file is part of the Patchwork package.
+#
+# Patchwork is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Patchwork is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Patchwork; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import importlib
+import json
+
+from django.apps import apps
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils.six import StringIO
+
+from patchwork import search
+from patchwork.models import Comment, Patch
+from patchwork.tests.utils import defaults
+
+
+class SearchTest(TestCase):
+    fixtures = ['default_states']
+
+    def setUp(self):
+        defaults.project.save()
+        defaults.patch_author_person.save()
+        self.patches = []
+        for (i, (name, message)) in enumerate([
+                ('drm/i915: Fix the panel', 'Wait for the backlight.'),
+                ('net: Add a driver', 'Supports the foo_bar chips.'),
+                ('drm: Clean up', 'No functional change.')]):
+            patch = Patch(project=defaults.project, msgid='<%d@a>' % i,
+                          name=name, submitter=defaults.patch_author_person,
+                          content='')
+            patch.save()
+            Comment(patch=patch, msgid=patch.msgid, content=message,
+                    submitter=defaults.patch_author_person).save()
+            self.patches.append(patch)
+
+    def search(self, query):
+        return list(Patch.objects.filter(pk__in=search.matching(query))
+                                 .order_by('pk'))
+
+    def assertMatches(self, query, indexes):
+        self.assertEqual(self.search(query),
+                         [self.patches[i] for i in indexes])
+
+    def testName(self):
+        self.assertMatches('drm', [0, 2])
+        self.assertMatches('DRM panel', [0])
+        self.assertMatches('drm/i915', [0])
+        self.assertMatches('usb', [])
+        # words match as prefixes
+        self.assertMatches('dr', [0, 1, 2])
+        self.assertMatches('i91 fi', [0])
+
+    def testComments(self):
+        self.assertMatches('backlight', [0])
+        self.assertMatches('foo_bar', [1])
+        self.assertMatches('"functional', [2])
+        Comment(patch=self.patches[1], msgid='<reply@a>',
+                content='The backlight looks fine.',
+                submitter=defaults.patch_author_person).save()
+        self.assertMatches('backlight', [0, 1])
+
+    def testUpdates(self):
+        patch = self.patches[2]
+        patch.name = 'usb: Clean up'
+        patch.save()
+        self.assertMatches('usb', [2])
+        self.assertMatches('drm', [0])
+
+        Comment.objects.get(patch=patch).delete()
+        self.assertMatches('functional', [])
+
+        self.patches[0].delete()
+        self.assertMatches('backlight', [])
+
+    def testStateChange(self):
+        patch = Patch.objects.get(pk=self.patches[1].pk)
+        patch.archived = True
+        with CaptureQueriesContext(connection) as queries:
+            patch.save()
+        self.assertFalse([query for query in queries
+                          if search.TABLE in query['sql']])
+
+    def testNoIndex(self):
+        matching = search.SearchBackend().matching('DRM up')
+        self.assertEqual(list(Patch.objects.filter(pk__in=matching)),
+                         [self.patches[2]])
+        matching = search.SearchBackend().matching('backlight')
+        self.assertEqual(list(Patch.objects.filter(pk__in=matching)),
+                         [self.patches[0]])
+
+    def testEmptyQuery(self):
+        self.assertMatches(' - ', [])
+
+    def testList(self):
+        url = '/project/%s/list/' % defaults.project.linkname
+        response = self.client.get(url, {'q': 'backlight'})
+        self.assertContains(response, 'drm/i915: Fix the panel')
+        self.assertNotContains(response, 'net: Add a driver')
+
+    def testREST(self):
+        response = self.client.get('/api/1.0/patches/',
+                                   {'search': 'drm clean'})
+        results = json.loads(response.content.decode())['results']
+        self.assertEqual([patch['id'] for patch in results],
+                         [self.patches[2].pk])
+
+    def testRebuild(self):
+        backend = search.get_backend()
+        with connection.cursor() as cursor:
+            for sql in backend.drop_sql() + backend.create_sql():
+                cursor.execute(sql)
+        if backend.create_sql():
+            self.assertMatches('drm', [])
+
+        # new comments of patches that aren't indexed index them
+        Comment(patch=self.patches[1], msgid='<reply@a>', content='Thanks',
+                submitter=defaults.patch_author_person).save()
+        self.assertMatches('foo_bar thanks', [1])
+
+        call_command('rebuild_search_index', stdout=StringIO())
+        self.assertMatches('drm', [0, 2])
+        self.assertMatches('foo_bar', [1])
+
+    def testMigration(self):
+        # the migration creating the index indexes the existing patches
+        migration = importlib.import_module(
+            'patchwork.migrations.0033_patch_search')
+        with connection.schema_editor() as schema_editor:
+            migration.drop_index(apps, schema_editor)
+            migration.create_index(apps, schema_editor)
+        self.assertMatches('drm', [0, 2])
+        self.assertMatches('foo_bar', [1])
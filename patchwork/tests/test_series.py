@@ -17,13 +17,17 @@
 # along with Patchwork; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
+from importlib import import_module
 import os
 
+from django.apps import apps
 from django.test import TestCase
 
+from patchwork import deferred
 from patchwork.models import (Patch, Series, SeriesRevision, Project,
                               SERIES_DEFAULT_NAME, EventLog, User, Person,
-                              State, RevisionState)
+                              State, RevisionState, ThreadIndex,
+                              set_series_ids)
 from patchwork.tests.utils import read_mail
 from patchwork.tests.utils import defaults, TestSeries
 
@@ -198,6 +202,40 @@ class BasicGeneratedSeriesTests(GeneratedSeriesTest):
         self.assertEquals(str(revision), 'Revision 1')
 
 
+class DuplicateRevisionTest(GeneratedSeriesTest):
+
+    def setUp(self):
+        super(DuplicateRevisionTest, self).setUp()
+        (series, mails) = self._create_series(30)
+        series.insert(mails)
+        self.revision = SeriesRevision.objects.get()
+
+    def testDuplicate(self):
+        # the number of queries doesn't depend on the number of patches
+        with self.assertNumQueries(13):
+            new = self.revision.duplicate()
+
+        self.assertEquals(new.version, 2)
+        self.assertEquals(list(new.ordered_patches()),
+                          list(self.revision.ordered_patches()))
+        new = SeriesRevision.objects.get(pk=new.pk)
+        self.assertEquals(new.state, RevisionState.INITIAL)
+        self.check_revision_summary(new, {'New': 30})
+        self.assertEquals(new.series.last_revision, new)
+        self.assertEquals(EventLog.objects.filter(
+            event__name='series-new-revision').count(), 2)
+
+    def testDuplicateExclude(self):
+        new = self.revision.duplicate(exclude_patches=(3,))
+
+        orders = new.seriesrevisionpatch_set.values_list('order', flat=True)
+        self.assertEquals(len(orders), 29)
+        self.assertNotIn(3, orders)
+        new = SeriesRevision.objects.get(pk=new.pk)
+        self.assertEquals(new.state, RevisionState.INCOMPLETE)
+        self.assertEquals(new.series.last_revision, self.revision)
+
+
 class SeriesViewTest(GeneratedSeriesTest):
 
     def testSeriesIdNotInteger(self):
@@ -382,6 +420,46 @@ class ReferencesListTest(TestCase):
                            mails[2].get('Message-Id'),
                            mails[0].get('Message-Id')])
 
+        # the whole list is a single query away
+        with self.assertNumQueries(1):
+            build_references_list(patch_v3)
+
+    def testOutOfOrder(self):
+        """Mails received before their parent learn the rest of the thread
+        once the parent is received"""
+        # patches sent with --chain-reply-to, only referencing their parent
+        series = TestSeries(3, has_cover_letter=False)
+        patch_1 = series.create_patch(1)
+        patch_2 = series.create_patch(2, in_reply_to=patch_1)
+        patch_3 = series.create_patch(3, in_reply_to=patch_2)
+        reply = series.create_reply(patch_3,
+                                    references=patch_3.get('Message-Id'))
+
+        series.insert([patch_1, patch_3, patch_2])
+        self.assertEquals(build_references_list(reply),
+                          [patch_3.get('Message-Id'),
+                           patch_2.get('Message-Id'),
+                           patch_1.get('Message-Id')])
+
+    def testIndexMigration(self):
+        series = TestSeries(3)
+        mails = series.create_mails()
+        reply_1 = series.create_reply(mails[2])
+        reply_2 = series.create_reply(reply_1,
+                                      references=reply_1.get('Message-Id'))
+        mails += [reply_1, reply_2]
+        series.insert(mails)
+
+        fields = ('msgid', 'parent_msgid', 'root_msgid', 'references')
+        index = sorted(ThreadIndex.objects.values_list(*fields))
+        self.assertEquals(len(index), 5)
+
+        ThreadIndex.objects.all().delete()
+        migration = import_module('patchwork.migrations.0030_threadindex')
+        migration.index_threads(apps, None)
+        self.assertEquals(sorted(ThreadIndex.objects.values_list(*fields)),
+                          index)
+
 #
 # New version of a single patch
 #
@@ -726,6 +804,21 @@ class FullSeriesUpdateTest(GeneratedSeriesTest):
     def testNewSeriesDifferentNumberOfPatches(self):
         self._test_internal((3, 7), ('Awesome series', 'Awesome series v2'))
 
+    def testNewSeriesRenamed(self):
+        (series1, series1_mails) = self._create_series(3)
+        series1.insert(series1_mails)
+        series = Series.objects.get()
+        series.name = 'Renamed Series'
+        series.save()
+        self.assertEquals(series.name_lower, 'renamed series')
+
+        (series2, series2_mails) = self._create_series(3)
+        self._set_cover_letter_subject(series2_mails[0], 3,
+                                       'renamed series v2')
+        series2.insert(series2_mails)
+
+        self.check(series1_mails, series2_mails, (3, 3))
+
 
 class SeriesStateTest(GeneratedSeriesTest):
 
@@ -833,3 +926,52 @@ class StateChangeEventLogTest(Series0010):
             update_count += 1
         stateChangeLogCount = EventLog.objects.filter(event_id=2).count()
         self.assertEquals(update_count, stateChangeLogCount)
+
+    def testStateChangeQueries(self):
+        series = Series.objects.get()
+        patch = Patch.objects.all()[0]
+        set_series_ids([patch])
+        old_state = patch.state
+        new_state = State.objects.exclude(pk=old_state.pk)[0]
+        patch.project
+
+        # no need to fetch the patch again to find out its previous state,
+        # or to look its series up
+        with deferred.collect():
+            with self.assertNumQueries(3):
+                patch.state = new_state
+                patch.save()
+            deferred.discard(('revision_state', series.last_revision_id))
+
+        logs = EventLog.objects.filter(event__name='patch-state-change')
+        self.assertEquals(logs.count(), 1)
+        self.assertEquals(logs[0].series, series)
+        self.assertEquals(logs[0].parameters['previous_state'],
+                          old_state.name)
+
+        # the patch knows its new state
+        patch.save()
+        self.assertEquals(logs.count(), 1)
+        # the series looked up by set_series_ids() is only used for a save
+        with deferred.collect():
+            with self.assertNumQueries(4):
+                patch.state = old_state
+                patch.save()
+            deferred.discard(('revision_state', series.last_revision_id))
+        self.assertEquals(logs.count(), 2)
+        self.assertEquals(logs[1].series, series)
+
+    def testSetSeriesIds(self):
+        series = Series.objects.get()
+        patches = list(Patch.objects.all())
+        patch = Patch(project=defaults.project, msgid='<no-series@a>',
+                      name='no series', submitter=patches[0].submitter,
+                      state=patches[0].state)
+        patch.save()
+        patch = Patch.objects.get(pk=patch.pk)
+        with self.assertNumQueries(1):
+            set_series_ids(patches + [patch])
+        self.assertEquals([p._series_id() for p in patches],
+                          [series.pk] * len(patches))
+        with self.assertNumQueries(0):
+            self.assertEquals(patch._series_id(), None)
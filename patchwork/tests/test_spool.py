@@ -0,0 +1,145 @@
+# Patchwork - automated patch tracking system
+# Copyright (C) 2018 Intel Corporation
+#
+# This file is part of the Patchwork package.
+#
+# Patchwork is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Patchwork is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Patchwork; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import os
+import shutil
+import tempfile
+import time
+
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from patchwork.lock import release
+from patchwork.models import Patch, SeriesRevision
+from patchwork.spool import Spool, SpoolError, key_of, thread_key
+from patchwork.tasks import parse_spooled_mail
+from patchwork.tests.utils import create_email, defaults, TestSeries
+
+
+def mail_data(mail):
+    return mail.as_string().encode('utf-8')
+
+
+class SpoolTest(SimpleTestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.spool = Spool(self.path)
+        self.parsed = []
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def parse(self, f):
+        data = f.read()
+        if data == b'fail':
+            raise ValueError
+        self.parsed.append(data)
+
+    def testNotConfigured(self):
+        with override_settings(PARSEMAIL_SPOOL_DIR=None):
+            self.assertRaises(SpoolError, Spool)
+
+    def testThreadKey(self):
+        patch = b'Message-Id: <1@a>\n\nfoo\n'
+        reply = b'Message-Id: <3@a>\nIn-Reply-To: <2@a>\n' \
+                b'References: <1@a> <2@a>\n\nbar\n'
+        other = b'Message-Id: <4@a>\r\n\r\nReferences: <1@a>\r\n'
+        self.assertEqual(thread_key(patch), thread_key(reply))
+        self.assertNotEqual(thread_key(patch), thread_key(other))
+
+    def testOrder(self):
+        names = [self.spool.accept(data) for data in (b'1', b'2', b'3')]
+        self.assertEqual(self.spool.list(), names)
+        self.assertEqual(self.spool.list('tmp'), [])
+
+        key = key_of(names[0])
+        self.assertEqual(self.spool.keys(), [key])
+        self.assertEqual(self.spool.process(key, self.parse), 3)
+        self.assertEqual(self.parsed, [b'1', b'2', b'3'])
+        self.assertEqual(self.spool.list(), [])
+        self.assertEqual(self.spool.list('cur'), [])
+
+    def testFailed(self):
+        name = self.spool.accept(b'fail')
+        self.spool.process(key_of(name), self.parse)
+        self.assertEqual(self.spool.list('failed'), [name])
+        error_path = os.path.join(self.spool.dir('failed'), name + '.error')
+        with open(error_path) as f:
+            self.assertIn('ValueError', f.read())
+
+        self.assertEqual(self.spool.retry(), [key_of(name)])
+        self.assertEqual(self.spool.list(), [name])
+        self.assertEqual(self.spool.list('failed'), [])
+        self.assertFalse(os.path.exists(error_path))
+        self.assertRaises(SpoolError, self.spool.retry, [name])
+
+    def testRecover(self):
+        name = self.spool.accept(b'1')
+        self.assertTrue(self.spool.claim(name))
+        self.assertFalse(self.spool.claim(name))
+        self.assertEqual(self.spool.recover(), [])
+
+        cur_path = os.path.join(self.spool.dir('cur'), name)
+        old = time.time() - 7200
+        os.utime(cur_path, (old, old))
+        self.assertEqual(self.spool.recover(), [key_of(name)])
+        self.assertEqual(self.spool.list(), [name])
+
+
+class ParseSpooledMailTest(TestCase):
+    fixtures = ['default_states', 'default_events']
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.settings = override_settings(PARSEMAIL_SPOOL_DIR=self.path)
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        shutil.rmtree(self.path)
+
+    def testLockHeld(self):
+        defaults.project.save()
+        spool = Spool()
+        name = spool.accept(mail_data(create_email(defaults.patch)))
+
+        # the retries give up, leaving the mail in the spool
+        lk = spool.lock(key_of(name))
+        try:
+            result = parse_spooled_mail.apply(args=[key_of(name)])
+        finally:
+            release(lk)
+        self.assertEqual(result.state, 'FAILURE')
+        self.assertEqual(spool.list(), [name])
+        self.assertEqual(Patch.objects.count(), 0)
+
+    def testSeries(self):
+        defaults.project.save()
+        spool = Spool()
+        names = [spool.accept(mail_data(mail))
+                 for mail in TestSeries(3).create_mails()]
+        self.assertEqual(spool.keys(), [key_of(names[0])])
+
+        parse_spooled_mail(key_of(names[0]))
+
+        self.assertEqual(spool.list(), [])
+        self.assertEqual(spool.list('failed'), [])
+        revision = SeriesRevision.objects.get()
+        self.assertEqual(revision.patches.count(), 3)
+        self.assertEqual(Patch.objects.count(), 3)
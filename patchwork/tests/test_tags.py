@@ -19,10 +19,14 @@
 
 import datetime
 
+from django.db import connection
 from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 
-from patchwork.models import Project, Patch, Comment, Tag, PatchTag
-from patchwork.parser import extract_tags
+from patchwork import deferred
+from patchwork.models import (Project, Patch, Comment, Tag, PatchTag,
+                              set_tag_counts)
+from patchwork.parser import extract_tags, TagMatcher
 from patchwork.tests.utils import defaults
 
 
@@ -79,6 +83,70 @@ class ExtractTagsTest(TestCase):
         self.assertTagsEqual("> Acked-by: %s\n" % self.name_email, 0, 0, 0)
 
 
+class TagMatcherTest(TestCase):
+    fixtures = ['default_tags']
+
+    def testSingleScan(self):
+        matcher = TagMatcher(Tag.objects.all())
+        self.assertTrue(matcher._regex is not None)
+        counts = matcher.count("Acked-by: a\nReviewed-by: b\nAcked-by: c\n")
+        self.assertEqual(counts[Tag.objects.get(name='Acked-by')], 2)
+        self.assertEqual(counts[Tag.objects.get(name='Reviewed-by')], 1)
+        self.assertEqual(counts[Tag.objects.get(name='Tested-by')], 0)
+
+    def testNoTags(self):
+        self.assertEqual(TagMatcher([]).count("Acked-by: a\n"), {})
+
+    def testGroupsInPattern(self):
+        tag = Tag(name='Fixes', pattern='^(Fixes|Closes):', abbrev='F')
+        tag.save()
+        matcher = TagMatcher(Tag.objects.all())
+        counts = matcher.count("Closes: x\nAcked-by: a\nFixes: y\n")
+        self.assertEqual(counts[tag], 2)
+        self.assertEqual(counts[Tag.objects.get(name='Acked-by')], 1)
+
+    def testUnmergeablePattern(self):
+        tag = Tag(name='Twice', pattern=r'^(\w+) \1$', abbrev='2')
+        tag.save()
+        matcher = TagMatcher(Tag.objects.all())
+        self.assertTrue(matcher._regex is None)
+        counts = matcher.count("foo foo\nAcked-by: a\nfoo bar\n")
+        self.assertEqual(counts[tag], 1)
+        self.assertEqual(counts[Tag.objects.get(name='Acked-by')], 1)
+
+
+class ProjectTagMatcherTest(TestCase):
+    fixtures = ['default_tags']
+
+    def setUp(self):
+        self.project = Project(linkname='test-project', name='Test Project',
+                               use_tags=True)
+        self.project.save()
+
+    def testShared(self):
+        self.project.tag_matcher
+        project = Project.objects.get(pk=self.project.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(len(project.tags), 3)
+            self.assertTrue(project.tag_matcher is self.project.tag_matcher)
+
+    def testTagChange(self):
+        self.assertEqual(len(self.project.tag_matcher.tags), 3)
+        tag = Tag(name='Fixes', pattern='^Fixes:', abbrev='F')
+        tag.save()
+        self.assertEqual(len(self.project.tag_matcher.tags), 4)
+        tag.delete()
+        self.assertEqual(len(self.project.tag_matcher.tags), 3)
+
+    def testUseTagsChange(self):
+        self.assertEqual(len(self.project.tag_matcher.tags), 3)
+        self.project.use_tags = False
+        self.project.save()
+        project = Project.objects.get(pk=self.project.pk)
+        self.assertEqual(project.tag_matcher.tags, [])
+        self.assertEqual(project.tags, [])
+
+
 class PatchTagsTest(TransactionTestCase):
     ACK = 1
     REVIEW = 2
@@ -188,6 +256,57 @@ class PatchTagsTest(TransactionTestCase):
         c1.save()
         self.assertTagsEqual(self.patch, 1, 1, 0)
 
+    def testCommentMove(self):
+        patch = Patch(project=self.patch.project, msgid='y',
+                      name=defaults.patch_name,
+                      submitter=defaults.patch_author_person, content='')
+        patch.save()
+        comment = self.create_tag_comment(self.patch, self.ACK)
+        self.create_tag_comment(patch, self.REVIEW)
+
+        comment = Comment.objects.get(pk=comment.pk)
+        comment.patch = patch
+        comment.save()
+        self.assertTagsEqual(self.patch, 0, 0, 0)
+        self.assertTagsEqual(patch, 1, 1, 0)
+
+    def testDeferredContent(self):
+        comment = self.create_tag_comment(self.patch, self.ACK)
+        comment = Comment.objects.defer('content').get(pk=comment.pk)
+        comment.delete()
+        self.assertTagsEqual(self.patch, 0, 0, 0)
+
+    def testRefresh(self):
+        self.create_tag_comment(self.patch, self.ACK)
+        self.create_tag_comment(self.patch, self.ACK)
+        PatchTag.objects.filter(patch=self.patch).update(count=5)
+        self.patch.refresh_tag_counts()
+        self.assertTagsEqual(self.patch, 2, 0, 0)
+
+    def testDeferredRefresh(self):
+        with deferred.collect():
+            self.create_tag_comment(self.patch, self.ACK)
+            comment = self.create_tag_comment(self.patch, self.REVIEW)
+            # a comment whose content wasn't loaded refreshes the counts
+            comment = Comment.objects.defer('content').get(pk=comment.pk)
+            comment.save()
+            self.create_tag_comment(self.patch, self.ACK)
+        self.assertTagsEqual(self.patch, 2, 1, 0)
+
+    def testNoTagCommentQueries(self):
+        # warm up the project tag matcher
+        self.patch.project.tag_matcher
+        comment = Comment(patch=self.patch, msgid='z',
+                          submitter=defaults.patch_author_person,
+                          content='no tag here')
+        # a comment without tags doesn't need to touch the tag counts
+        with CaptureQueriesContext(connection) as ctx:
+            comment.save()
+        queries = [q['sql'] for q in ctx.captured_queries]
+        self.assertFalse([q for q in queries if 'patchwork_patchtag' in q])
+        self.assertFalse([q for q in queries if 'patchwork_comment' in q and
+                          q.startswith('SELECT')])
+
 
 class PatchTagManagerTest(PatchTagsTest):
 
@@ -198,14 +317,14 @@ class PatchTagManagerTest(PatchTagsTest):
             tagattrs[tag.name] = tag.attr_name
 
         # force project.tags to be queried outside of the assertNumQueries
-        patch.project.tags
+        project = patch.project
+        project.tags
 
-        # we should be able to do this with two queries: one for
-        # the patch table lookup, and the prefetch_related for the
-        # projects table.
+        # we should be able to do this with two queries: one for the patch
+        # table lookup, and one for the tag counts
         with self.assertNumQueries(2):
-            patch = Patch.objects.with_tag_counts(project=patch.project) \
-                .get(pk=patch.pk)
+            patch = Patch.objects.get(pk=patch.pk)
+            set_tag_counts([patch], project)
 
             counts = (
                 getattr(patch, tagattrs['Acked-by']),
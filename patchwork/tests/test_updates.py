@@ -18,7 +18,9 @@
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
 from django.core.urlresolvers import reverse
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 
 from patchwork.models import Patch, Person, State
 from patchwork.tests.utils import defaults, create_maintainer
@@ -89,6 +91,19 @@ class MultipleUpdateTest(TestCase):
         for p in self.patches:
             self.assertEqual(Patch.objects.get(pk=p.pk).state, state)
 
+    def testStateChangeSeriesQueries(self):
+        # the series of the patches, to log the state changes, are looked
+        # up at once
+        state = State.objects.exclude(pk=self.patches[0].state_id)[0]
+        data = self.base_data.copy()
+        data.update({'state': str(state.pk)})
+        self._selectAllPatches(data)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(self.url, data)
+        lookups = [query for query in queries
+                   if 'FROM "patchwork_seriesrevisionpatch"' in query['sql']]
+        self.assertEqual(len(lookups), 1)
+
     def testStateChangeInvalid(self):
         state = max(State.objects.all().values_list('id', flat=True)) + 1
         orig_states = [patch.state for patch in self.patches]
@@ -26,7 +26,8 @@ from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
 from django.core.mail import EmailMessage
-from django.db.models import Max, Q, F
+from django.db.models import Max, Q, F, Value
+from django.db.models.functions import Coalesce
 from django.shortcuts import get_object_or_404
 from django.template.loader import render_to_string
 
@@ -59,6 +60,9 @@ class Order(object):
         'delegate': 'delegate__username',
     }
     default_order = ('date', True)
+    # orders on a column that can be NULL, which is sorted as '' so that
+    # keyset pagination doesn't have to compare NULLs
+    nullable = ('submitter', 'delegate')
 
     def __init__(self, str=None, editable=False):
         self.reversed = False
@@ -102,23 +106,30 @@ class Order(object):
             return 'up'
         return 'down'
 
-    def apply(self, qs):
-        q = self.order_map[self.order]
-        if self.reversed:
-            q = '-' + q
+    def _key(self, name):
+        key = F(self.order_map[name])
+        if name in self.nullable:
+            key = Coalesce(key, Value(''))
+        return key
 
-        orders = [q]
+    def keys(self):
+        """The (expression, descending) pairs the patches are sorted on. The
+           id comes last, so that patches are always in the same order."""
+        keys = [(self._key(self.order), self.reversed)]
 
         # if we're using a non-default order, add the default as a secondary
         # ordering. We reverse the default if the primary is reversed.
         (default_name, default_reverse) = self.default_order
         if self.order != default_name:
-            q = self.order_map[default_name]
-            if self.reversed ^ default_reverse:
-                q = '-' + q
-            orders.append(q)
+            keys.append((self._key(default_name),
+                         self.reversed ^ default_reverse))
 
-        return qs.order_by(*orders)
+        keys.append((F('id'), keys[-1][1]))
+        return keys
+
+    def apply(self, qs):
+        return qs.order_by(*[key.desc() if descending else key.asc()
+                             for (key, descending) in self.keys()])
 
 
 bundle_actions = ['create', 'add', 'remove']
@@ -29,9 +29,9 @@ import re
 
 from .base import *  # noqa
 from patchwork.utils import Order, get_patch_ids, bundle_actions, set_bundle
-from patchwork.paginator import Paginator
+from patchwork.paginator import KeysetPaginator, Paginator
 from patchwork.forms import MultiplePatchForm
-from patchwork.models import Comment, Patch
+from patchwork.models import Comment, Patch, set_series_ids, set_tag_counts
 from patchwork.filters import Filters
 from patchwork.permissions import Can
 
@@ -120,9 +120,6 @@ def generic_list(request, project, view,
     if patches is None:
         patches = Patch.objects.filter(project=project)
 
-    # annotate with tag counts
-    patches = patches.with_tag_counts(project)
-
     patches = context['filters'].apply(patches)
     if not editable_order:
         patches = order.apply(patches)
@@ -135,7 +132,13 @@ def generic_list(request, project, view,
     # rendering the list template
     patches = patches.select_related('state', 'submitter', 'delegate')
 
-    paginator = Paginator(request, patches)
+    if editable_order:
+        paginator = Paginator(request, patches)
+    else:
+        paginator = KeysetPaginator(request, patches, order)
+
+    # annotate the patches of the page with their tag counts
+    set_tag_counts(paginator.current_page.object_list, project)
 
     context.update({
         'page': paginator.current_page,
@@ -156,6 +159,11 @@ def process_multiplepatch_form(form, user, action, patches, context):
         context['messsages'] += ["No patches selected; nothing updated"]
         return errors
 
+    # the patches are saved one by one, log their state changes without
+    # a query per patch
+    patches = list(patches)
+    set_series_ids(patches)
+
     changed_patches = 0
     for patch in patches:
         if not Can(user).edit(patch):
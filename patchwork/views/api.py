@@ -24,6 +24,7 @@ from django.conf import settings
 from django.core import mail
 from django.db.models import Q
 from django.http import HttpResponse
+from patchwork import search
 from patchwork.tasks import send_reviewer_notification
 from patchwork.models import (Project, Series, SeriesRevision, Patch, EventLog,
                               State, Test, TestResult, TestState, Person,
@@ -488,6 +489,11 @@ class PatchFilter(django_filters.FilterSet):
         except State.DoesNotExist:
             return queryset
 
+    def filter_search(self, queryset, name, query):
+        if not query.strip():
+            return queryset
+        return queryset.filter(pk__in=search.matching(query))
+
     submitted_since = django_filters.CharFilter(name='date',
                                                 lookup_expr='gt')
     updated_since = django_filters.CharFilter(name='last_updated',
@@ -499,6 +505,7 @@ class PatchFilter(django_filters.FilterSet):
     submitter = django_filters.CharFilter(method='filter_submitter')
     name = django_filters.CharFilter(lookup_expr='icontains')
     state = django_filters.CharFilter(method='filter_state')
+    search = django_filters.CharFilter(method='filter_search')
 
     class Meta:
         model = Patch
@@ -88,7 +88,7 @@ def register_confirm(request, conf):
     conf.user.save()
     conf.deactivate()
     try:
-        person = Person.objects.get(email__iexact=conf.user.email)
+        person = Person.objects.get(email_lower=conf.user.email.lower())
     except Person.DoesNotExist:
         person = Person(email=conf.user.email,
                         name=conf.user.profile.name())
@@ -158,7 +158,7 @@ def link(request):
 @login_required
 def link_confirm(request, conf):
     try:
-        person = Person.objects.get(email__iexact=conf.email)
+        person = Person.objects.get(email_lower=conf.email.lower())
     except Person.DoesNotExist:
         person = Person(email=conf.email)
 
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+#
+# Patchwork - automated patch tracking system
+# Copyright (C) 2018 Intel Corporation
+#
+# This file is part of the Patchwork package.
+#
+# Patchwork is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Patchwork is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Patchwork; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Compare the delegation rule matching of auto_delegate(), one fnmatch()
+per file and rule, with the compiled DelegationMatcher, on synthetic rule
+sets and tree-wide patches."""
+
+from __future__ import print_function
+
+import argparse
+from fnmatch import fnmatch
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from patchwork.parser import DelegationMatcher  # noqa
+
+
+def make_tree(n_dirs, depth, rng):
+    dirs = ['']
+    for i in range(n_dirs):
+        parent = rng.choice(dirs)
+        if parent.count('/') >= depth:
+            parent = ''
+        dirs.append('%sdir%d/' % (parent, i))
+    return dirs[1:]
+
+
+def make_rules(dirs, n_rules, rng):
+    rules = []
+    for i in range(n_rules):
+        d = rng.choice(dirs)
+        kind = i % 3
+        if kind == 0:
+            path = d + '*'
+        elif kind == 1:
+            path = d + '*.[ch]'
+        else:
+            path = d + 'file%d.?' % rng.randint(0, 9)
+        rules.append((path, 'user%d' % (i % 50)))
+    # the order of the rules is the priority
+    return rules
+
+
+def make_files(dirs, n_files, rng):
+    return ['%sfile%d.%s' % (rng.choice(dirs), rng.randint(0, 9),
+                             rng.choice('chS'))
+            for _ in range(n_files)]
+
+
+def fnmatch_delegate(rules, filename):
+    for (path, delegate) in rules:
+        if fnmatch(filename, path):
+            return delegate
+    return None
+
+
+def bench(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        result = func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return (best, result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rules', type=int, nargs='+',
+                        default=[10, 100, 500, 1000])
+    parser.add_argument('--files', type=int, nargs='+',
+                        default=[1, 10, 100, 1000])
+    parser.add_argument('--dirs', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    dirs = make_tree(args.dirs, 5, rng)
+
+    print('%6s %6s %12s %12s %12s %8s' % ('rules', 'files', 'fnmatch ms',
+                                          'compile ms', 'matcher ms',
+                                          'speedup'))
+    for n_rules in args.rules:
+        rules = make_rules(dirs, n_rules, rng)
+        (compile_time, matcher) = bench(lambda: DelegationMatcher(rules),
+                                        args.repeat)
+        for n_files in args.files:
+            files = make_files(dirs, n_files, rng)
+            (ref_time, expected) = bench(
+                lambda: [fnmatch_delegate(rules, f) for f in files],
+                args.repeat)
+            (time_, got) = bench(
+                lambda: [matcher.delegate(f) for f in files], args.repeat)
+            if got != expected:
+                print('error: DelegationMatcher and fnmatch disagree',
+                      file=sys.stderr)
+                return 1
+            print('%6d %6d %12.2f %12.2f %12.2f %7.1fx' %
+                  (n_rules, n_files, ref_time * 1000, compile_time * 1000,
+                   time_ * 1000, ref_time / time_ if time_ else 0))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+#
+# Patchwork - automated patch tracking system
+# Copyright (C) 2018 Intel Corporation
+#
+# This file is part of the Patchwork package.
+#
+# Patchwork is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Patchwork is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Patchwork; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Compare fetching pages of the patch list with one correlated subquery
+per tag and patch, as with_tag_counts() used to do, with set_tag_counts(),
+on the database configured by DJANGO_SETTINGS_MODULE.
+With --populate, first add synthetic patches and tag counts to the
+project."""
+
+from __future__ import print_function
+
+import argparse
+from collections import OrderedDict
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import django  # noqa
+django.setup()
+
+from django.db import transaction  # noqa
+
+from patchwork.models import (Patch, PatchTag, Person, Project,  # noqa
+                              get_default_initial_patch_state,
+                              set_tag_counts)
+
+
+def subquery_tag_counts(qs, project):
+    select = OrderedDict()
+    select_params = []
+    for tag in project.tags:
+        select[tag.attr_name] = (
+            "coalesce("
+            "(SELECT count FROM patchwork_patchtag "
+            "WHERE patchwork_patchtag.patch_id=patchwork_patch.id "
+            "AND patchwork_patchtag.tag_id=%s), 0)")
+        select_params.append(tag.id)
+    return qs.extra(select=select, select_params=select_params)
+
+
+def populate(project, n_patches, rng):
+    person, _ = Person.objects.get_or_create(email='bench@example.com')
+    state = get_default_initial_patch_state()
+    tags = project.tags
+    start = Patch.objects.count()
+    batch = 5000
+    for first in range(start, start + n_patches, batch):
+        last = min(first + batch, start + n_patches)
+        with transaction.atomic():
+            Patch.objects.bulk_create([
+                Patch(project=project, msgid='<bench-%d@example.com>' % i,
+                      name='[PATCH] bench %d' % i, submitter=person,
+                      state=state, content='', hash='%040x' % i)
+                for i in range(first, last)])
+            patches = Patch.objects.filter(
+                project=project,
+                msgid__in=['<bench-%d@example.com>' % i
+                           for i in range(first, last)])
+            PatchTag.objects.bulk_create([
+                PatchTag(patch_id=pk, tag=tag, count=rng.randint(1, 3))
+                for pk in patches.values_list('pk', flat=True)
+                for tag in tags if rng.random() < 0.3])
+        print('%d/%d' % (last - start, n_patches), end='\r')
+        sys.stdout.flush()
+    print()
+
+
+def fetch_page(qs, page, per_page, tags, project=None):
+    patches = list(qs[page * per_page:(page + 1) * per_page])
+    if project is not None:
+        set_tag_counts(patches, project)
+    return [tuple(getattr(p, tag.attr_name) for tag in tags)
+            for p in patches]
+
+
+def bench(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        result = func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return (best, result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('project', help='linkname of the project')
+    parser.add_argument('--populate', type=int, default=0, metavar='N',
+                        help='add N synthetic patches to the project first')
+    parser.add_argument('--per-page', type=int, default=100)
+    parser.add_argument('--pages', type=int, nargs='+', default=[0, 10, 100])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    project = Project.objects.get(linkname=args.project)
+    if args.populate:
+        populate(project, args.populate, random.Random(args.seed))
+
+    tags = project.tags
+    base = Patch.objects.filter(project=project).order_by('-date') \
+                        .defer('content', 'headers') \
+                        .select_related('state', 'submitter', 'delegate')
+    print('%d patches, %d tags' % (base.count(), len(tags)))
+
+    print('%6s %14s %14s %8s' % ('page', 'subqueries ms', 'current ms',
+                                 'speedup'))
+    for page in args.pages:
+        (ref_time, expected) = bench(
+            lambda: fetch_page(subquery_tag_counts(base, project), page,
+                               args.per_page, tags), args.repeat)
+        (time_, got) = bench(
+            lambda: fetch_page(base, page, args.per_page, tags, project),
+            args.repeat)
+        if got != expected:
+            print('error: tag counts differ', file=sys.stderr)
+            return 1
+        print('%6d %14.2f %14.2f %7.1fx' %
+              (page, ref_time * 1000, time_ * 1000,
+               ref_time / time_ if time_ else 0))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())